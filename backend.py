@@ -0,0 +1,192 @@
+import os
+
+import xarray as xr
+
+import instrument
+import memory_budget
+from output_encoding import netcdf_encoding
+
+# ===== INPUTS =====
+
+# 'eager' opens files as before; 'dask' opens them in chunks and runs the
+# reductions lazily on a local distributed cluster (EXTRACT_BACKEND overrides)
+backend = os.environ.get('EXTRACT_BACKEND', 'eager')
+
+# Chunking policy for ORCA2 fields: a few time steps per chunk, depth/y/x whole
+# (one month of a 3D variable is 31 x 149 x 182 floats, ~3.4 MB); with a memory
+# budget (see memory_budget.py) the chunks are sized to the workers instead
+time_dims = ('time_counter', 'time')
+time_chunk = int(os.environ.get('EXTRACT_TIME_CHUNK', 3))
+
+# Local cluster: workers x memory_limit should stay below the node's memory (32G);
+# with a memory budget each worker gets its share of it instead of worker_memory
+dask_workers = int(os.environ.get('EXTRACT_DASK_WORKERS', 4))
+worker_memory = os.environ.get('EXTRACT_WORKER_MEMORY', '6GB')
+
+# Deferred writes (dask backend) as (write, temporary file, output file),
+# computed together by compute_pending()
+_pending = []
+
+# ===== FUNCTIONS =====
+
+def use_dask():
+    """True when the dask backend is selected"""
+    return backend == 'dask'
+
+
+def chunk_policy(dims, chunk=None):
+    """
+    Chunks for a set of dims: time_chunk along time, everything else whole.
+
+    Parameters
+    ----------
+    dims : iterable of str
+        Dimension names of a dataset
+    chunk : int, optional
+        Time steps per chunk instead of time_chunk (see planned_time_chunk)
+
+    Returns
+    -------
+    dict
+        Chunk size per dim (-1 for a single chunk)
+    """
+    return {d: (chunk or time_chunk) if d in time_dims else -1 for d in dims}
+
+
+def worker_limit():
+    """Memory limit of a dask worker: its share of the memory budget, or worker_memory"""
+    total = memory_budget.budget()
+    if total is None:
+        return worker_memory
+    return int(total / dask_workers)
+
+
+def planned_time_chunk(ds):
+    """
+    Time steps per chunk for a dataset: time_chunk, or with a memory budget
+    the most whose chunk of the largest variable (as float64) fills an
+    eighth of a worker's limit, leaving room for the tasks' copies.
+    """
+    if memory_budget.budget() is None:
+        return time_chunk
+    steps = [memory_budget.field_bytes(da.shape, float) // da.sizes[d]
+             for da in ds.data_vars.values() for d in time_dims if d in da.dims and da.sizes[d]]
+    if not steps:
+        return time_chunk
+    n_time = max(ds.sizes[d] for d in time_dims if d in ds.sizes)
+    chunk = max(1, min(int(worker_limit() / 8 // max(steps)), n_time))
+    memory_budget.report('dask', f"{chunk} time steps per chunk, ~{memory_budget.format_size(chunk * max(steps))} "
+                                 f"of the largest variable", time_chunk=chunk)
+    return chunk
+
+
+def open_dataset(path, **kwargs):
+    """
+    Open one NetCDF file with the selected backend.
+
+    With the dask backend the variables are dask arrays chunked by
+    chunk_policy(), so reductions only read a few time steps at a time.
+    """
+    with instrument.stage('open'):
+        ds = xr.open_dataset(path, **kwargs)
+    if use_dask():
+        ds = ds.chunk(chunk_policy(ds.dims, planned_time_chunk(ds)))
+    return ds
+
+
+def open_mfdataset(paths, **kwargs):
+    """Open several NetCDF files as one dataset, chunked by chunk_policy() with the dask backend"""
+    with instrument.stage('open'):
+        ds = xr.open_mfdataset(paths, **kwargs)
+    if use_dask():
+        return ds.chunk(chunk_policy(ds.dims, planned_time_chunk(ds)))
+    return ds
+
+
+def start_cluster():
+    """
+    Start a local distributed cluster for the dask backend.
+
+    Workers are single-threaded processes with memory_limit=worker_limit(),
+    so an oversized task spills to disk or restarts one worker instead of
+    the node's OOM killer ending the job. Does nothing with the eager backend.
+
+    Returns
+    -------
+    distributed.Client or None
+        Client connected to the cluster (keep a reference for the run)
+    """
+    if not use_dask():
+        return None
+
+    from dask.distributed import Client, LocalCluster
+
+    memory_limit = worker_limit()
+    cluster = LocalCluster(n_workers=dask_workers, threads_per_worker=1, memory_limit=memory_limit)
+    client = Client(cluster)
+    if not isinstance(memory_limit, str):
+        memory_budget.report('dask', f"{dask_workers} workers x {memory_budget.format_size(memory_limit)}",
+                             workers=dask_workers, worker_bytes=memory_limit)
+        memory_limit = memory_budget.format_size(memory_limit)
+    print(f"Dask cluster: {dask_workers} workers x {memory_limit} ({client.dashboard_link})")
+    return client
+
+
+def unit_workers(n_workers):
+    """
+    Process count for run_units: 1 with the dask backend, where the
+    cluster provides the parallelism and units only build task graphs
+    """
+    return 1 if use_dask() else n_workers
+
+
+def write_netcdf(ds, path):
+    """
+    Write a dataset with the output encoding profile (see output_encoding.py),
+    or with the dask backend defer it to compute_pending().
+
+    The dataset is written to a temporary file next to the output, which
+    then replaces it, so an existing output survives a failed rewrite.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Output dataset
+    path : str or Path
+        Output file
+    """
+    encoding = netcdf_encoding(ds)
+    tmp = f'{path}.tmp'
+    if use_dask():
+        _pending.append((ds.to_netcdf(tmp, encoding=encoding, compute=False), tmp, path))
+    else:
+        with instrument.stage('write'):
+            ds.to_netcdf(tmp, encoding=encoding)
+        os.replace(tmp, path)
+
+
+def compute_pending():
+    """
+    Compute every deferred write in one go (dask backend).
+
+    All outputs of the run (e.g. several years) are computed together on
+    the cluster, which schedules them within the workers' memory limits.
+
+    Returns
+    -------
+    int
+        Number of files written
+    """
+    if not _pending:
+        return 0
+
+    import dask
+
+    print(f"Computing {len(_pending)} deferred output(s)...", flush=True)
+    n_written = len(_pending)
+    with instrument.stage('dask_compute'):
+        dask.compute(*[write for write, _, _ in _pending])
+    for _, tmp, path in _pending:
+        os.replace(tmp, path)
+    _pending.clear()
+    return n_written
@@ -0,0 +1,448 @@
+import contextlib
+import gc
+import importlib
+import io
+import json
+import os
+import time
+import tracemalloc
+from pathlib import Path
+
+import cftime
+import numpy as np
+import xarray as xr
+
+import backend
+import instrument
+import mesh_cache
+import output_encoding
+
+# ===== INPUTS =====
+
+# Synthetic ORCA2 inputs are written here once (local disk, not /gpfs) and
+# reused while the sizes below don't change
+work_dir = os.environ.get('EXTRACT_BENCH_DIR', '/tmp/EXTRACT_bench')
+model = 'BENCH_ORCA2'
+
+# ORCA2 sizes (one 4D float32 field is 12 x 31 x 149 x 182 x 4 B = 40 MB per year;
+# the limphy file is ~1 GB)
+n_time = 12
+n_depth = 31
+n_y = 149
+n_x = 182
+n_years = 2  # years of ptrc_T / MOC files (climatology, province means, AMOC)
+
+# Results are compared against this baseline (when its sizes and backend match);
+# the first run on a machine, with no baseline yet, stores its results as the baseline
+baseline_file = 'benchmark_baseline.json'
+save_baseline = False  # True: store this run's results as the new baseline
+tolerance = 1.2  # flag wall time or peak memory more than 20% above the baseline
+
+# Timings keep the fastest of n_repeat untraced runs; peak memory and bytes
+# read/written come from one more run under tracemalloc
+n_repeat = 3
+
+# Functions to benchmark (see benchmark_cases)
+benchmarks = [
+    'get_limiter',
+    'average_top_meters',
+    'integrate_depth',
+    'compute_averages',
+    'compute_climatology',
+    'compute_latitudinal_profiles',
+    'compute_amoc_timeseries',
+]
+
+# Variable names as in the PlankTOM outputs
+pfts = ['DIA', 'MIX', 'COC', 'PIC', 'PHA', 'FIX']
+ptrc_vars = pfts + ['NO3']
+first_year = 2000
+
+# ===== FUNCTIONS =====
+
+def orca2_coordinates(ny, nx):
+    """
+    Approximate ORCA2 nav_lat/nav_lon: ~2 degree cells from 78S to 89N, with
+    latitude refined towards the equator like the ORCA2 grid.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        nav_lat, nav_lon (y, x)
+    """
+    s = np.linspace(-1, 1, ny)
+    lat = np.where(s < 0, 78 * s, 89 * s)
+    lat = lat - 3.5 * np.sin(np.pi * s)  # finer rows near the equator
+    lon = np.linspace(80, 440, nx, endpoint=False)
+    lon = (lon + 180) % 360 - 180
+    nav_lat = np.repeat(lat[:, np.newaxis], nx, axis=1)
+    nav_lon = np.repeat(lon[np.newaxis], ny, axis=0)
+    return nav_lat.astype('float32'), nav_lon.astype('float32')
+
+
+def orca2_levels(nz):
+    """ORCA2-like level thicknesses (10 m at the surface to ~500 m at depth) and centre depths"""
+    k = np.arange(nz)
+    e3t_1d = 10 + 490 / (1 + np.exp(-(k - 0.7 * nz) / (0.12 * nz)))
+    depth = np.cumsum(e3t_1d) - e3t_1d / 2
+    return e3t_1d, depth
+
+
+def bottom_levels(nav_lat, nav_lon, nz, seed=0):
+    """
+    Number of ocean levels per column: 0 on land, shelves near the coasts.
+
+    Continents are ellipses in (lon, lat) at roughly their real positions,
+    plus Antarctica south of 70S, giving a land fraction close to ORCA2's.
+
+    Returns
+    -------
+    np.ndarray
+        Integer (y, x) bottom level count
+    """
+    continents = [  # lon, lat, lon radius, lat radius
+        (-100, 48, 32, 22), (-60, -15, 16, 26), (20, 5, 22, 30), (85, 50, 65, 22),
+        (135, -25, 18, 12), (-40, 73, 14, 10), (105, 15, 15, 12),
+    ]
+    distance = np.full(nav_lat.shape, np.inf)
+    for lon0, lat0, rlon, rlat in continents:
+        dlon = (nav_lon - lon0 + 180) % 360 - 180
+        distance = np.minimum(distance, np.hypot(dlon / rlon, (nav_lat - lat0) / rlat))
+    distance = np.where(nav_lat < -70, 0, distance)
+
+    rng = np.random.default_rng(seed)
+    kbot = np.round(8 + 40 * (distance - 1) + rng.normal(0, 2, distance.shape))
+    kbot = np.clip(kbot, 3, nz).astype(int)
+    return np.where(distance < 1, 0, kbot)
+
+
+def time_axis(year, nt):
+    """Monthly mid-month noleap times of one year"""
+    return [cftime.DatetimeNoLeap(year, m % 12 + 1, 15) for m in range(nt)]
+
+
+def random_field(rng, shape, ocean, scale=1.0):
+    """Uniform random float32 field in [0, scale), NaN outside the ocean mask"""
+    values = rng.random(shape, dtype='float32') * scale
+    values[..., ~ocean] = np.nan
+    return values
+
+
+def make_inputs(work_dir):
+    """
+    Write the synthetic ORCA2 inputs of every benchmark under work_dir.
+
+    Files are only regenerated when the sizes in INPUTS change (recorded in
+    inputs.json).
+
+    Returns
+    -------
+    dict
+        Paths of the generated files and directories
+    """
+    root = Path(work_dir)
+    run_dir = root / 'runs' / model
+    paths = {
+        'runs_dir': f'{root / "runs"}/',
+        'clims_dir': f'{root / "clims"}/',
+        'moc_dir': f'{root / "moc"}/',
+        'mesh_file': str(root / 'mesh_mask.nc'),
+        'ma_file': str(root / 'mask_atl.nc'),
+        'lop_file': str(root / 'LoP_T.nc'),
+        'rg_file': str(root / 'clim_int_rg.nc'),
+        'atl_file': str(root / 'ATL_rg.nc'),
+    }
+    sizes = dict(n_time=n_time, n_depth=n_depth, n_y=n_y, n_x=n_x, n_years=n_years)
+    record = root / 'inputs.json'
+    if record.exists() and json.loads(record.read_text()) == sizes:
+        return paths
+
+    print(f"Writing synthetic ORCA2 inputs to {root} ...", flush=True)
+    for d in ('runs_dir', 'clims_dir', 'moc_dir'):
+        Path(paths[d]).mkdir(parents=True, exist_ok=True)
+    run_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+
+    nav_lat, nav_lon = orca2_coordinates(n_y, n_x)
+    e3t_1d, depth = orca2_levels(n_depth)
+    kbot = bottom_levels(nav_lat, nav_lon, n_depth)
+    tmask = (np.arange(n_depth)[:, np.newaxis, np.newaxis] < kbot).astype('int8')
+    ocean = tmask != 0
+    csize = (111e3 * 2) ** 2 * np.cos(np.deg2rad(nav_lat)) * tmask[0]
+    horizontal = {'nav_lat': (('y', 'x'), nav_lat), 'nav_lon': (('y', 'x'), nav_lon)}
+
+    # Mesh mask (e3t_0, tmask, csize), as in mesh_mask3_6.nc / the nicedims file
+    e3t = np.broadcast_to(e3t_1d[:, np.newaxis, np.newaxis], tmask.shape).astype('float64')
+    mesh = xr.Dataset({
+        'e3t_0': (('t', 'z', 'y', 'x'), e3t[np.newaxis]),
+        'tmask': (('t', 'z', 'y', 'x'), tmask[np.newaxis]),
+        'csize': (('y', 'x'), csize),
+        'glamt': (('t', 'y', 'x'), nav_lon[np.newaxis]),
+        'gphit': (('t', 'y', 'x'), nav_lat[np.newaxis]),
+    })
+    mesh.to_netcdf(paths['mesh_file'])
+
+    # Atlantic regions of mask_atl.nc
+    atlantic = (nav_lon > -80) & (nav_lon < 20) & ocean[0]
+    regions = {
+        'AB': atlantic & (nav_lat > -35) & (nav_lat < 10),
+        'HA': atlantic & (nav_lat >= 10) & (nav_lat < 45),
+        'NA': atlantic & (nav_lat >= 45),
+    }
+    xr.Dataset({k: (('y', 'x'), v.astype(float)) for k, v in regions.items()}).to_netcdf(paths['ma_file'])
+
+    def model_file(year, names, scale=1.0):
+        ds = xr.Dataset(coords={'time_counter': time_axis(year, n_time), 'deptht': depth})
+        ds = ds.assign_coords(horizontal)
+        for name in names:
+            ds[name] = (('time_counter', 'deptht', 'y', 'x'),
+                        random_field(rng, (n_time, n_depth, n_y, n_x), ocean, scale))
+        return ds
+
+    # limphy (one year) with the nutrient and light limitation terms
+    limphy_vars = []
+    for pft in pfts:
+        p = pft.lower()
+        limphy_vars += [f'lim3fe_{p}', f'lim4po4_{p}', f'lim6din_{p}', f'lim8light_{p}']
+        if p == 'dia':
+            limphy_vars.append('lim5si_dia')
+    model_file(first_year, limphy_vars).to_netcdf(
+        run_dir / f'ORCA2_1m_{first_year}0101_{first_year}1231_limphy.nc')
+
+    # LoP (LV_DIA, ...) for average_top_meters
+    model_file(first_year, [f'LV_{pft}' for pft in pfts]).to_netcdf(paths['lop_file'])
+
+    # ptrc_T for the climatology, depth integral and province means
+    for year in range(first_year, first_year + n_years):
+        model_file(year, ptrc_vars, 1e-6).to_netcdf(
+            run_dir / f'ORCA2_1m_{year}0101_{year}1231_ptrc_T.nc')
+
+    # CDFTOOLS MOC files (zonal integrals, x=1)
+    depthw = np.concatenate([[0], np.cumsum(e3t_1d)[:-1]])
+    for year in range(first_year, first_year + n_years):
+        moc = xr.Dataset(coords={'time_counter': time_axis(year, n_time), 'depthw': depthw})
+        moc['nav_lat'] = (('y', 'x'), nav_lat[:, :1])
+        for name in ('zomsfatl', 'zomsfglo', 'zomsfinp'):
+            moc[name] = (('time_counter', 'depthw', 'y', 'x'),
+                         rng.normal(10, 5, (n_time, n_depth, n_y, 1)).astype('float32'))
+        moc.to_netcdf(f'{paths["moc_dir"]}{model}_1m_{year}0101_{year}1231_MOC.nc')
+
+    # Regridded depth-integrated climatology (r360x180) and Atlantic cell sizes
+    lat = np.arange(-89.5, 90, 1.0)
+    lon = np.arange(0.5, 360, 1.0)
+    rg_ocean = rng.random((lat.size, lon.size)) > 0.3
+    rg = xr.Dataset(coords={'time_counter': np.arange(1, 13), 'lat': ('y', lat), 'lon': ('x', lon)})
+    for pft in pfts:
+        rg[pft] = (('time_counter', 'y', 'x'), random_field(rng, (12, lat.size, lon.size), rg_ocean))
+    rg.to_netcdf(paths['rg_file'])
+    atl = np.where(rg_ocean & (lon > 280)[np.newaxis], np.cos(np.deg2rad(lat))[:, np.newaxis], 0)
+    xr.Dataset({'ATL_csize': (('y', 'x'), atl)}).to_netcdf(paths['atl_file'])
+
+    record.write_text(json.dumps(sizes))
+    return paths
+
+
+def benchmark_cases(paths):
+    """
+    Benchmarked calls on the synthetic inputs.
+
+    Scripts are pointed at the synthetic files through their INPUTS; the
+    returned callables run one function each (n_workers=1, so the work
+    happens in this process and is measured).
+
+    Returns
+    -------
+    dict
+        Benchmark name -> callable
+    """
+    lop = importlib.import_module('extract-LoP')
+    lnl = importlib.import_module('create_LNL_files')
+    di = importlib.import_module('depth_integrate')
+    cpm = importlib.import_module('compute_province_means')
+    clim = importlib.import_module('get_clim')
+    lp = importlib.import_module('compute_latitudinal_profiles')
+    amoc = importlib.import_module('get_AMOC')
+
+    lop.base_dir = paths['runs_dir']
+    lop.mesh_file = paths['mesh_file']
+    lop.output_format = 'netcdf'
+    cpm.clims_dir = paths['clims_dir']
+    cpm.mask_file = paths['mesh_file']
+    cpm.ma_file = paths['ma_file']
+    province_weights = cpm.load_province_weights()
+    tmesh = mesh_cache.cached_dataset(paths['mesh_file'], ['e3t_0', 'tmask'])
+    ptrc_file = f'{paths["runs_dir"]}{model}/ORCA2_1m_{first_year}0101_{first_year}1231_ptrc_T.nc'
+    last_year = first_year + n_years - 1
+
+    def latitudinal_profiles():
+        with xr.open_dataset(paths['rg_file']) as ds, xr.open_dataset(paths['atl_file']) as atl:
+            return lp.compute_latitudinal_profiles(ds, pfts, atl.ATL_csize).load()
+
+    cases = {
+        'get_limiter': lambda: lop.get_limiter(model, first_year),
+        'average_top_meters': lambda: lnl.average_top_meters(
+            backend.open_dataset(paths['lop_file']), [f'LV_{pft}' for pft in pfts], 100, tmesh),
+        'integrate_depth': lambda: di.integrate_depth(backend.open_dataset(ptrc_file), ptrc_vars, tmesh),
+        'compute_averages': lambda: cpm.compute_averages(
+            model, 'ptrc', 'NO3', 0, province_weights, paths['runs_dir'], n_workers=1),
+        'compute_climatology': lambda: clim.compute_climatology(
+            model, 'ptrc_T', first_year, last_year, paths['runs_dir'], paths['clims_dir'],
+            clim.streaming, clim.with_std),
+        'compute_latitudinal_profiles': latitudinal_profiles,
+        'compute_amoc_timeseries': lambda: amoc.compute_amoc_timeseries(
+            model, first_year, last_year, paths['moc_dir'], paths['clims_dir'], n_readers=1),
+    }
+    return {name: cases[name] for name in benchmarks}
+
+
+def run_case(name, func):
+    """Call a benchmarked function with its output silenced, computing lazy results and deferred writes"""
+    with contextlib.redirect_stdout(io.StringIO()), instrument.unit(benchmark=name):
+        result = func()
+        if hasattr(result, 'compute'):
+            result.compute()
+        backend.compute_pending()
+
+
+def measure(name, func, n_repeat=3):
+    """
+    Time one benchmark and record its peak memory and I/O.
+
+    Parameters
+    ----------
+    name : str
+        Benchmark name (tags its records in the run report)
+    func : callable
+        Benchmarked call
+    n_repeat : int, optional
+        Untraced runs; the fastest is kept
+
+    Returns
+    -------
+    dict
+        wall_s, cpu_s, peak_mb (Python/numpy allocations traced by
+        tracemalloc) and read_mb/written_mb (None where /proc is missing).
+        With the dask backend, work done on the cluster's workers is only
+        in wall_s, so results are compared within one backend.
+    """
+    walls, cpus = [], []
+    for _ in range(n_repeat):
+        gc.collect()
+        t0, c0 = time.perf_counter(), time.process_time()
+        run_case(name, func)
+        walls.append(time.perf_counter() - t0)
+        cpus.append(time.process_time() - c0)
+
+    gc.collect()
+    io0 = instrument.io_bytes()
+    tracemalloc.start()
+    try:
+        run_case(name, func)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    io1 = instrument.io_bytes()
+
+    result = {'wall_s': min(walls), 'cpu_s': min(cpus), 'peak_mb': peak / 2**20}
+    if io0 is not None and io1 is not None:
+        result['read_mb'] = (io1[0] - io0[0]) / 2**20
+        result['written_mb'] = (io1[1] - io0[1]) / 2**20
+    else:
+        result['read_mb'] = result['written_mb'] = None
+    return result
+
+
+def run_metadata():
+    """What the numbers depend on besides the code: sizes, backend and output encoding"""
+    return {
+        'n_time': n_time, 'n_depth': n_depth, 'n_y': n_y, 'n_x': n_x, 'n_years': n_years,
+        'backend': backend.backend, 'encoding': output_encoding.profile,
+    }
+
+
+def load_baseline(path, meta):
+    """Baseline results for the same metadata, or {} (with a note) if there is none"""
+    try:
+        with open(path, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if baseline.get('meta') != meta:
+        print(f"Baseline {path} was recorded with {baseline.get('meta')}; not comparing")
+        return {}
+    return baseline['results']
+
+
+def format_report(results, baseline, tolerance=1.2):
+    """
+    Table of results with wall time and peak memory relative to the baseline.
+
+    Ratios above tolerance are marked SLOWER / MORE MEMORY.
+
+    Returns
+    -------
+    str
+        Report text
+    """
+    def mb(value):
+        return f"{value:9.1f}" if value is not None else f"{'-':>9}"
+
+    lines = [f"{'benchmark':<30}{'wall s':>9}{'cpu s':>9}{'peak MB':>9}{'read MB':>9}{'write MB':>9}  vs baseline"]
+    for name, r in results.items():
+        line = f"{name:<30}{r['wall_s']:9.2f}{r['cpu_s']:9.2f}{mb(r['peak_mb'])}{mb(r['read_mb'])}{mb(r['written_mb'])}"
+        base = baseline.get(name)
+        if base:
+            wall_ratio = r['wall_s'] / base['wall_s']
+            peak_ratio = r['peak_mb'] / base['peak_mb'] if base['peak_mb'] else 1.0
+            line += f"  wall {wall_ratio:.2f}x  peak {peak_ratio:.2f}x"
+            if wall_ratio > tolerance:
+                line += '  SLOWER'
+            if peak_ratio > tolerance:
+                line += '  MORE MEMORY'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+# ===== RUN =====
+
+def main():
+    """Run the benchmarks and report them against the baseline"""
+    # Keep the mesh cache and run report of the synthetic grid out of the shared ones
+    mesh_cache.cache_dir = str(Path(work_dir) / 'cache')
+    instrument.report_file = str(Path(work_dir) / 'report.jsonl') if instrument.report_file else ''
+
+    paths = make_inputs(work_dir)
+    cases = benchmark_cases(paths)
+    meta = run_metadata()
+    print(f"Benchmarking {len(cases)} function(s) on {n_time} x {n_depth} x {n_y} x {n_x} "
+          f"({backend.backend} backend, {output_encoding.profile} encoding)")
+
+    client = backend.start_cluster()
+
+    results = {}
+    for name, func in cases.items():
+        print(f"  {name} ...", flush=True)
+        try:
+            results[name] = measure(name, func, n_repeat)
+        except Exception as e:
+            print(f"  ERROR benchmarking {name}: {e}")
+
+    baseline = load_baseline(baseline_file, meta)
+    print()
+    print(format_report(results, baseline, tolerance))
+
+    first_run = not os.path.exists(baseline_file)
+    if (save_baseline or first_run) and results:
+        with open(baseline_file, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+        if first_run:
+            print(f"\nNo baseline yet: saved this run to {baseline_file}; later runs are compared against it")
+        else:
+            print(f"\nSaved baseline to {baseline_file}")
+
+    if client is not None:
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+
+import instrument
+import mesh_cache
+from cli import read_models_from_file
+
+# ===== INPUTS =====
+
+# Directories indexed by `python catalog.py` (the scripts index theirs on first lookup)
+runs_dir = '/gpfs/data/greenocean/software/runs/'
+clims_dir = '/gpfs/data/greenocean/users/mep22dku/clims/'
+moc_dir = '/gpfs/data/greenocean/software/resources/CDFTOOLS/MOCresults/'
+models_file = 'models.txt'  # Path to text file containing model names
+
+# Keep directory indexes under <cache_dir>/v<CACHE_VERSION>/catalog/ (see mesh_cache.py)
+# so later jobs skip the listing while the directory is unchanged
+persist = True
+
+# An index is only reused if it was taken this many seconds after the directory
+# last changed: files added within the filesystem's mtime resolution are not missed
+settle_s = 2.0
+
+# File names: yearly run output, climatologies (get_clim and derived files) and MOC files
+run_name = re.compile(r'^ORCA2_1m_(?P<start>\d{8})_(?P<end>\d{8})_(?P<type>.+)\.nc$')
+clim_name = re.compile(r'^ORCA2_1m_clim_(?P<start>\d{4})_(?P<end>\d{4})_(?P<type>.+)\.nc$')
+moc_name = re.compile(r'^(?P<model>.+?)_1m_(?P<start>\d{8})_(?:(?P<end>\d{8})_)?.*?(?P<type>MOC)\.nc$')
+
+# File type with an optional grid letter and derived-file suffixes, e.g. ptrc_T_int_rg
+type_name = re.compile(r'^(?P<filetype>.+?)(?:_(?P<grid>[A-Z]))?(?P<suffix>(?:_[a-z]+)*)$')
+
+# Indexes already read in this process: directory -> index
+_indexes = {}
+
+# ===== FUNCTIONS =====
+
+def parse_type(text):
+    """
+    Split a file type into (filetype, grid letter, suffix).
+
+    e.g. 'ptrc_T' -> ('ptrc', 'T', ''), 'ptrc_T_int_rg' -> ('ptrc', 'T', '_int_rg'),
+    'limphy' -> ('limphy', None, '')
+    """
+    m = type_name.match(text)
+    return m['filetype'], m['grid'], m['suffix']
+
+
+def parse_name(name, model=None):
+    """
+    Catalog entry for a file name, or None for names the catalog doesn't know.
+
+    Parameters
+    ----------
+    name : str
+        File name
+    model : str, optional
+        Model the file belongs to when the name doesn't say (run and
+        climatology files live in one directory per model)
+
+    Returns
+    -------
+    dict or None
+        name, model, year, year_end, filetype, grid, suffix and clim
+        (True for climatologies)
+    """
+    for pattern, clim in ((clim_name, True), (run_name, False), (moc_name, False)):
+        m = pattern.match(name)
+        if m:
+            break
+    else:
+        return None
+
+    filetype, grid, suffix = parse_type(m['type'])
+    end = m['end'] or m['start']
+    return {
+        'name': name,
+        'model': m.groupdict().get('model') or model,
+        'year': int(m['start'][:4]),
+        'year_end': int(end[:4]),
+        'filetype': filetype,
+        'grid': grid,
+        'suffix': suffix,
+        'clim': clim,
+    }
+
+
+def scan_directory(directory):
+    """
+    List a directory once and parse the names of its NetCDF files.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Run directory (runs/<model>/), climatology directory (clims/<model>/)
+        or MOC directory
+
+    Returns
+    -------
+    list of dict
+        Entries (see parse_name), sorted by name
+    """
+    model = Path(directory).name
+    entries = []
+    with instrument.stage('scan'):
+        with os.scandir(directory) as it:
+            for item in it:
+                if item.name.endswith('.nc'):
+                    entry = parse_name(item.name, model)
+                    if entry is not None:
+                        entries.append(entry)
+    return sorted(entries, key=lambda e: e['name'])
+
+
+def index_file(directory):
+    """Persistent index of a directory, keyed by its absolute path"""
+    key = hashlib.sha1(os.path.abspath(directory).encode()).hexdigest()
+    return Path(mesh_cache.cache_dir) / f'v{mesh_cache.CACHE_VERSION}' / 'catalog' / f'{key}.json'
+
+
+def directory_index(directory):
+    """
+    Entries of a directory, listing it only when it has changed.
+
+    The index is remembered in this process and, with persist, on disk,
+    keyed by the directory's mtime: adding, removing or renaming a file
+    changes it, so a stale index is never used. Missing directories have
+    no entries.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory to index
+
+    Returns
+    -------
+    list of dict
+        Entries (see parse_name)
+    """
+    directory = os.path.abspath(directory)
+    try:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    def usable(index):
+        return (index is not None and index.get('directory') == directory and index['mtime_ns'] == mtime_ns
+                and index['scanned'] - mtime_ns / 1e9 > settle_s)
+
+    index = _indexes.get(directory)
+    if not usable(index) and persist:
+        try:
+            with open(index_file(directory), 'r') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = None
+
+    if not usable(index):
+        index = {'directory': directory, 'mtime_ns': mtime_ns, 'scanned': time.time(),
+                 'entries': scan_directory(directory)}
+        if persist:
+            path = index_file(directory)
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.parent / f'.{path.name}.{uuid.uuid4().hex}.tmp'
+                tmp.write_text(json.dumps(index))
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"  Warning: could not save the file index of {directory}: {e}")
+
+    _indexes[directory] = index
+    return index['entries']
+
+
+def matching_entries(directory, filetype=None, model=None, years=None, clim=False, suffix=''):
+    """
+    Entries of a directory matching a file type, model and years.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory to look in
+    filetype : str, optional
+        File type, with or without grid letter ('ptrc_T' or 'ptrc');
+        without one, files on any grid match. None matches every type
+    model : str, optional
+        Model name (needed for the MOC directory, which holds every model)
+    years : iterable of int, optional
+        Start years to keep
+    clim : bool, optional
+        Look for climatologies instead of yearly files
+    suffix : str or None, optional
+        Derived-file suffix ('' for the files themselves, '_int', '_int_rg', ...);
+        None matches any
+
+    Returns
+    -------
+    list of dict
+        Matching entries (see parse_name), sorted by year then name
+    """
+    wanted = parse_type(filetype) if filetype else None
+    years = None if years is None else set(years)
+    matches = []
+    for e in directory_index(directory):
+        if e['clim'] != clim or (model is not None and e['model'] != model):
+            continue
+        if years is not None and e['year'] not in years:
+            continue
+        if suffix is not None and e['suffix'] != suffix:
+            continue
+        if wanted and (e['filetype'] != wanted[0] or (wanted[1] and e['grid'] != wanted[1])):
+            continue
+        matches.append(e)
+    return sorted(matches, key=lambda e: (e['year'], e['name']))
+
+
+def find_files(directory, filetype=None, **match):
+    """Paths of the matching files, sorted by year then name (arguments as for matching_entries)"""
+    return [Path(directory) / e['name'] for e in matching_entries(directory, filetype, **match)]
+
+
+def files_by_year(directory, filetype, model=None, years=None):
+    """
+    One yearly file per year, the first by name (as glob(...)[0] picked).
+
+    Returns
+    -------
+    dict
+        Year -> Path, in year order
+    """
+    found = {}
+    for e in matching_entries(directory, filetype, model=model, years=years):
+        found.setdefault(e['year'], Path(directory) / e['name'])
+    return found
+
+
+# ===== RUN =====
+
+def main():
+    """Index the run and climatology directories of the models in models_file, and the MOC directory"""
+    for model in read_models_from_file(models_file):
+        for directory in (Path(runs_dir) / model, Path(clims_dir) / model):
+            print(f"{directory}: {len(directory_index(directory))} files")
+    print(f"{moc_dir}: {len(directory_index(moc_dir))} files")
+
+
+if __name__ == '__main__':
+    main()
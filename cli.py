@@ -0,0 +1,165 @@
+import argparse
+import ast
+import importlib
+import os
+import sys
+
+import memory_budget
+
+# ===== INPUTS =====
+
+# Scripts runnable as `python cli.py <script>`; each has INPUTS and a main()
+scripts = {
+    'get_clim': 'monthly climatologies (ptrc_T, diad_T)',
+    'depth_integrate': 'depth integrals of the climatologies',
+    'regrid_clim': 'bilinear ORCA2 -> r360x180 regridding',
+    'compute_latitudinal_profiles': 'Atlantic latitudinal profiles',
+    'extract-LoP': 'limiting nutrient and value per PFT (LoP_T)',
+    'create_LNL_files': 'top 10m/100m nutrient and light limitation (LNL_T)',
+    'compute_province_means': 'province means',
+    'get_AMOC': 'AMOC timeseries and overturning metrics',
+    'pipeline': 'make-style runner over the stages above',
+    'zarr_store': 'convert yearly LoP_T/LNL_T files to Zarr stores',
+    'benchmark': 'benchmarks on synthetic ORCA2 inputs',
+    'instrument': 'summary of the latest run report',
+    'worker': 'resident worker serving jobs from the spool directory',
+    'catalog': 'index the run, climatology and MOC directories',
+}
+
+# ===== FUNCTIONS =====
+
+def read_models_from_file(filepath):
+    """
+    Read model names from a text file (one per line).
+
+    Parameters
+    ----------
+    filepath : str or Path
+        Path to text file containing model names
+
+    Returns
+    -------
+    list of str
+        List of model names
+    """
+    models = []
+    try:
+        with open(filepath, 'r') as f:
+            for line in f:
+                line = line.strip()
+                # Skip empty lines and comments
+                if line and not line.startswith('#'):
+                    models.append(line)
+        print(f"Loaded {len(models)} models from {filepath}")
+        return models
+    except FileNotFoundError:
+        print(f"ERROR: Models file not found: {filepath}")
+        return []
+
+
+def parse_value(text):
+    """Python literal for an input override (e.g. 2010, [10, 100], True), or the text itself"""
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def load_script(name, overrides=None):
+    """
+    Import a script and override some of its INPUTS.
+
+    Importing a script only defines its inputs and functions: masks and
+    meshes are loaded on first use, and nothing runs until main().
+
+    Parameters
+    ----------
+    name : str
+        Script module name, e.g. 'get_clim' or 'extract-LoP'
+    overrides : dict, optional
+        Input name -> value, e.g. {'yrst': 2000, 'n_workers': 8}
+
+    Returns
+    -------
+    module
+        The script's module
+
+    Raises
+    ------
+    AttributeError
+        If an override isn't one of the script's inputs
+    """
+    module = importlib.import_module(name)
+    for key, value in (overrides or {}).items():
+        if key.startswith('_') or not hasattr(module, key) or callable(getattr(module, key)):
+            raise AttributeError(f"{name} has no input '{key}'")
+        setattr(module, key, value)
+    return module
+
+
+def build_parser():
+    """Command-line arguments: script, --models, --workers, --ensemble, --mark-built, --max-memory and --set NAME=VALUE"""
+    parser = argparse.ArgumentParser(
+        prog='python cli.py',
+        description='Run an EXTRACT script, optionally overriding its INPUTS.',
+        epilog='scripts:\n' + '\n'.join(f'  {name:<30}{text}' for name, text in scripts.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('script', choices=list(scripts), metavar='script', help='script to run (see below)')
+    parser.add_argument('--models', help='models file (models_file)')
+    parser.add_argument('--workers', type=int, help='worker processes (n_workers)')
+    parser.add_argument('--ensemble', action='store_true',
+                        help='process all models together along a model dim (ensemble_mode)')
+    parser.add_argument('--mark-built', action='store_true',
+                        help='pipeline: record existing outputs as built instead of rebuilding them (mark_built)')
+    parser.add_argument('--max-memory', metavar='SIZE',
+                        help='memory budget of the job, e.g. 28G: sizes time blocks, passes and workers '
+                             'to stay under it (see memory_budget.py)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="override an input, e.g. --set yrst=2000 --set 'depth_levels=[10, 50]'")
+    return parser
+
+
+# ===== RUN =====
+
+def main(argv=None):
+    """Run the script named on the command line with its overridden INPUTS"""
+    args = build_parser().parse_args(argv)
+
+    overrides = {}
+    if args.models is not None:
+        overrides['models_file'] = args.models
+    if args.workers is not None:
+        overrides['n_workers'] = args.workers
+    if args.ensemble:
+        overrides['ensemble_mode'] = True
+    if args.mark_built:
+        overrides['mark_built'] = True
+    for item in args.set:
+        name, sep, value = item.partition('=')
+        if not sep:
+            print(f"ERROR: --set expects NAME=VALUE, got '{item}'")
+            return 2
+        overrides[name.strip()] = parse_value(value)
+
+    if args.max_memory is not None:
+        try:
+            memory_budget.parse_size(args.max_memory)
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            return 2
+        # Also for processes started by the script (dask workers, pipeline stages)
+        memory_budget.max_memory = os.environ['EXTRACT_MAX_MEMORY'] = args.max_memory
+
+    try:
+        module = load_script(args.script, overrides)
+    except AttributeError as e:
+        print(f"ERROR: {e}")
+        return 2
+
+    module.main()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,30 @@
+import numpy as np
+import scipy.sparse
 import xarray as xr
 from pathlib import Path
 
+import backend
+import catalog
+import instrument
+import memory_budget
+from cli import read_models_from_file
+from depth_integrate import integrate_depth, smallest_integration_bytes
+from executor import default_workers, run_units, shared_resource
+from mesh_cache import cached_dataset, cached_derived
+from output_encoding import netcdf_encoding
+from regrid_clim import regrid_unit
+
 # ===== INPUTS =====
 
 # Paths
 bdir = '/gpfs/data/greenocean/users/mep22dku/clims/'
 models_file = 'models.txt'  # Path to text file containing model names
+n_workers = default_workers()  # Processes for model units; 1 runs serially
+regrid_missing = True  # Regrid the depth-integrated file in-process when the _rg file is missing
 
-# Load masks and setup
-cdomask = xr.open_dataset('/gpfs/home/mep22dku/scratch/SOZONE/windAnalyis/wspdComponents/PlankTOMmask_regridrecalc.nc')
-tmask = cdomask.tmask
-ATL = xr.open_dataset('/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_ATL_rg.nc')
-ATL = ATL.ATL
-ATL_csize = tmask * ATL
+# Masks (loaded once per process on first use)
+cdomask_file = '/gpfs/home/mep22dku/scratch/SOZONE/windAnalyis/wspdComponents/PlankTOMmask_regridrecalc.nc'
+atl_file = '/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_ATL_rg.nc'
 
 # Define parameters
 ys = 2010
@@ -20,6 +32,19 @@ ye = 2019
 phy = ['DIA', 'MIX', 'COC', 'PIC', 'PHA', 'FIX']
 #'BAC', 'PRO', 'PTE', 'MES', 'GEL', 'MAC', 
 
+# Native-grid mode: bin ORCA2 cells by latitude and read the yearly run output
+# directly (no climatology, depth_integrate or regrid step), for any range of years
+native = False
+runs_dir = '/gpfs/data/greenocean/software/runs/'
+native_ys = 1940
+native_ye = 2024
+lat_edges = list(range(-90, 91, 2))  # Latitude band edges (degrees N)
+
+# Native-grid masks: csize, e3t_0 and T-point latitudes, and the Atlantic mask (native atl_file)
+mask_file = '/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_nicedims.nc'
+lat_var = 'gphit'
+native_atl_file = '/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_ATL.nc'
+
 # ===== FUNCTIONS =====
 
 def compute_latitudinal_profiles(dataset, phy, ATL_csize):
@@ -46,63 +71,177 @@ def compute_latitudinal_profiles(dataset, phy, ATL_csize):
     return lat_profiles
 
 
-def read_models_from_file(filepath):
+def build_atl_csize():
+    """Build the Atlantic mask with cell sizes from the regridded masks"""
+    tmask = xr.open_dataset(cdomask_file).tmask
+    ATL = xr.open_dataset(atl_file).ATL
+    return tmask * ATL
+
+
+def load_atl_csize():
+    """Atlantic mask with cell sizes, memory-mapped from the mesh cache"""
+    return cached_derived('tmask*ATL', [cdomask_file, atl_file], build_atl_csize)
+
+
+def build_native_atl_csize():
+    """Atlantic cell sizes on the native ORCA2 grid (csize * ATL, 0 outside)"""
+    csize = xr.open_dataset(mask_file).csize
+    ATL = xr.open_dataset(native_atl_file).ATL
+    return (csize * ATL.squeeze(drop=True).values).fillna(0)
+
+
+def load_lat_bins():
+    """
+    Latitude band and weight of every Atlantic cell of the native grid.
+    
+    Computed once per process: the bin of each cell comes from lat_var in
+    mask_file and its weight is its Atlantic cell size (memory-mapped from
+    the mesh cache). Cells outside lat_edges or the Atlantic are left out.
+    
+    Returns
+    -------
+    xr.Dataset
+        'bin' and 'weight' along 'cell' (with cell_y/cell_x grid positions),
+        and lat/lat_min/lat_max coords of the bands
     """
-    Read model names from a text file (one per line).
+    weight = cached_derived('csize*ATL native', [mask_file, native_atl_file], build_native_atl_csize).values
+    lat = cached_dataset(mask_file, [lat_var])[lat_var].squeeze(drop=True).values
+    edges = np.asarray(lat_edges, dtype=float)
+    
+    band = np.digitize(lat, edges) - 1
+    inside = (band >= 0) & (band < len(edges) - 1) & (np.nan_to_num(weight) > 0)
+    cell_y, cell_x = np.nonzero(inside)
+    
+    return xr.Dataset(
+        {'bin': ('cell', band[cell_y, cell_x]), 'weight': ('cell', weight[cell_y, cell_x])},
+        coords={
+            'cell_y': ('cell', cell_y), 'cell_x': ('cell', cell_x),
+            'lat': (edges[:-1] + edges[1:]) / 2,
+            'lat_min': ('lat', edges[:-1]), 'lat_max': ('lat', edges[1:]),
+        },
+    )
+
+
+def lat_binned_means(dataset, variables, bins, time_dim='time_counter'):
+    """
+    Weighted latitude-band means of 2D fields on the native grid.
+    
+    One sparse (band x cell) product per variable gives every band at every
+    time step. NaN cells are left out of both the weighted sum and the total
+    weight, as in .weighted().mean().
     
     Parameters
     ----------
-    filepath : str or Path
-        Path to text file containing model names
-        
+    dataset : xr.Dataset
+        Fields with dims (time_dim, y, x)
+    variables : list of str
+        Variables to bin
+    bins : xr.Dataset
+        Bins from load_lat_bins()
+    time_dim : str, optional
+        Name of the time dim
+    
     Returns
     -------
-    list of str
-        List of model names
+    xr.Dataset
+        Profiles with dims (time_dim, lat)
     """
-    models = []
-    try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if line and not line.startswith('#'):
-                    models.append(line)
-        print(f"Loaded {len(models)} models from {filepath}")
-        return models
-    except FileNotFoundError:
-        print(f"ERROR: Models file not found: {filepath}")
-        return []
-
+    n_cell = bins.sizes['cell']
+    matrix = scipy.sparse.csr_matrix(
+        (bins.weight.values, (bins.bin.values, np.arange(n_cell))), shape=(bins.sizes['lat'], n_cell)
+    )
+    cell_y, cell_x = bins.cell_y.values, bins.cell_x.values
+    
+    profiles = xr.Dataset(coords={time_dim: dataset[time_dim], **bins.lat.coords})
+    for var in variables:
+        data = dataset[var].transpose(time_dim, 'y', 'x').values[:, cell_y, cell_x]
+        valid = ~np.isnan(data)
+        weighted_sum = (matrix @ np.where(valid, data, 0).T).T
+        total_weight = (matrix @ valid.T.astype(float)).T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            profiles[var] = ((time_dim, 'lat'), (weighted_sum / total_weight).astype(data.dtype))
+    return profiles
 
-# ===== RUN =====
 
-# Read models from file
-mods = read_models_from_file(models_file)
+def native_year_unit(mod, year, filepath):
+    """Work unit for run_units: depth-integrated latitude-band profiles of one yearly file"""
+    bins = shared_resource('lat_bins', load_lat_bins)
+    tmesh = shared_resource('nicedims_e3t', cached_dataset, mask_file, ['e3t_0'])
+    with instrument.unit(model=mod, year=year), backend.open_dataset(filepath) as ds:
+        integrated = integrate_depth(ds, phy, tmesh)
+        with instrument.stage('compute'):
+            return lat_binned_means(integrated.compute(), list(integrated.data_vars), bins)
 
-if not mods:
-    print("No models to process. Exiting.")
-    exit(1)
 
-# Process each model
-for mod in mods:
-    print(f"\n{'='*60}")
-    print(f'Processing {mod}...')
-    print(f"{'='*60}")
+def compute_native_profiles(mod, n_workers=1):
+    """
+    Latitudinal Hovmoller of one model from its yearly files on the native grid.
+    
+    Every year from native_ys to native_ye found in runs_dir is a work unit;
+    the profiles are concatenated along time_counter and saved as
+    ORCA2_1m_<native_ys>_<native_ye>_ptrc_T_int_latbins.nc in bdir.
+    
+    Returns
+    -------
+    xr.Dataset or None
+        Profiles with dims (time_counter, lat), or None if no file was found
+    """
+    files = catalog.files_by_year(f'{runs_dir}{mod}', 'ptrc_T', years=range(native_ys, native_ye + 1))
+    if not files:
+        print(f"  Warning: no ptrc_T files for {mod} in {native_ys}-{native_ye}")
+        return None
     
-    try:
+    print(f'Processing {mod} ({len(files)} years on the native grid)...')
+    units = [(mod, year, str(path)) for year, path in files.items()]
+    if memory_budget.budget() is not None:
+        # As many concurrent years as fit the budget a time step at a time
+        unit_bytes = smallest_integration_bytes(units[0][2], phy)
+        n_workers = memory_budget.plan_workers('compute_latitudinal_profiles', unit_bytes, min(n_workers, len(units)))
+    results = [r for r in run_units(native_year_unit, units, n_workers, error_format='  ERROR processing {0} {1}: {e}',
+                                    resources={'lat_bins': shared_resource('lat_bins', load_lat_bins)}) if r is not None]
+    if not results:
+        return None
+    
+    lat_profiles = xr.concat(results, dim='time_counter')
+    lat_profiles.attrs['made_in'] = 'compute_latitudinal_profiles.py'
+    lat_profiles.attrs['source_model'] = mod
+    lat_profiles.attrs['source_years'] = f'{min(files)}-{max(files)}'
+    lat_profiles.attrs['weights'] = 'csize x ATL, native ORCA2 cells binned by latitude'
+    
+    output_dir = Path(bdir) / mod
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_file = output_dir / f'ORCA2_1m_{native_ys}_{native_ye}_ptrc_T_int_latbins.nc'
+    with instrument.stage('write'):
+        lat_profiles.to_netcdf(output_file, encoding=netcdf_encoding(lat_profiles))
+    print(f'  Saved: {output_file}')
+    return lat_profiles
+
+
+def latprof_unit(mod):
+    """Work unit for run_units: compute and save the latitudinal profiles of one model"""
+    with instrument.unit(model=mod):
+        ATL_csize = shared_resource('ATL_csize', load_atl_csize)
+        
         # Load regridded integrated data
         input_file = f'{bdir}{mod}/ORCA2_1m_clim_{ys}_{ye}_ptrc_T_int_rg.nc'
         
+        # Regrid straight from depth_integrate output if needed (see regrid_clim.py)
+        int_file = f'{bdir}{mod}/ORCA2_1m_clim_{ys}_{ye}_ptrc_T_int.nc'
+        if regrid_missing and not Path(input_file).exists() and Path(int_file).exists():
+            regrid_unit(int_file, input_file)
+        
         # Check if input file exists
         if not Path(input_file).exists():
             print(f"  Warning: Input file not found: {input_file}")
-            continue
+            return False
         
-        dataset = xr.open_dataset(input_file)
+        print(f'Processing {mod}...')
+        with instrument.stage('open'):
+            dataset = xr.open_dataset(input_file)
         
         # Compute latitudinal profiles
-        lat_profiles = compute_latitudinal_profiles(dataset, phy, ATL_csize)
+        with instrument.stage('compute'):
+            lat_profiles = compute_latitudinal_profiles(dataset, phy, ATL_csize).load()
         
         # Add metadata
         lat_profiles.attrs['made_in'] = 'compute_latitudinal_profiles.py'
@@ -111,12 +250,45 @@ for mod in mods:
         
         # Save output
         output_file = f'{bdir}{mod}/ORCA2_1m_clim_{ys}_{ye}_ptrc_T_int_rg_latprof.nc'
-        lat_profiles.to_netcdf(output_file)
+        with instrument.stage('write'):
+            lat_profiles.to_netcdf(output_file, encoding=netcdf_encoding(lat_profiles))
         print(f'  Saved: {output_file}')
-        
-    except Exception as e:
-        print(f"  ERROR processing {mod}: {e}")
+        return True
+
+
+# ===== RUN =====
+
+def main():
+    """Compute the latitudinal profiles of every model in models_file"""
+    # Read models from file
+    mods = read_models_from_file(models_file)
+
+    if not mods:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    if native:
+        # Yearly files straight from the runs; the units are the years of each model
+        for mod in mods:
+            try:
+                compute_native_profiles(mod, n_workers)
+            except Exception as e:
+                print(f'  ERROR processing {mod}: {e}')
+        instrument.print_summary()
+        return
+
+    # Run every model unit
+    print(f"Processing models: {', '.join(mods)} with {n_workers} worker(s)")
+
+    units = [(mod,) for mod in mods]
+    run_units(latprof_unit, units, n_workers, error_format='  ERROR processing {0}: {e}')
+
+    instrument.print_summary()
+
+    print(f"\n{'='*60}")
+    print('All models processed!')
+    print(f"{'='*60}")
+
 
-print(f"\n{'='*60}")
-print('All models processed!')
-print(f"{'='*60}")
+if __name__ == '__main__':
+    main()
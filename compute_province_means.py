@@ -1,9 +1,17 @@
-import numpy as np
 import xarray as xr
-import glob
 from pathlib import Path
 import pandas as pd
 
+import backend
+import catalog
+import ensemble
+import instrument
+from cli import read_models_from_file
+from executor import default_workers, run_units, shared_resource
+from output_encoding import netcdf_encoding
+from mesh_cache import cached_dataset, cached_derived
+from province_engine import build_province_weights, grouped_province_means, grouped_province_profiles
+
 
 # ===== INPUTS =====
 models_file = 'models.txt'  # Path to text file containing model names
@@ -11,191 +19,535 @@ model = 'TOM12_TJ_LA50'
 filetype = 'ptrc'  # or 'diad'
 variable = 'NO3'   # or 'PO4', 'Fer', 'Si', 'PPINT', 'Cflx', 'EXP', etc.
 depth = 0          # surface=0, or specific depth index, or None for 2D variables
+single_pass = True # read each yearly file once for all variables (also writes a consolidated file)
+ensemble_mode = False  # all models at once, stacked along a 'model' dim, one year at a time (see ensemble.py)
+n_workers = default_workers()  # Processes for yearly files; 1 runs serially
 
 # Paths
 baseDir = '/gpfs/data/greenocean/software/runs/'
+clims_dir = '/gpfs/data/greenocean/users/mep22dku/clims/'
+
+# Masks (memory-mapped from the mesh cache, loaded by load_province_weights())
+ma_file = '/gpfs/home/mep22dku/scratch/AMOC-PLANKTOM/AMOC-LoP-202510/data/mask_atl.nc'
+mask_file = '/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_nicedims.nc'
 
-# Load masks
-MA = xr.open_dataset('/gpfs/home/mep22dku/scratch/AMOC-PLANKTOM/AMOC-LoP-202510/data/mask_atl.nc')
-mask = xr.open_dataset('/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_nicedims.nc')
+# Optional integer label grid (e.g. Longhurst provinces) added on top of the masks
+province_labels_file = None  # NetCDF file with a (y, x) label variable
+province_labels_var = 'provinces'
+area_weighted = False  # False reproduces the unweighted cell means of the original masks
 
-# Define provinces
-provinces = {
-    'GO': mask.csize,
-    'AB': mask.csize * MA.AB,
-    'HA': mask.csize * MA.HA,
-    'NA': mask.csize * MA.NA
-}
+# Depth-resolved province means (province x deptht x time_counter), volume-weighted
+# (csize x e3t) and computed in the same read of each yearly file as the means above
+profile_vars = {'ptrc': []}  # e.g. {'ptrc': ['NO3', 'PO4', 'Fer', 'Si']}
+profile_bands = None  # None for every deptht level, or bands in m, e.g. [(0, 100), (100, 500), (500, 6000)]
 
 # ===== FUNCTION =====
-def compute_averages(model, filetype, variable, depth, provinces, baseDir):
+def load_province_weights(weighted=None):
+    """
+    Province x ocean-cell weights from the mask files in INPUTS.
+    
+    Provinces are the global ocean (GO) and the AB, HA and NA regions of
+    mask_atl.nc, plus the labels in province_labels_file if set. All
+    province means then come from one reduction per field.
+    
+    Parameters
+    ----------
+    weighted : bool, optional
+        Area (csize) weights; defaults to area_weighted
+    
+    Returns
+    -------
+    xr.DataArray
+        Weights from province_engine.build_province_weights()
+    """
+    mask = cached_dataset(mask_file, ['csize'])
+    
+    def region_csize(region):
+        """Cell sizes within one region of mask_atl.nc (mask.csize * MA.<region>), cached"""
+        return cached_derived(f'csize*{region}', [mask_file, ma_file],
+                              lambda: mask.csize * xr.open_dataset(ma_file)[region])
+    
+    provinces = {
+        'GO': mask.csize,
+        'AB': region_csize('AB'),
+        'HA': region_csize('HA'),
+        'NA': region_csize('NA')
+    }
+    
+    province_labels = None
+    if province_labels_file is not None:
+        province_labels = xr.open_dataset(province_labels_file)[province_labels_var]
+    
+    return build_province_weights(
+        masks=provinces, labels=province_labels, area=mask.csize, weighted=area_weighted if weighted is None else weighted
+    )
+
+
+def load_profile_weights():
+    """
+    Area weights of the provinces and the cell thickness, for depth profiles.
+    
+    Returns
+    -------
+    xr.Dataset
+        'weights' (province, cell) from load_province_weights(weighted=True)
+        and 'e3t' (deptht, y, x) from mask_file
+    """
+    e3t = cached_dataset(mask_file, ['e3t_0']).e3t_0
+    if 't' in e3t.dims:
+        e3t = e3t.isel(t=0, drop=True)
+    e3t = e3t.rename({'z': 'deptht'}) if 'z' in e3t.dims else e3t
+    return xr.Dataset({'weights': load_province_weights(weighted=True), 'e3t': e3t.reset_coords(drop=True)})
+
+
+def find_model_files(model, filetype, baseDir):
+    """
+    Find yearly output files for a model and extract their years.
+    
+    Parameters
+    ----------
+    model : str
+        Model name
+    filetype : str
+        File type ('ptrc' or 'diad')
+    baseDir : str
+        Base directory containing model runs
+        
+    Returns
+    -------
+    tuple of (list of str, list of int)
+        Sorted file paths and the years parsed from their names
+    """
+    # Files ORCA2_1m_YYYYMMDD_YYYYMMDD_{filetype}_{letter}.nc, indexed once per
+    # run directory with their years already parsed (see catalog.py)
+    entries = [e for e in catalog.matching_entries(Path(baseDir) / model, filetype) if e['grid']]
+    files = [str(Path(baseDir) / model / e['name']) for e in entries]
+    years = [e['year'] for e in entries]
+    
+    return files, years
+
+
+def select_variable(ds, variable, depth):
+    """
+    Select a variable (at a depth index if it has one) from an open dataset.
+    
+    depth='profile' keeps every level, for province profiles. Returns None
+    if the variable is not in the dataset (or has no depth for a profile).
+    """
+    if depth == 'profile':
+        if variable in ds and 'deptht' in ds[variable].dims:
+            return ds[variable]
+        return None
+    # Handle EXP100 special case
+    if variable == 'EXP100' and 'EXP' in ds:
+        return (ds['EXP'].isel(deptht=9) + ds['EXP'].isel(deptht=10)) / 2
+    if variable not in ds:
+        return None
+    var_data = ds[variable]
+    # Apply depth selection only if variable has depth dimension
+    if 'deptht' in var_data.dims:
+        if depth is not None:
+            var_data = var_data.isel(deptht=depth)
+    # If no depth dimension, depth parameter is ignored
+    return var_data
+
+
+def province_means(var_data, provinces):
+    """
+    Compute the mean of var_data over each province, stacked along 'province'.
+    
+    provinces is either a dict of province masks or a weight matrix from
+    province_engine.build_province_weights(); a dict is converted on the fly.
+    """
+    if isinstance(provinces, dict):
+        provinces = build_province_weights(masks=provinces, weighted=False)
+    return grouped_province_means(var_data, provinces)
+
+
+def to_datetime_index(combined):
+    """Convert the cftime time_counter of a result to pandas datetime"""
+    time_pd = pd.to_datetime([pd.Timestamp(t.isoformat()) for t in combined.time_counter.values])
+    return combined.assign_coords(time_counter=time_pd)
+
+
+def file_province_means(filepath, year, specs):
+    """
+    Work unit for run_units: province means of all (variable, depth) specs in one file.
+    
+    Uses the 'province_weights' shared resource installed by collect_province_means(),
+    and 'profile_weights' for (variable, 'profile') specs. Returns a dict of
+    (variable, depth) -> province means; missing variables are left out.
+    """
+    # Print progress every 5 years
+    if year and year % 5 == 0:
+        print(f"  Processing year {year}...", flush=True)
+    
+    with instrument.unit(file=Path(filepath).name, year=year), backend.open_dataset(filepath) as ds:
+        return dataset_province_means(ds, specs)
+
+
+def ensemble_file_means(paths, models, year, specs):
+    """
+    Work unit for run_units: province means of one year of every model at once.
+    
+    The models' files are stacked along 'model' (see ensemble.py), so each
+    spec is one reduction for the whole ensemble. Returns a dict of
+    (variable, depth) -> province means with a 'model' dim.
+    """
+    if year and year % 5 == 0:
+        print(f"  Processing year {year}...", flush=True)
+    
+    variables = spec_variables(specs)
+    with instrument.unit(model=ensemble.ensemble_name, year=year), ensemble.open_ensemble(paths, models, variables) as ds:
+        return dataset_province_means(ds, specs)
+
+
+def spec_variables(specs):
+    """Variables of the files that the (variable, depth) specs read (EXP100 is computed from EXP)"""
+    names = []
+    for variable, _ in specs:
+        for name in (['EXP'] if variable == 'EXP100' else []) + [variable]:
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def dataset_province_means(ds, specs):
+    """Province means (or profiles) of all (variable, depth) specs in an open dataset, with the shared weights"""
+    provinces = shared_resource('province_weights')
+    results = {}
+    for variable, depth in specs:
+        var_data = select_variable(ds, variable, depth)
+        if var_data is None:
+            continue
+        with instrument.stage('compute'):
+            if depth == 'profile':
+                profile = shared_resource('profile_weights')
+                means = grouped_province_profiles(var_data, profile.weights, profile.e3t, profile_bands)
+            else:
+                means = province_means(var_data, provinces)
+            results[(variable, depth)] = means.load()
+    return results
+
+
+def collect_province_means(files, years, specs, provinces, n_workers=1):
+    """Run file_province_means over every yearly file, returning spec -> list of yearly results"""
+    units = [(filepath, years[i] if i < len(years) else None, specs) for i, filepath in enumerate(files)]
+    file_results = run_units(file_province_means, units, n_workers,
+                             error_format='Error processing {0}: {e}',
+                             resources=province_resources(provinces, specs))
+    return gather_results(file_results, specs)
+
+
+def province_resources(provinces, specs):
+    """Shared resources of the work units: the province weights, and the profile weights if needed"""
+    resources = {'province_weights': provinces}
+    if any(depth == 'profile' for _, depth in specs):
+        resources['profile_weights'] = shared_resource('province_profile_weights', load_profile_weights)
+    return resources
+
+
+def gather_results(file_results, specs):
+    """Spec -> list of yearly results, from the per-file dicts of the work units"""
+    all_results = {spec: [] for spec in specs}
+    for file_result in file_results:
+        if file_result is None:
+            continue
+        for spec, result in file_result.items():
+            all_results[spec].append(result)
+    return all_results
+
+
+def save_province_means(all_results, model, filetype, variable, depth, output_dir):
+    """Concatenate yearly province means and save the per-variable file"""
+    combined = xr.concat(all_results, dim='time_counter')
+    combined = to_datetime_index(combined)
+    
+    combined.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/compute_province_means.py'
+    if depth == 'profile':
+        combined.attrs['weights'] = 'csize x e3t'
+        output_file = output_dir / f"{model}_{filetype}_{variable}_profile_provinces.nc"
+    else:
+        output_file = output_dir / f"{model}_{filetype}_{variable}_d{depth}_provinces.nc"
+    with instrument.stage('write'):
+        combined.to_netcdf(output_file, encoding=netcdf_encoding(combined))
+    print(f"Saved to {output_file}")
+    return combined
+
+
+def compute_averages(model, filetype, variable, depth, provinces, baseDir, n_workers=1):
     """Compute province averages for a variable across all available years"""
     
     # Create model-specific output directory
-    output_dir = Path(f'/gpfs/data/greenocean/users/mep22dku/clims/{model}/')
+    output_dir = Path(clims_dir) / model
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Find all files with specific pattern: ORCA2_1m_YYYYMMDD_YYYYMMDD_{filetype}_{letter}.nc
-    pattern = f'{baseDir}/{model}/ORCA2_1m_????????_????????_{filetype}_?.nc'
-    files = sorted(glob.glob(pattern))
+    if isinstance(provinces, dict):
+        provinces = build_province_weights(masks=provinces, weighted=False)
+    
+    files, years = find_model_files(model, filetype, baseDir)
     if not files:
         print(f"No files found for {model}, {filetype}")
         return None
     
-    # Extract years using regex to find 4-digit year in filename
-    import re
-    years = []
-    for f in files:
-        match = re.search(r'_(\d{4})', f)
-        if match:
-            years.append(int(match.group(1)))
-    
     if not years:
-        print(f"Could not extract years from filenames")
+        print("Could not extract years from filenames")
         return None
     
     yrst, yrend = min(years), max(years)
     print(f"Processing {model} - {filetype} - {variable}")
     print(f"Found {len(files)} files from {yrst} to {yrend}")
     
-    all_results = []
+    all_results = collect_province_means(files, years, [(variable, depth)], provinces, n_workers)[(variable, depth)]
     
-    for i, filepath in enumerate(files):
-        year = years[i] if i < len(years) else None
-        
-        # Print progress every 5 years
-        if year and year % 5 == 0:
-            print(f"  Processing year {year}...")
+    # Concatenate and save
+    if all_results:
+        return save_province_means(all_results, model, filetype, variable, depth, output_dir)
+    
+    return None
+
+
+def compute_averages_multi(model, var_specs, provinces, baseDir, n_workers=1):
+    """
+    Compute province averages for many variables, reading each yearly file once.
+    
+    Every file is opened a single time and all requested (variable, depth)
+    pairs for its file type are pulled from it. The per-variable output files
+    written by compute_averages() are still produced, plus one consolidated
+    per-model file with a 'variable' dimension.
+    
+    Parameters
+    ----------
+    model : str
+        Model name
+    var_specs : dict
+        Mapping of file type to list of (variable, depth) pairs,
+        e.g. {'ptrc': [('NO3', 0)], 'diad': [('Cflx', None)]}; depth 'profile'
+        gives depth-resolved means (saved per variable, not consolidated)
+    provinces : dict or xr.DataArray
+        Mapping of province name to cell-size mask, or precomputed
+        weights from province_engine.build_province_weights()
+    baseDir : str
+        Base directory containing model runs
+    n_workers : int, optional
+        Processes used to read yearly files concurrently
         
-        try:
-            with xr.open_dataset(filepath) as ds:
-                # Handle EXP100 special case
-                if variable == 'EXP100' and 'EXP' in ds:
-                    var_data = (ds['EXP'].isel(deptht=9) + ds['EXP'].isel(deptht=10)) / 2
-                elif variable in ds:
-                    var_data = ds[variable]
-                    # Apply depth selection only if variable has depth dimension
-                    if 'deptht' in var_data.dims:
-                        if depth is not None:
-                            var_data = var_data.isel(deptht=depth)
-                    # If no depth dimension, depth parameter is ignored
-                else:
-                    continue
-                
-                # Compute province means
-                province_means = []
-                province_names = []
-                
-                for prov_name, prov_mask in provinces.items():
-                    masked_data = var_data.where(prov_mask > 0)
-                    spatial_dims = [d for d in masked_data.dims if d not in ['time_counter', 'time']]
-                    prov_mean = masked_data.mean(dim=spatial_dims)
-                    province_means.append(prov_mean)
-                    province_names.append(prov_name)
-                
-                # Stack into dataset
-                stacked = xr.concat(province_means, dim='province')
-                stacked['province'] = province_names
-                all_results.append(stacked)
+    Returns
+    -------
+    xr.DataArray or None
+        Province means with dims (variable, province, time_counter)
+    """
+    
+    # Create model-specific output directory
+    output_dir = Path(clims_dir) / model
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    if isinstance(provinces, dict):
+        provinces = build_province_weights(masks=provinces, weighted=False)
+    
+    consolidated = []
+    
+    for filetype, specs in var_specs.items():
+        files, years = find_model_files(model, filetype, baseDir)
+        if not files:
+            print(f"No files found for {model}, {filetype}")
+            continue
         
-        except Exception as e:
-            print(f"Error processing {filepath}: {e}")
+        if not years:
+            print("Could not extract years from filenames")
             continue
-    
-    # Concatenate and save
-    if all_results:
-        combined = xr.concat(all_results, dim='time_counter')
         
-        # Convert cftime to pandas datetime
-        time_pd = pd.to_datetime([pd.Timestamp(t.isoformat()) for t in combined.time_counter.values])
-        combined = combined.assign_coords(time_counter=time_pd)
+        yrst, yrend = min(years), max(years)
+        print(f"Processing {model} - {filetype} - {', '.join(v for v, _ in specs)}")
+        print(f"Found {len(files)} files from {yrst} to {yrend}")
         
-        combined.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/compute_province_means.py'
-        output_file = output_dir / f"{model}_{filetype}_{variable}_d{depth}_provinces.nc"
-        combined.to_netcdf(output_file)
-        print(f"Saved to {output_file}")
-        return combined
+        all_results = collect_province_means(files, years, specs, provinces, n_workers)
+        
+        # Save per-variable files and collect them for the consolidated output
+        for (variable, depth), results in all_results.items():
+            if not results:
+                print(f"No data found for {model} - {filetype} - {variable}")
+                continue
+            combined = save_province_means(results, model, filetype, variable, depth, output_dir)
+            if depth == 'profile':
+                continue
+            combined = combined.reset_coords(drop=True)
+            combined = combined.expand_dims(variable=[variable])
+            combined = combined.assign_coords(
+                depth_index=('variable', [-1 if depth is None else depth]),
+                filetype=('variable', [filetype]),
+            )
+            consolidated.append(combined.rename(None))
     
-    return None
+    if not consolidated:
+        return None
+    
+    combined = xr.concat(consolidated, dim='variable')
+    combined.name = 'province_mean'
+    combined.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/compute_province_means.py'
+    combined.attrs['depth_index_note'] = 'deptht index used per variable, -1 = 2D variable or EXP100'
+    output_file = output_dir / f"{model}_provinces.nc"
+    with instrument.stage('write'):
+        combined.to_netcdf(output_file, encoding=netcdf_encoding(combined))
+    print(f"Saved to {output_file}")
+    return combined
 
 
-def read_models_from_file(filepath):
+def compute_ensemble_averages(models, var_specs, provinces, baseDir, n_workers=1):
     """
-    Read model names from a text file (one per line).
+    Province averages of every model at once, one work unit per year.
+    
+    Each year's files of all models are stacked along 'model' and reduced
+    together, for the years every model has. Each model's per-variable
+    files are written as by compute_averages(), plus one file per variable
+    with the 'model' dim under clims_dir/ENSEMBLE/.
     
     Parameters
     ----------
-    filepath : str or Path
-        Path to text file containing model names
-        
+    models : list of str
+        Model names (same grid and file layout)
+    var_specs : dict
+        Mapping of file type to list of (variable, depth) pairs (see compute_averages_multi)
+    provinces : xr.DataArray
+        Weights from province_engine.build_province_weights()
+    baseDir : str
+        Base directory containing model runs
+    n_workers : int, optional
+        Processes used to read years concurrently
+    
     Returns
     -------
-    list of str
-        List of model names
-    """
-    models = []
-    try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if line and not line.startswith('#'):
-                    models.append(line)
-        print(f"Loaded {len(models)} models from {filepath}")
-        return models
-    except FileNotFoundError:
-        print(f"ERROR: Models file not found: {filepath}")
-        return []
+    dict
+        (filetype, variable, depth) -> province means with a 'model' dim
+    """
+    ensemble_means = {}
+    for filetype, specs in var_specs.items():
+        files = ensemble.ensemble_files({m: Path(baseDir) / m for m in models}, filetype)
+        if not files:
+            print(f"No years with {filetype} files for every model")
+            continue
+        
+        years = list(files)
+        print(f"Processing {len(models)} models - {filetype} - {', '.join(str(v) for v, _ in specs)}")
+        print(f"Found {len(years)} common years from {years[0]} to {years[-1]}")
+        
+        units = [(paths, models, year, specs) for year, paths in files.items()]
+        year_results = run_units(ensemble_file_means, units, n_workers,
+                                 error_format='Error processing {2}: {e}',
+                                 resources=province_resources(provinces, specs))
+        
+        for (variable, depth), results in gather_results(year_results, specs).items():
+            if not results:
+                print(f"No data found for {filetype} - {variable}")
+                continue
+            for model in models:
+                output_dir = Path(clims_dir) / model
+                output_dir.mkdir(parents=True, exist_ok=True)
+                save_province_means([r.sel(model=model, drop=True) for r in results],
+                                    model, filetype, variable, depth, output_dir)
+            combined = save_province_means([r.transpose('model', ...) for r in results], ensemble.ensemble_name,
+                                           filetype, variable, depth, ensemble.ensemble_dir(clims_dir))
+            ensemble_means[(filetype, variable, depth)] = combined
+    return ensemble_means
 
 
 # ===== RUN =====
 
-# Read models from file
-models = read_models_from_file(models_file)
-
-if not models:
-    print("No models to process. Exiting.")
-    exit(1)
-
-# Define variables to extract
-ptrc_vars = [
-    ('Fer', 0),
-    ('Si', 0),
-   ('NO3', 0),
-   ('PO4', 0),
-   ('DIC', 0),
-   ('Alkalini', 0)
-]
-
-diad_vars = [
-    ('TChl', 0),
-    ('Cflx', None),
-    ('PPINT', None),
-    ('EXP100', None)
-]
-
-# Loop over models and variables
-for model in models:
-    print(f"\n{'='*60}")
-    print(f"Processing model: {model}")
-    print(f"{'='*60}")
+def main():
+    """Compute the province means of every model in models_file"""
+    # Read models from file
+    models = read_models_from_file(models_file)
 
-    # Process ptrc variables
-    for variable, depth in ptrc_vars:
-        try:
-            print(f"\n--- {variable} at depth {depth} ---")
-            result = compute_averages(model, 'ptrc', variable, depth, provinces, baseDir)
-        except Exception as e:
-            print(f"ERROR processing {model} - ptrc - {variable}: {e}")
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    # With the dask backend, start the local cluster; units then run in this process
+    client = backend.start_cluster()
+    workers = backend.unit_workers(n_workers)
+
+    # Province x ocean-cell weights, built once per process
+    province_weights = shared_resource('province_mask_weights', load_province_weights)
+
+    # Define variables to extract
+    ptrc_vars = [
+        ('Fer', 0),
+        ('Si', 0),
+       ('NO3', 0),
+       ('PO4', 0),
+       ('DIC', 0),
+       ('Alkalini', 0)
+    ]
+
+    diad_vars = [
+        ('TChl', 0),
+        ('Cflx', None),
+        ('PPINT', None),
+        ('EXP100', None)
+    ]
 
-    # Process diad variables
-    for variable, depth in diad_vars:
+    # Profiles are read in the same pass as the surface means of their file type
+    profiles = {ft: [(v, 'profile') for v in names] for ft, names in profile_vars.items()}
+
+    if ensemble_mode:
+        # All models together, one unit per year
+        var_specs = {'ptrc': ptrc_vars, 'diad': diad_vars}
+        for ft, specs in profiles.items():
+            var_specs[ft] = var_specs.get(ft, []) + specs
         try:
-            print(f"\n--- {variable} at depth {depth} ---")
-            result = compute_averages(model, 'diad', variable, depth, provinces, baseDir)
+            compute_ensemble_averages(models, var_specs, province_weights, baseDir, workers)
         except Exception as e:
-            print(f"ERROR processing {model} - diad - {variable}: {e}")
+            print(f"ERROR processing the ensemble: {e}")
+        instrument.print_summary()
+        return
+
+    # Loop over models and variables
+    for model in models:
+        print(f"\n{'='*60}")
+        print(f"Processing model: {model}")
+        print(f"{'='*60}")
+
+        if single_pass:
+            var_specs = {'ptrc': ptrc_vars, 'diad': diad_vars}
+            for ft, specs in profiles.items():
+                var_specs[ft] = var_specs.get(ft, []) + specs
+            try:
+                compute_averages_multi(model, var_specs, province_weights, baseDir, workers)
+            except Exception as e:
+                print(f"ERROR processing {model}: {e}")
+            continue
+
+        # Process ptrc variables
+        for variable, depth in ptrc_vars:
+            try:
+                print(f"\n--- {variable} at depth {depth} ---")
+                compute_averages(model, 'ptrc', variable, depth, province_weights, baseDir, workers)
+            except Exception as e:
+                print(f"ERROR processing {model} - ptrc - {variable}: {e}")
+
+        # Process diad variables
+        for variable, depth in diad_vars:
+            try:
+                print(f"\n--- {variable} at depth {depth} ---")
+                compute_averages(model, 'diad', variable, depth, province_weights, baseDir, workers)
+            except Exception as e:
+                print(f"ERROR processing {model} - diad - {variable}: {e}")
+
+        # Process depth profiles
+        for ft, specs in profiles.items():
+            for variable, depth in specs:
+                try:
+                    print(f"\n--- {variable} profile ---")
+                    compute_averages(model, ft, variable, depth, province_weights, baseDir, workers)
+                except Exception as e:
+                    print(f"ERROR processing {model} - {ft} - {variable} profile: {e}")
+
+    instrument.print_summary()
+
+    print(f"\n{'='*60}")
+    print("All processing complete!")
+    print(f"{'='*60}")
+
 
-print(f"\n{'='*60}")
-print("All processing complete!")
-print(f"{'='*60}")
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,22 @@ import xarray as xr
 import numpy as np
 from pathlib import Path
 
+import backend
+import ensemble
+import instrument
+import memory_budget
+from cli import read_models_from_file
+from executor import default_workers, run_units, shared_resource
+from limiters import compute_limiters, limiter_inputs, smallest_limiter_bytes
+from mesh_cache import cached_dataset
+from zarr_store import store_path, write_year
+
 # ===== INPUTS =====
 
 models_file = 'models.txt'  # Path to text file containing model names
 base_dir = '/gpfs/data/greenocean/software/runs/'
+mesh_file = '/gpfs/data/greenocean/software/resources/regrid/mesh_mask3_6.nc'
+n_workers = default_workers()  # Processes for (model, year) units; 1 runs serially
 
 # Year range
 year_start = 1953
@@ -16,12 +28,69 @@ pfts = ['DIA', 'MIX', 'COC', 'PIC', 'PHA', 'FIX']
 
 # Depth levels to average over (in meters)
 depth_levels = [10, 100]
+partial_cells = False  # True: count the cell containing each cutoff by its part above it
+
+# Compute LV in memory from limphy instead of reading the LoP file from extract-LoP.py
+fused = False
+write_lop = False  # with fused, also write the full LoP_T file
+
+# Process every model of models_file together, one year at a time, stacked along a
+# 'model' dim (see ensemble.py); also writes ENSEMBLE/ files with that dim
+ensemble_mode = False
+
+# 'netcdf' (yearly LNL_T files), 'zarr' (one ORCA2_1m_LNL_T.zarr store per model, see zarr_store.py) or 'both'
+output_format = 'netcdf'
 
 # ===== FUNCTIONS =====
 
-def average_top_meters(dataset, var_list, depth_meters, tmesh):
+def depth_level_weights(depths, e3t, depth_levels, partial_cells=False):
     """
-    Average variables over the top x meters.
+    Static thickness weights of every level for every depth cutoff.
+    
+    Parameters
+    ----------
+    depths : np.ndarray
+        Depth of each level (cell centres, m)
+    e3t : np.ndarray
+        Cell thickness (depth, y, x)
+    depth_levels : list of int or float
+        Depth cutoffs in meters
+    partial_cells : bool, optional
+        If False (default), a level counts fully when its centre depth is
+        <= the cutoff, as before. If True, each cell counts by the part of
+        its thickness above the cutoff, so the average covers exactly the
+        top depth_meters of the water column.
+        
+    Returns
+    -------
+    np.ndarray
+        Weights with shape (cutoff, depth, y, x)
+    """
+    weights = np.zeros((len(depth_levels),) + e3t.shape)
+    if partial_cells:
+        # Depth of the top of each cell, per column
+        z_top = np.cumsum(e3t, axis=0) - e3t
+    
+    for i, depth_meters in enumerate(depth_levels):
+        if not (depths <= depth_meters).any():
+            raise ValueError(f"No depths found <= {depth_meters} meters")
+        if partial_cells:
+            weights[i] = np.clip(depth_meters - z_top, 0, e3t)
+        else:
+            weights[i] = np.where((depths <= depth_meters)[:, np.newaxis, np.newaxis], e3t, 0)
+    
+    return weights
+
+
+def average_depth_levels(dataset, var_list, depth_levels, tmesh, partial_cells=False):
+    """
+    Average variables over the top x meters for several x in one pass.
+    
+    Each variable is accumulated level by level down the water column with
+    static per-cutoff thickness weights, so every cutoff comes from the same
+    single read of the variable and e3t is never broadcast over time. As
+    before, NaN values add nothing to the weighted sum but their thickness
+    still counts in the total.
     
     Parameters
     ----------
@@ -29,15 +98,18 @@ def average_top_meters(dataset, var_list, depth_meters, tmesh):
         Input dataset with 4D variables (time, depth, y, x)
     var_list : list of str
         Names of variables to average
-    depth_meters : int or float
-        Depth in meters over which to average (e.g., 100 for top 100m)
+    depth_levels : list of int or float
+        Depths in meters over which to average (e.g., [10, 100])
     tmesh : xr.Dataset
         Meshmask dataset containing depth info and cell thickness
+    partial_cells : bool, optional
+        Weight the cell containing each cutoff by the part of it above the
+        cutoff (see depth_level_weights)
         
     Returns
     -------
     xr.Dataset
-        Dataset with averaged variables
+        Dataset with {var}_avg_{depth}m variables, ordered by depth then variable
     """
     # Get depth dimension name
     depth_dim = 'deptht'
@@ -45,7 +117,7 @@ def average_top_meters(dataset, var_list, depth_meters, tmesh):
     
     # Get depth coordinates and cell thickness
     depths = dataset[depth_dim].values
-    e3t = tmesh['e3t_0'].copy()
+    e3t = tmesh['e3t_0']
     
     # Rename tmesh dimensions to match dataset dimensions
     dim_mapping = {}
@@ -57,49 +129,143 @@ def average_top_meters(dataset, var_list, depth_meters, tmesh):
     if dim_mapping:
         e3t = e3t.rename(dim_mapping)
     
-    # Handle time dimension: squeeze if singleton, then broadcast if needed
+    # Squeeze a singleton time dimension; e3t stays static (depth, y, x)
     if time_dim in e3t.dims and e3t.sizes[time_dim] == 1:
         e3t = e3t.squeeze(time_dim, drop=True)
     
-    # If e3t doesn't have the dataset's time dimension, add it
-    if time_dim not in e3t.dims and time_dim in dataset.dims:
-        e3t = e3t.expand_dims({time_dim: dataset[time_dim]})
-    
-    # Find indices where depth <= depth_meters
-    depth_mask = depths <= depth_meters
-    depth_indices = [i for i, mask in enumerate(depth_mask) if mask]
+    weights = depth_level_weights(depths, np.asarray(e3t.transpose(depth_dim, ...).values), depth_levels, partial_cells)
+    total_thickness = weights.sum(axis=1)
+    levels = np.nonzero(weights.any(axis=(0, 2, 3)))[0]
     
-    if not depth_indices:
-        raise ValueError(f"No depths found <= {depth_meters} meters")
-    
-    # Create output dataset
-    output_ds = xr.Dataset()
-    
-    # Average each variable over the selected depth range
+    averaged = {depth_meters: {} for depth_meters in depth_levels}
     for var in var_list:
         if var not in dataset.data_vars:
             print(f"Warning: variable {var} not found in dataset")
             continue
         
-        # Select data within the depth range
-        var_subset = dataset[var].isel({depth_dim: depth_indices})
-        e3t_subset = e3t.isel({depth_dim: depth_indices})
+        data = dataset[var].transpose(time_dim, depth_dim, ...)
         
-        # Broadcast e3t to match variable dimensions
-        e3t_broadcasted = xr.broadcast(var_subset, e3t_subset)[1]
+        if data.chunks:
+            # Dask backend: the same weighted sums, built lazily chunk by chunk
+            level_weights = xr.DataArray(weights[:, levels], dims=('cutoff', depth_dim) + data.dims[-2:])
+            weighted_sum = (data.isel({depth_dim: levels}).fillna(0) * level_weights).sum(depth_dim)
+            weighted_sum = weighted_sum.transpose('cutoff', time_dim, ...).data
+        else:
+            # Single pass down the column, accumulating every cutoff at once
+            weighted_sum = None
+            for k in levels:
+                with instrument.stage('load'):
+                    level = data.isel({depth_dim: k}).values
+                with instrument.stage('compute'):
+                    level = np.where(np.isnan(level), 0, level)
+                    # (cutoff, y, x) weights against (time, [model,] y, x) levels
+                    level_weights = weights[:, k].reshape((len(depth_levels),) + (1,) * (level.ndim - 2) + level.shape[-2:])
+                    contribution = level[np.newaxis] * level_weights
+                    weighted_sum = contribution if weighted_sum is None else weighted_sum + contribution
         
-        # Depth-weighted average
-        weighted_sum = (var_subset * e3t_broadcasted).sum(dim=depth_dim)
-        total_thickness = e3t_broadcasted.sum(dim=depth_dim)
-        averaged = weighted_sum / total_thickness
+        coords = {c: v for c, v in data.coords.items() if depth_dim not in v.dims}
+        dims = (time_dim,) + data.dims[2:]
+        for i, depth_meters in enumerate(depth_levels):
+            averaged[depth_meters][var] = xr.DataArray(
+                weighted_sum[i] / total_thickness[i], dims=dims, coords=coords
+            ).transpose(*[d for d in dataset[var].dims if d != depth_dim])
+    
+    # Create output dataset with suffix
+    output_ds = xr.Dataset()
+    for depth_meters in depth_levels:
+        for var, values in averaged[depth_meters].items():
+            output_ds[f'{var}_avg_{int(depth_meters)}m'] = values
+    
+    return output_ds
+
+
+def average_top_meters(dataset, var_list, depth_meters, tmesh, partial_cells=False):
+    """
+    Average variables over the top x meters.
+    
+    Parameters
+    ----------
+    dataset : xr.Dataset
+        Input dataset with 4D variables (time, depth, y, x)
+    var_list : list of str
+        Names of variables to average
+    depth_meters : int or float
+        Depth in meters over which to average (e.g., 100 for top 100m)
+    tmesh : xr.Dataset
+        Meshmask dataset containing depth info and cell thickness
+    partial_cells : bool, optional
+        Weight the cell containing the cutoff by the part of it above it
         
-        # Add to output dataset with suffix
-        output_ds[f'{var}_avg_{int(depth_meters)}m'] = averaged
+    Returns
+    -------
+    xr.Dataset
+        Dataset with averaged variables
+    """
+    return average_depth_levels(dataset, var_list, [depth_meters], tmesh, partial_cells)
+
+
+def lnl_dataset(limphy_ds, lop_ds, pfts, depth_levels, tmesh, partial_cells=False):
+    """
+    NUT_* and LIGHT_* top-layer averages from open limphy and LoP datasets.
+    
+    Works the same on one model's files and on an ensemble stacked along
+    'model' (see ensemble.py).
     
+    Returns
+    -------
+    xr.Dataset
+        {NUT,LIGHT}_{pft}_{depth}m variables, grouped by depth level
+    """
+    # Build variable lists
+    lv_vars = [f'LV_{pft}' for pft in pfts]  # Nutrient limitation (LV not LN)
+    light_vars = [f'lim8light_{pft.lower()}' for pft in pfts]  # Light limitation
+    
+    # Average all depth levels in one pass per variable
+    lv_averaged = average_depth_levels(lop_ds, lv_vars, depth_levels, tmesh, partial_cells)
+    light_averaged = average_depth_levels(limphy_ds, light_vars, depth_levels, tmesh, partial_cells)
+    
+    # Rename variables to NUT_* and LIGHT_* format, grouped by depth level
+    output_ds = xr.Dataset()
+    for depth in depth_levels:
+        for pft in pfts:
+            # Rename nutrient limitation: LV_DIA_avg_10m -> NUT_DIA_10m
+            old_lv_name = f'LV_{pft}_avg_{depth}m'
+            if old_lv_name in lv_averaged:
+                output_ds[f'NUT_{pft}_{depth}m'] = lv_averaged[old_lv_name]
+        for pft in pfts:
+            # Rename light limitation: lim8light_dia_avg_10m -> LIGHT_DIA_10m
+            old_light_name = f'lim8light_{pft.lower()}_avg_{depth}m'
+            if old_light_name in light_averaged:
+                output_ds[f'LIGHT_{pft}_{depth}m'] = light_averaged[old_light_name]
     return output_ds
 
 
-def process_year(model, year, pfts, depth_levels, base_dir, tmesh):
+def lnl_attrs(model, year, limphy_name, lop_name, fused, depth_levels):
+    """Global attributes of an LNL_T file"""
+    depth_text = ' and '.join(f'{depth}m' for depth in depth_levels)
+    return {
+        'made_in': '/gpfs/home/mep22dku/scratch/EXTRACT/create_LNL_files.py',
+        'source_files': f'{limphy_name} (LV computed in memory)' if fused else f'{lop_name}, {limphy_name}',
+        'source_model': model,
+        'year': year,
+        'description': f'Top {depth_text} averages of nutrient limitation (LV->NUT) and light limitation (LIGHT) variables',
+        'variable_naming': 'NUT_* = nutrient limitation (from LV), LIGHT_* = light limitation (from lim8light)',
+    }
+
+
+def save_lnl(output_ds, model, year, output_file, base_dir, output_format='netcdf', years=None):
+    """Write one model-year of LNL output as a yearly file and/or a region of the model's store"""
+    if output_format in ('netcdf', 'both'):
+        backend.write_netcdf(output_ds, output_file)
+        print(f"  Saved: {output_file.name}")
+    if output_format in ('zarr', 'both'):
+        store = store_path(base_dir, model, 'LNL_T')
+        write_year(output_ds, store, year, years)
+        print(f"  Saved: {year} -> {store.name}")
+
+
+def process_year(model, year, pfts, depth_levels, base_dir, tmesh, fused=False, write_lop=False, partial_cells=False,
+                 output_format='netcdf', years=None, overwrite=False):
     """
     Process a single year for a model.
     
@@ -117,6 +283,21 @@ def process_year(model, year, pfts, depth_levels, base_dir, tmesh):
         Base directory containing model runs
     tmesh : xr.Dataset
         Meshmask dataset
+    fused : bool, optional
+        If True, compute the LV fields from the limphy file in memory
+        instead of reading the LoP file, so limphy is the only input
+    write_lop : bool, optional
+        With fused, also write the LoP file extract-LoP.py would have written
+    partial_cells : bool, optional
+        Weight the cell containing each depth cutoff by the part of it above
+        the cutoff instead of including whole levels by their centre depth
+    output_format : str, optional
+        'netcdf' (yearly file), 'zarr' (region of the model's store) or 'both'
+    years : list of int, optional
+        All years of the model's store; required for 'zarr' and 'both'
+    overwrite : bool, optional
+        Rebuild the yearly file even if it exists; it is replaced only once
+        the new one has been written
         
     Returns
     -------
@@ -131,7 +312,7 @@ def process_year(model, year, pfts, depth_levels, base_dir, tmesh):
     output_file = model_dir / f'ORCA2_1m_{year}0101_{year}1231_LNL_T.nc'
     
     # Check if input files exist
-    if not lop_file.exists():
+    if not fused and not lop_file.exists():
         print(f"  Warning: LoP file not found: {lop_file}")
         return False
     
@@ -139,8 +320,8 @@ def process_year(model, year, pfts, depth_levels, base_dir, tmesh):
         print(f"  Warning: limphy file not found: {limphy_file}")
         return False
     
-    # Check if output already exists
-    if output_file.exists():
+    # Check if output already exists (a store region is simply rewritten)
+    if output_format == 'netcdf' and output_file.exists() and not overwrite:
         print(f"  Skipping {year} (output already exists)")
         return True
     
@@ -148,52 +329,23 @@ def process_year(model, year, pfts, depth_levels, base_dir, tmesh):
         print(f"  Processing {year}...")
         
         # Open datasets
-        lop_ds = xr.open_dataset(lop_file)
-        limphy_ds = xr.open_dataset(limphy_file)
-        
-        # Build variable lists
-        lv_vars = [f'LV_{pft}' for pft in pfts]  # Nutrient limitation (LV not LN)
-        light_vars = [f'lim8light_{pft.lower()}' for pft in pfts]  # Light limitation
-        
-        # Create combined output dataset
-        output_ds = xr.Dataset()
+        limphy_ds = backend.open_dataset(limphy_file)
+        if fused:
+            lop_ds = compute_limiters(limphy_ds, tmesh.tmask.isel(t=0))
+            if write_lop:
+                lop_ds.attrs['note'] = 'made in /gpfs/home/mep22dku/scratch/EXTRACT/create_LNL_files.py'
+                backend.write_netcdf(lop_ds, lop_file)
+                print(f"  Saved: {lop_file.name}")
+        else:
+            lop_ds = backend.open_dataset(lop_file)
         
-        # Process each depth level
-        for depth in depth_levels:
-            # Average LV variables from LoP file (nutrient limitation)
-            lv_averaged = average_top_meters(lop_ds, lv_vars, depth, tmesh)
-            
-            # Average light limitation variables from limphy file
-            light_averaged = average_top_meters(limphy_ds, light_vars, depth, tmesh)
-            
-            # Rename variables to LIGHT_* and NUT_* format
-            for pft in pfts:
-                # Rename light limitation: lim8light_dia_avg_10m -> LIGHT_DIA_10m
-                old_light_name = f'lim8light_{pft.lower()}_avg_{depth}m'
-                new_light_name = f'LIGHT_{pft}_{depth}m'
-                if old_light_name in light_averaged:
-                    light_averaged = light_averaged.rename({old_light_name: new_light_name})
-                
-                # Rename nutrient limitation: LV_DIA_avg_10m -> NUT_DIA_10m
-                old_lv_name = f'LV_{pft}_avg_{depth}m'
-                new_lv_name = f'NUT_{pft}_{depth}m'
-                if old_lv_name in lv_averaged:
-                    lv_averaged = lv_averaged.rename({old_lv_name: new_lv_name})
-            
-            # Merge into output dataset
-            output_ds = xr.merge([output_ds, lv_averaged, light_averaged])
+        output_ds = lnl_dataset(limphy_ds, lop_ds, pfts, depth_levels, tmesh, partial_cells)
         
         # Add metadata
-        output_ds.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/create_LNL_files.py'
-        output_ds.attrs['source_files'] = f'{lop_file.name}, {limphy_file.name}'
-        output_ds.attrs['source_model'] = model
-        output_ds.attrs['year'] = year
-        output_ds.attrs['description'] = 'Top 10m and 100m averages of nutrient limitation (LV->NUT) and light limitation (LIGHT) variables'
-        output_ds.attrs['variable_naming'] = 'NUT_* = nutrient limitation (from LV), LIGHT_* = light limitation (from lim8light)'
+        output_ds.attrs.update(lnl_attrs(model, year, limphy_file.name, lop_file.name, fused, depth_levels))
         
         # Save output
-        output_ds.to_netcdf(output_file)
-        print(f"  Saved: {output_file.name}")
+        save_lnl(output_ds, model, year, output_file, base_dir, output_format, years)
         
         # Close datasets
         lop_ds.close()
@@ -206,69 +358,140 @@ def process_year(model, year, pfts, depth_levels, base_dir, tmesh):
         return False
 
 
-def read_models_from_file(filepath):
+def process_ensemble_year(models, year, pfts, depth_levels, base_dir, tmesh, fused=False, write_lop=False,
+                          partial_cells=False, output_format='netcdf', years=None):
     """
-    Read model names from a text file (one per line).
+    Process one year of every model at once, stacked along 'model' (see ensemble.py).
+    
+    The limiters and depth averages run once on the stacked data instead of
+    once per model. Each model's LNL_T output is written as in process_year,
+    plus an ensemble file with the 'model' dim under base_dir/ENSEMBLE/.
+    Parameters are as for process_year, with a list of models.
     
-    Parameters
-    ----------
-    filepath : str or Path
-        Path to text file containing model names
-        
     Returns
     -------
-    list of str
-        List of model names
+    bool
+        True if successful, False otherwise
     """
-    models = []
+    model_dirs = [Path(base_dir) / model for model in models]
+    lop_files = [d / f'ORCA2_1m_{year}0101_{year}1231_LoP_T.nc' for d in model_dirs]
+    limphy_files = [d / f'ORCA2_1m_{year}0101_{year}1231_limphy.nc' for d in model_dirs]
+    output_files = [d / f'ORCA2_1m_{year}0101_{year}1231_LNL_T.nc' for d in model_dirs]
+    
+    missing = [f for f in limphy_files + ([] if fused else lop_files) if not f.exists()]
+    if missing:
+        print(f"  Warning: {len(missing)} input file(s) not found for {year}, e.g. {missing[0]}")
+        return False
+    
+    if output_format == 'netcdf' and all(f.exists() for f in output_files):
+        print(f"  Skipping {year} (outputs already exist)")
+        return True
+    
     try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if line and not line.startswith('#'):
-                    models.append(line)
-        print(f"Loaded {len(models)} models from {filepath}")
-        return models
-    except FileNotFoundError:
-        print(f"ERROR: Models file not found: {filepath}")
-        return []
+        print(f"  Processing {year} ({len(models)} models)...")
+        
+        # Only the variables used: the eager backend reads the stacked variables whole
+        light_vars = [f'lim8light_{pft.lower()}' for pft in pfts]
+        limphy_ds = ensemble.open_ensemble(limphy_files, models, light_vars + (limiter_inputs() if fused else []))
+        if fused:
+            lop_ds = compute_limiters(limphy_ds, tmesh.tmask.isel(t=0))
+            if write_lop:
+                for model_ds, lop_file in zip(ensemble.split_models(lop_ds).values(), lop_files):
+                    model_ds.attrs['note'] = 'made in /gpfs/home/mep22dku/scratch/EXTRACT/create_LNL_files.py'
+                    backend.write_netcdf(model_ds, lop_file)
+                    print(f"  Saved: {lop_file.name}")
+        else:
+            lop_ds = ensemble.open_ensemble(lop_files, models, [f'LV_{pft}' for pft in pfts])
+        
+        output_ds = lnl_dataset(limphy_ds, lop_ds, pfts, depth_levels, tmesh, partial_cells)
+        
+        # One file per model, as process_year writes them
+        for (model, model_ds), output_file in zip(ensemble.split_models(output_ds).items(), output_files):
+            model_ds.attrs.update(lnl_attrs(model, year, limphy_files[0].name, lop_files[0].name, fused, depth_levels))
+            save_lnl(model_ds, model, year, output_file, base_dir, output_format, years)
+        
+        # And the ensemble with its 'model' dim
+        output_ds.attrs.update(lnl_attrs(', '.join(models), year, limphy_files[0].name, lop_files[0].name,
+                                         fused, depth_levels))
+        ensemble_file = ensemble.ensemble_dir(base_dir) / output_files[0].name
+        backend.write_netcdf(output_ds.transpose('model', ...), ensemble_file)
+        print(f"  Saved: {ensemble_file}")
+        
+        lop_ds.close()
+        limphy_ds.close()
+        return True
+    
+    except Exception as e:
+        print(f"  ERROR processing {year}: {e}")
+        return False
+
+
+def process_unit(model, year, overwrite=False):
+    """Work unit for run_units: process one (model, year) with the per-process meshmask"""
+    tmesh = shared_resource('mesh_e3t_tmask', cached_dataset, mesh_file, ['e3t_0', 'tmask'])
+    with instrument.unit(model=model, year=year):
+        return process_year(model, year, pfts, depth_levels, base_dir, tmesh, fused, write_lop, partial_cells,
+                            output_format, list(range(year_start, year_end + 1)), overwrite)
+
+
+def ensemble_unit(models, year):
+    """Work unit for run_units: process one year of every model together"""
+    tmesh = shared_resource('mesh_e3t_tmask', cached_dataset, mesh_file, ['e3t_0', 'tmask'])
+    with instrument.unit(model=ensemble.ensemble_name, year=year):
+        return process_ensemble_year(models, year, pfts, depth_levels, base_dir, tmesh, fused, write_lop,
+                                     partial_cells, output_format, list(range(year_start, year_end + 1)))
 
 
 # ===== RUN =====
 
-# Load meshmask once (used for all calculations)
-print("Loading meshmask...")
-tmesh = xr.open_dataset('/gpfs/data/greenocean/software/resources/regrid/mesh_mask3_6.nc')
+def main():
+    """Write the LNL files of every (model, year) in models_file and the year range"""
+    # Read models from file
+    models = read_models_from_file(models_file)
+
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    # Process every (model, year) unit; the meshmask is loaded once per worker
+    client = backend.start_cluster()
+    workers = backend.unit_workers(n_workers)
+    sample = Path(base_dir) / models[0] / f'ORCA2_1m_{year_start}0101_{year_start}1231_limphy.nc'
+    if memory_budget.budget() is not None and sample.exists():
+        # As many concurrent years as fit the budget a time step at a time
+        unit_bytes = smallest_limiter_bytes(sample, len(models) if ensemble_mode else 1)
+        n_units = (1 if ensemble_mode else len(models)) * (year_end - year_start + 1)
+        workers = memory_budget.plan_workers('create_LNL_files', unit_bytes, min(workers, n_units))
+    print(f"Processing models: {', '.join(models)} with {workers} worker(s)")
+
+    if ensemble_mode:
+        # One unit per year for all models, stacked along 'model'
+        units = [(models, year) for year in range(year_start, year_end + 1)]
+        results = run_units(ensemble_unit, units, workers, error_format='  ERROR processing {1}: {e}')
+        backend.compute_pending()
+        print(f"\nEnsemble of {len(models)} models: {sum(1 for r in results if r)} of {len(units)} years processed")
+        instrument.print_summary()
+        return
+
+    units = [(model, year) for model in models for year in range(year_start, year_end + 1)]
+    results = run_units(process_unit, units, workers, error_format='  ERROR processing {0} {1}: {e}')
+    backend.compute_pending()
 
-# Read models from file
-models = read_models_from_file(models_file)
+    for model in models:
+        model_results = [result for (unit_model, _), result in zip(units, results) if unit_model == model]
+        success_count = sum(1 for result in model_results if result)
+        fail_count = len(model_results) - success_count
 
-if not models:
-    print("No models to process. Exiting.")
-    exit(1)
+        print(f"\nSummary for {model}:")
+        print(f"  Processed: {success_count} years")
+        print(f"  Failed/Missing: {fail_count} years")
+
+    instrument.print_summary()
 
-# Process each model
-for model in models:
     print(f"\n{'='*60}")
-    print(f"Processing model: {model}")
+    print("All models processed!")
     print(f"{'='*60}")
-    
-    success_count = 0
-    fail_count = 0
-    skip_count = 0
-    
-    for year in range(year_start, year_end + 1):
-        result = process_year(model, year, pfts, depth_levels, base_dir, tmesh)
-        if result:
-            success_count += 1
-        else:
-            fail_count += 1
-    
-    print(f"\nSummary for {model}:")
-    print(f"  Processed: {success_count} years")
-    print(f"  Failed/Missing: {fail_count} years")
 
-print(f"\n{'='*60}")
-print("All models processed!")
-print(f"{'='*60}")
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,31 @@
 import xarray as xr
-import glob
+import numpy as np
 from pathlib import Path
 
+import backend
+import catalog
+import instrument
+import memory_budget
+from cli import read_models_from_file
+from executor import default_workers, run_units, shared_resource
+from mesh_cache import cached_dataset
+
 # ===== INPUTS =====
 
 # Paths
 clims_dir = '/gpfs/data/greenocean/users/mep22dku/clims/'
 models_file = 'models.txt'  # Path to text file containing model names
+n_workers = default_workers()  # Processes for climatology file units; 1 runs serially
 
-# Load mask
-mask = xr.open_dataset('/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_nicedims.nc')
+# Mask (loaded once per process on first use)
+mask_file = '/gpfs/home/mep22dku/scratch/SOZONE/UTILS/mesh_mask3pt6_nicedims.nc'
 
 # Variable lists for different file types
 diad_vars = ['PPT', 'PPT_DIA', 'PPT_MIX', 'PPT_COC', 'PPT_PIC', 'PPT_PHA', 'PPT_FIX']
 ptrc_vars = ['BAC', 'PRO', 'PTE', 'MES', 'GEL', 'MAC', 'DIA', 'MIX', 'COC', 'PIC', 'PHA', 'FIX']
 
 # ===== FUNCTION =====
-def integrate_depth(dataset, var_list, tmesh, suffix='_int'):
+def integrate_depth(dataset, var_list, tmesh, suffix='_int', time_block=None):
     """
     Integrate 4D variables along depth dimension to create 3D variables.
     
@@ -31,6 +40,10 @@ def integrate_depth(dataset, var_list, tmesh, suffix='_int'):
     suffix : str, optional
         Suffix to append to integrated variable names (default: '_int')
         Note: This parameter is kept for backwards compatibility but is not used
+    time_block : int, optional
+        Number of time steps integrated per batch (bounds memory for long files);
+        by default the most that fit the memory budget (see memory_budget.py),
+        or 1 without one
         
     Returns
     -------
@@ -75,35 +88,120 @@ def integrate_depth(dataset, var_list, tmesh, suffix='_int'):
     if dim_mapping:
         e3t = e3t.rename(dim_mapping)
     
-    # Handle time dimension: squeeze if singleton, then broadcast if needed
+    # Handle time dimension: squeeze if singleton; e3t is never broadcast over time
     if time_dim in e3t.dims and e3t.sizes[time_dim] == 1:
         e3t = e3t.squeeze(time_dim, drop=True)
     
-    # If e3t doesn't have the dataset's time dimension, add it
-    if time_dim not in e3t.dims and time_dim in dataset.dims:
-        e3t = e3t.expand_dims({time_dim: dataset[time_dim]})
-    
     # Create empty output dataset
     output_ds = xr.Dataset()
     
-    # Integrate each variable
+    present = []
     for var in var_list:
         if var not in dataset.data_vars:
             print(f"Warning: variable {var} not found in dataset")
             continue
-        
-        # Broadcast e3t to match variable dimensions
-        e3t_broadcasted = xr.broadcast(dataset[var], e3t)[1]
-        
-        # Depth-integrated values
-        integrated = (dataset[var] * e3t_broadcasted).sum(dim=depth_dim)
-        
-        # Add to output dataset without suffix
-        output_ds[var] = integrated
+        present.append(var)
+    
+    # Variables with the same dims are integrated together in one batched contraction
+    groups = {}
+    for var in present:
+        groups.setdefault(dataset[var].dims, []).append(var)
+    
+    integrated = {}
+    for dims, group in groups.items():
+        for var, values in zip(group, depth_integral(dataset, group, e3t, time_dim, depth_dim, time_block)):
+            integrated[var] = values
+    
+    # Add to output dataset without suffix, in var_list order
+    for var in present:
+        output_ds[var] = integrated[var]
     
     return output_ds
 
 
+def depth_integral(dataset, var_list, e3t, time_dim, depth_dim, time_block=None):
+    """
+    Contract variables over depth against a static e3t, without broadcasting it over time.
+    
+    NaN cells count as zero, as in .sum() (so all-NaN columns integrate to 0).
+    Blocks of time steps are read, stacked over variables and contracted
+    with einsum, so the working set is one time block of the inputs.
+    Dask-backed inputs (see backend.py) give lazy results instead.
+
+    Parameters
+    ----------
+    dataset : xr.Dataset
+        Input dataset
+    var_list : list of str
+        Variables sharing the same dims (time, depth, ...)
+    e3t : xr.DataArray
+        Cell thickness with dims (depth, ...) or (time, depth, ...), named
+        like the dataset
+    time_dim, depth_dim : str
+        Names of the time and depth dimensions
+    time_block : int, optional
+        Number of time steps contracted per batch (default: planned from
+        the memory budget, see memory_budget.time_block)
+        
+    Returns
+    -------
+    list of xr.DataArray
+        Depth-integrated variables, in var_list order
+    """
+    template = dataset[var_list[0]].transpose(time_dim, depth_dim, ...)
+    other_dims = template.dims[2:]
+    
+    # Keep the coordinates .sum() would keep: everything not on the depth dim
+    coords = {k: v for k, v in template.coords.items() if depth_dim not in v.dims}
+    
+    if any(dataset[var].chunks for var in var_list):
+        # Dask backend: contract lazily, chunk by chunk of time steps
+        integrals = [(dataset[var].fillna(0) * e3t).sum(depth_dim) for var in var_list]
+        return [
+            xr.DataArray(integral.data, dims=integral.dims, coords=coords).transpose(
+                *[d for d in dataset[var].dims if d != depth_dim]
+            )
+            for var, integral in zip(var_list, integrals)
+        ]
+    
+    time_varying = time_dim in e3t.dims
+    if time_varying:
+        e3t = e3t.transpose(time_dim, depth_dim, *other_dims)
+        subscripts = 'vtz...,tz...->vt...'
+    else:
+        e3t = e3t.transpose(depth_dim, *other_dims)
+        subscripts = 'vtz...,z...->vt...'
+    e3t_values = np.asarray(e3t.values)
+    
+    ntime = template.sizes[time_dim]
+    dtype = np.result_type(*[dataset[v].dtype for v in var_list], e3t_values.dtype)
+    out = np.empty((len(var_list), ntime) + template.shape[2:], dtype=dtype)
+    
+    if time_block is None:
+        # A block of every variable, plus its NaN mask and einsum temporaries
+        step = memory_budget.field_bytes((len(var_list),) + template.shape[1:], dtype) * 3
+        time_block = memory_budget.time_block('depth_integrate', step, ntime, out.nbytes)
+    
+    for t0 in range(0, ntime, time_block):
+        t1 = min(t0 + time_block, ntime)
+        with instrument.stage('load'):
+            block = np.stack([
+                dataset[v].isel({time_dim: slice(t0, t1)}).transpose(time_dim, depth_dim, ...).values
+                for v in var_list
+            ])
+        with instrument.stage('compute'):
+            block[np.isnan(block)] = 0
+            weights = e3t_values[t0:t1] if time_varying else e3t_values
+            out[:, t0:t1] = np.einsum(subscripts, block, weights, optimize=True)
+    
+    return [
+        xr.DataArray(out[i], dims=(time_dim,) + other_dims, coords=coords).transpose(
+            *[d for d in dataset[var].dims if d != depth_dim]
+        )
+        for i, var in enumerate(var_list)
+    ]
+
+
 def process_climatology(filepath, var_list, mask):
     """
     Process a single climatology file by depth-integrating specified variables.
@@ -128,7 +226,7 @@ def process_climatology(filepath, var_list, mask):
         print(f"Processing {filepath.name}...")
         
         # Open dataset
-        ds = xr.open_dataset(filepath)
+        ds = backend.open_dataset(filepath)
         
         # Integrate depth
         ds_int = integrate_depth(ds, var_list, mask)
@@ -141,7 +239,7 @@ def process_climatology(filepath, var_list, mask):
         output_file = filepath.parent / f"{filepath.stem}_int.nc"
         
         # Save
-        ds_int.to_netcdf(output_file)
+        backend.write_netcdf(ds_int, output_file)
         print(f"  Saved to {output_file.name}")
         
         return str(output_file)
@@ -151,72 +249,67 @@ def process_climatology(filepath, var_list, mask):
         return None
 
 
-def read_models_from_file(filepath):
-    """
-    Read model names from a text file (one per line).
-    
-    Parameters
-    ----------
-    filepath : str or Path
-        Path to text file containing model names
-        
-    Returns
-    -------
-    list of str
-        List of model names
-    """
-    models = []
-    try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if line and not line.startswith('#'):
-                    models.append(line)
-        print(f"Loaded {len(models)} models from {filepath}")
-        return models
-    except FileNotFoundError:
-        print(f"ERROR: Models file not found: {filepath}")
-        return []
+def smallest_integration_bytes(filepath, var_list):
+    """Working set of integrating one file a time step at a time (output plus one block)"""
+    with xr.open_dataset(filepath) as ds:
+        fields = [ds[v] for v in var_list if v in ds.data_vars]
+        out = sum(memory_budget.field_bytes(da.shape[:1] + da.shape[2:], float) for da in fields)
+        step = sum(memory_budget.field_bytes(da.shape[1:], float) for da in fields) * 3
+    return out + step
+
+
+def integrate_unit(filepath, var_list):
+    """Work unit for run_units: depth-integrate one climatology file with the per-process mask"""
+    mask = shared_resource('nicedims_e3t', cached_dataset, mask_file, ['e3t_0'])
+    with instrument.unit(file=Path(filepath).name):
+        return process_climatology(filepath, var_list, mask)
 
 
 # ===== RUN =====
 
-# Read models from file
-models = read_models_from_file(models_file)
+def main():
+    """Depth-integrate the climatology files of every model in models_file"""
+    # Read models from file
+    models = read_models_from_file(models_file)
+
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    # Collect one unit per climatology file
+    units = []
+    for model in models:
+        model_dir = Path(clims_dir) / model
+
+        if not model_dir.exists():
+            print(f"  Model directory not found: {model_dir}")
+            continue
+
+        # Find all diad_T climatology files
+        diad_files = catalog.find_files(model_dir, 'diad_T', clim=True)
+        units.extend((diad_file, diad_vars) for diad_file in diad_files)
+
+        # Find all ptrc_T climatology files
+        ptrc_files = catalog.find_files(model_dir, 'ptrc_T', clim=True)
+        units.extend((ptrc_file, ptrc_vars) for ptrc_file in ptrc_files)
+
+    client = backend.start_cluster()
+    workers = backend.unit_workers(n_workers)
+    if units and memory_budget.budget() is not None:
+        # As many concurrent files as fit the budget a time step at a time
+        samples = {tuple(var_list): filepath for filepath, var_list in units}
+        unit_bytes = max(smallest_integration_bytes(f, v) for v, f in samples.items())
+        workers = memory_budget.plan_workers('depth_integrate', unit_bytes, min(workers, len(units)))
+    print(f"Processing {len(units)} climatology files with {workers} worker(s)")
+    run_units(integrate_unit, units, workers, error_format='ERROR processing {0}: {e}')
+    backend.compute_pending()
 
-if not models:
-    print("No models to process. Exiting.")
-    exit(1)
+    instrument.print_summary()
 
-# Process each model
-for model in models:
     print(f"\n{'='*60}")
-    print(f"Processing model: {model}")
+    print("All processing complete!")
     print(f"{'='*60}")
-    
-    model_dir = Path(clims_dir) / model
-    
-    if not model_dir.exists():
-        print(f"  Model directory not found: {model_dir}")
-        continue
-    
-    # Find all diad_T climatology files
-    diad_files = sorted(model_dir.glob('ORCA2_1m_clim_*_diad_T.nc'))
-    for diad_file in diad_files:
-        try:
-            process_climatology(diad_file, diad_vars, mask)
-        except Exception as e:
-            print(f"ERROR processing {diad_file.name}: {e}")
-    
-    # Find all ptrc_T climatology files
-    ptrc_files = sorted(model_dir.glob('ORCA2_1m_clim_*_ptrc_T.nc'))
-    for ptrc_file in ptrc_files:
-        try:
-            process_climatology(ptrc_file, ptrc_vars, mask)
-        except Exception as e:
-            print(f"ERROR processing {ptrc_file.name}: {e}")
-
-print(f"\n{'='*60}")
-print("All processing complete!")
-print(f"{'='*60}")
+
+
+if __name__ == '__main__':
+    main()
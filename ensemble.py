@@ -0,0 +1,118 @@
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+
+import backend
+import catalog
+
+# ===== INPUTS =====
+
+# Ensemble outputs (with a 'model' dim) go where a model of this name would,
+# e.g. clims/ENSEMBLE/ next to clims/<model>/
+ensemble_name = 'ENSEMBLE'
+
+# ===== FUNCTIONS =====
+
+def common_years(files_by_model):
+    """
+    Years every model has a file for, in order.
+
+    Parameters
+    ----------
+    files_by_model : dict
+        Model -> {year: path} (see catalog.files_by_year)
+
+    Returns
+    -------
+    list of int
+        Common years; years only some models have are reported and left out
+    """
+    year_sets = [set(files) for files in files_by_model.values()]
+    if not year_sets:
+        return []
+    common = set.intersection(*year_sets)
+    for model, files in files_by_model.items():
+        missing = sorted(set(files) - common)
+        if missing:
+            print(f"  Warning: {model} years {missing[0]}-{missing[-1]} are not in every model, left out of the ensemble")
+    return sorted(common)
+
+
+def ensemble_files(directories, filetype, models=None, years=None):
+    """
+    Yearly files of every model for the years they all have.
+
+    Parameters
+    ----------
+    directories : dict
+        Model -> directory of its yearly files (one listing each, see catalog.py)
+    filetype : str
+        File type, e.g. 'ptrc_T', 'limphy' or 'MOC'
+    models : list of str, optional
+        Models to match by file name (for the MOC directory, shared by all models)
+    years : iterable of int, optional
+        Years to consider
+
+    Returns
+    -------
+    dict
+        Year -> list of paths, in the order of directories
+    """
+    files = {model: catalog.files_by_year(directory, filetype, model=model if models else None, years=years)
+             for model, directory in directories.items()}
+    return {year: [files[model][year] for model in directories] for year in common_years(files)}
+
+
+def open_ensemble(paths, models, variables=None, time_dim='time_counter'):
+    """
+    Open one file per model and stack them along a 'model' dim.
+
+    The models must share the grid and time axis: coordinates, the time
+    index and variables without the time dim (e.g. grid fields) are taken
+    from the first file. The 'model' dim follows the time dim, so (time,
+    depth, y, x) variables become (time, model, depth, y, x) and the
+    time-blocked kernels work on them unchanged. On the eager backend the
+    stacked variables are read into memory, so pass the variables needed.
+    Closing the result closes every file.
+
+    Parameters
+    ----------
+    paths : list of str or Path
+        One file per model, in model order
+    models : list of str
+        Model names
+    variables : list of str, optional
+        Variables to keep (those missing from the files are skipped)
+    time_dim : str, optional
+        Name of the time dim
+
+    Returns
+    -------
+    xr.Dataset
+        Stacked dataset
+    """
+    datasets = [backend.open_dataset(p) for p in paths]
+    selected = datasets
+    if variables is not None:
+        selected = [ds[[v for v in variables if v in ds]] for ds in datasets]
+    stacked_vars = [v for v, da in selected[0].data_vars.items() if time_dim in da.dims]
+    stacked = xr.concat(selected, dim=pd.Index(list(models), name='model'), data_vars=stacked_vars,
+                        coords='minimal', compat='override', join='override', combine_attrs='drop_conflicts')
+    stacked = stacked.transpose(time_dim, 'model', ..., missing_dims='ignore')
+    if backend.use_dask():
+        # One chunk along 'model' (and depth/y/x), so the kernels see whole ensembles
+        stacked = stacked.chunk(backend.chunk_policy(stacked.dims, backend.planned_time_chunk(stacked)))
+    stacked.set_close(lambda: [ds.close() for ds in datasets])
+    return stacked
+
+
+def split_models(stacked):
+    """Model -> the stacked dataset or array at that model, without the 'model' dim"""
+    return {str(model): stacked.sel(model=model, drop=True) for model in stacked['model'].values}
+
+
+def ensemble_dir(parent):
+    """Output directory of the ensemble files under a per-model parent directory"""
+    path = Path(parent) / ensemble_name
+    path.mkdir(parents=True, exist_ok=True)
+    return path
@@ -0,0 +1,136 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+
+# Per-process store of shared resources (mesh, masks, weights). Each worker
+# process fills its own copy once and reuses it for every unit it runs.
+_resources = {}
+
+# ===== FUNCTIONS =====
+
+def default_workers():
+    """
+    Number of worker processes to use by default.
+
+    Uses EXTRACT_WORKERS if set, then the SLURM allocation
+    (SLURM_CPUS_PER_TASK, SLURM_CPUS_ON_NODE), otherwise 1: on a shared
+    login node the CPU count says nothing about what the job may use.
+
+    Returns
+    -------
+    int
+        Number of workers (at least 1)
+    """
+    for var in ['EXTRACT_WORKERS', 'SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE']:
+        value = os.environ.get(var)
+        if value:
+            try:
+                return max(1, int(value))
+            except ValueError:
+                print(f"Warning: ignoring non-integer {var}={value}")
+    return 1
+
+
+def shared_resource(name, loader=None, *args):
+    """
+    Return a per-process shared resource, loading it on first use.
+
+    Parameters
+    ----------
+    name : str
+        Resource name, e.g. 'tmesh'
+    loader : callable, optional
+        Called as loader(*args) the first time the resource is requested in
+        this process. If None, the resource must already have been installed
+        (see run_units(resources=...)).
+    *args
+        Arguments for loader
+
+    Returns
+    -------
+    object
+        The resource
+    """
+    if name not in _resources:
+        if loader is None:
+            raise KeyError(f"Shared resource not loaded: {name}")
+        _resources[name] = loader(*args)
+    return _resources[name]
+
+
+def _install_resources(resources):
+    """Worker initializer: install resources passed from the parent process"""
+    _resources.update(resources)
+
+
+def _run_unit(func, unit, error_format):
+    """Run one work unit, printing failures the way the serial loops do"""
+    try:
+        return func(*unit)
+    except Exception as e:
+        print(error_format.format(*unit, e=e), flush=True)
+        return None
+
+
+def run_units(func, units, n_workers=1, error_format='  Error for {0}: {e}', resources=None):
+    """
+    Run func(*unit) for every work unit, optionally on a process pool.
+
+    Each unit is independent (typically a (model, year) pair). Results are
+    returned in the order of units regardless of completion order, so
+    outputs and summaries are deterministic. A unit that raises is reported
+    with error_format and gives None, as the try/except in the serial loops did.
+
+    Parameters
+    ----------
+    func : callable
+        Module-level function to run for each unit
+    units : list of tuple
+        Arguments for each call
+    n_workers : int, optional
+        Number of worker processes; 1 (default) runs serially in this process
+    error_format : str, optional
+        Format string for failures; positional fields are the unit's items
+        and {e} is the exception
+    resources : dict, optional
+        Shared resources (e.g. precomputed masks) installed once in every
+        worker, retrievable there with shared_resource(name)
+
+    Returns
+    -------
+    list
+        func's return value for each unit (None for failed units)
+    """
+    units = [tuple(unit) for unit in units]
+    instrument.plan(len(units))
+    started = time.time()
+
+    if n_workers <= 1 or len(units) <= 1:
+        _install_resources(resources or {})
+        results = []
+        for unit in units:
+            results.append(_run_unit(func, unit, error_format))
+            instrument.unit_done(len(results), len(units), started)
+        return results
+
+    # Fork where available so workers inherit the script's inputs and any
+    # resources already loaded, instead of re-importing it
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(units)), mp_context=context,
+                             initializer=_install_resources, initargs=(resources or {},)) as pool:
+        futures = [pool.submit(_run_unit, func, unit, error_format) for unit in units]
+        for unit, future in zip(units, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                # Worker died (e.g. OOM-killed) rather than the unit raising
+                print(error_format.format(*unit, e=e), flush=True)
+                results.append(None)
+            instrument.unit_done(len(results), len(units), started)
+    return results
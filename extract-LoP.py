@@ -1,11 +1,27 @@
-import xarray as xr
-import numpy as np
-import glob
 from pathlib import Path
 
+import backend
+import instrument
+import memory_budget
+from cli import read_models_from_file
+from executor import default_workers, run_units, shared_resource
+from limiters import compute_limiters, smallest_limiter_bytes
+from mesh_cache import cached_dataset
+from zarr_store import store_path, write_year
+
 # ===== INPUTS =====
 
 models_file = 'models.txt'  # Path to text file containing model names
+base_dir = '/gpfs/data/greenocean/software/runs/'
+mesh_file = '/gpfs/data/greenocean/software/resources/regrid/mesh_mask3_6.nc'
+n_workers = default_workers()  # Processes for (model, year) units; 1 runs serially
+
+# Year range
+year_start = 1940
+year_end = 2023
+
+# 'netcdf' (yearly LoP_T files), 'zarr' (one ORCA2_1m_LoP_T.zarr store per model, see zarr_store.py) or 'both'
+output_format = 'netcdf'
 
 # ===== FUNCTIONS =====
 
@@ -27,135 +43,77 @@ def get_limiter(run='TOM12_TJ_LC00', year=1920, dataset_note=None):
     xr.Dataset
         Dataset containing LV and LN variables for each PFT
     """
-    tdir = f'/gpfs/data/greenocean/software/runs/{run}/'
+    tdir = f'{base_dir}{run}/'
     tfi = f'ORCA2_1m_{year}0101_{year}1231_limphy.nc'
-    w = xr.open_dataset(f'{tdir}/{tfi}')
+    w = backend.open_dataset(f'{tdir}/{tfi}')
     print(f'{run} {year}')
     
-    # Load meshmask
-    tmesh = xr.open_dataset('/gpfs/data/greenocean/software/resources/regrid/mesh_mask3_6.nc')
+    # Load meshmask (once per process, memory-mapped from the mesh cache)
+    tmesh = shared_resource('mesh_tmask', cached_dataset, mesh_file, ['tmask'])
     tm = tmesh.tmask.isel(t=0)
     
-    # Broadcast mask
-    tm_broad, _ = xr.broadcast(tm, w['nav_lat'])
-    tm_broad = tm_broad.expand_dims(time=w.time_counter)
-    
-    # PFTs
-    pfts = ['dia', 'mix', 'coc', 'pic', 'pha', 'fix']
-    
-    # Nutrient codes
-    limiter_codes = dict(fe=3, p=4, si=5, n=6)
-    
-    for pft in pfts:
-        varlist = [
-            f'lim3fe_{pft}',   # Fe
-            f'lim4po4_{pft}',  # P
-            f'lim6din_{pft}',  # N
-        ]
-        if pft == 'dia':
-            varlist.insert(2, f'lim5si_{pft}')  # Si at index 2
-        
-        # Stack
-        stacked = xr.concat([w[v] for v in varlist], dim='nutrient')
-        stacked = stacked.where(stacked != 0, np.nan)
-        
-        # Replace NaNs with infinity for min calculation
-        stacked_for_min = stacked.fillna(np.inf)
-        
-        # LV (Limiting Value)
-        lv_name = f'LV_{pft.upper()}'
-        lv_result = stacked_for_min.min(dim='nutrient')
-        # Convert inf back to NaN
-        lv_result = lv_result.where(np.isfinite(lv_result.values), np.nan)
-        w[lv_name] = lv_result
-        
-        # LN (Limiting Nutrient)
-        min_idx = stacked_for_min.argmin(dim='nutrient').values.astype(float)
-        min_idx[tm_broad.values == 0] = np.nan
-        
-        if pft == 'dia':
-            order = ['fe', 'p', 'si', 'n']
-        else:
-            order = ['fe', 'p', 'n']
-        
-        mapping = np.full_like(min_idx, np.nan)
-        for i, nutr in enumerate(order):
-            mapping[min_idx == i] = limiter_codes[nutr]
-        
-        ln_name = f'LN_{pft.upper()}'
-        w[ln_name] = w[lv_name].copy()
-        w[ln_name].data = mapping
-    
-    # Output vars
-    outvars = []
-    for pft in pfts:
-        outvars.extend([f'LV_{pft.upper()}', f'LN_{pft.upper()}'])
-    
-    output_ds = w[outvars]
-    output_ds.attrs['limiter_codes'] = "3 = Fe, 4 = P, 5 = Si, 6 = N"
+    output_ds = compute_limiters(w, tm)
     if dataset_note is not None:
         output_ds.attrs['note'] = dataset_note
     
     outfile = f'{tdir}/ORCA2_1m_{year}0101_{year}1231_LoP_T.nc'
     try:
-        output_ds.to_netcdf(outfile)
-        print(f'Saved {run} {year}:\n{outfile}\n')
+        if output_format in ('netcdf', 'both'):
+            backend.write_netcdf(output_ds, outfile)
+            print(f'Saved {run} {year}:\n{outfile}\n')
+        if output_format in ('zarr', 'both'):
+            store = store_path(Path(tdir).parent, run, 'LoP_T')
+            write_year(output_ds, store, year, list(range(year_start, year_end + 1)))
+            print(f'Saved {run} {year}:\n{store}\n')
     except Exception as e:
         print(f'Failed to save {run} {year}: {e}\n')
     
     return output_ds
 
 
-def read_models_from_file(filepath):
-    """
-    Read model names from a text file (one per line).
-    
-    Parameters
-    ----------
-    filepath : str or Path
-        Path to text file containing model names
-        
-    Returns
-    -------
-    list of str
-        List of model names
-    """
-    models = []
-    try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if line and not line.startswith('#'):
-                    models.append(line)
-        print(f"Loaded {len(models)} models from {filepath}")
-        return models
-    except FileNotFoundError:
-        print(f"ERROR: Models file not found: {filepath}")
-        return []
+def limiter_unit(run, year, dataset_note=None):
+    """Work unit for run_units: run get_limiter without returning the dataset to the parent"""
+    with instrument.unit(model=run, year=year):
+        get_limiter(run, year, dataset_note)
+    return True
 
 
 # ===== RUN =====
 
-# Read models from file
-mods = read_models_from_file(models_file)
+def main():
+    """Write the LoP files of every (model, year) in models_file and the year range"""
+    # Read models from file
+    mods = read_models_from_file(models_file)
+
+    if not mods:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    # Process every (model, year) unit
+    client = backend.start_cluster()
+    workers = backend.unit_workers(n_workers)
+    sample = Path(base_dir) / mods[0] / f'ORCA2_1m_{year_start}0101_{year_start}1231_limphy.nc'
+    if memory_budget.budget() is not None and sample.exists():
+        # As many concurrent years as fit the budget a time step at a time
+        unit_bytes = smallest_limiter_bytes(sample, 1)
+        n_units = len(mods) * (year_end - year_start + 1)
+        workers = memory_budget.plan_workers('extract-LoP', unit_bytes, min(workers, n_units))
+    print(f"Processing models: {', '.join(mods)} with {workers} worker(s)")
+
+    units = [
+        (mod, year, 'made in /gpfs/home/mep22dku/scratch/EXTRACT/extract-LoP.py')
+        for mod in mods
+        for year in range(year_start, year_end + 1)
+    ]
+    run_units(limiter_unit, units, workers, error_format='  Error for {0}, {1}: {e}')
+    backend.compute_pending()
 
-if not mods:
-    print("No models to process. Exiting.")
-    exit(1)
+    instrument.print_summary()
 
-# Process each model and year
-for mod in mods:
     print(f"\n{'='*60}")
-    print(f"Processing model: {mod}")
+    print("All models processed!")
     print(f"{'='*60}")
-    
-    for year in range(1940, 2024):
-        try:
-            get_limiter(mod, year, 'made in /gpfs/home/mep22dku/scratch/EXTRACT/extract-LoP.py')
-        except Exception as e:
-            print(f'  Error for {mod}, {year}: {e}')
-
-print(f"\n{'='*60}")
-print("All models processed!")
-print(f"{'='*60}")
+
+
+if __name__ == '__main__':
+    main()
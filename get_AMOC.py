@@ -1,18 +1,365 @@
 import xarray as xr
 import numpy as np
 import pandas as pd
-import glob
 from pathlib import Path
 
-# ===== INPUTS =====
+import cftime
+import netCDF4
+
+import catalog
+import ensemble
+import instrument
+from cli import read_models_from_file
+from executor import default_workers, run_units
+from output_encoding import netcdf_encoding
 
+# ===== INPUTS =====
+# Define year range
+yrst = 1940
+yrend = 2024
 # Paths
 baseDir = '/gpfs/data/greenocean/software/resources/CDFTOOLS/MOCresults/'
 clims_dir = '/gpfs/data/greenocean/users/mep22dku/clims/'
 models_file = 'models.txt'  # Path to text file containing model names
+n_workers = default_workers()  # Processes for model units; 1 runs serially
+n_readers = 4  # Processes reading MOC files within each model when models run serially; 1 reads serially
+ensemble_mode = False  # All models at once, stacked along a 'model' dim (see ensemble.py)
+
+# Overturning metrics (latitude x basin x statistic), written alongside the AMOC timeseries
+moc_metrics = True
+moc_basins = {'atl': 'zomsfatl', 'glo': 'zomsfglo', 'inp': 'zomsfinp'}  # basin -> MOC variable
+moc_latitudes = {26.5: 94, 45.0: None, -34.5: None}  # degrees N -> y index (None: nearest nav_lat row)
+moc_depth_band = (500, 2000)  # m, for the band-mean overturning
+moc_rolling_years = 10
+
+# The AMOC timeseries is the maximum of this variable at this y index (26°N on ORCA2)
+amoc_variable = 'zomsfatl'
+amoc_y_index = 94
 
 # ===== FUNCTION =====
-def compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir):
+def read_moc_profile(filepath, var_names=('zomsfatl',), y_indices=(94,)):
+    """
+    Read latitude rows of overturning variables from a MOC file.
+    
+    Only the (time, depth) hyperslab at each y index is read, with the
+    netCDF4 library directly, so nothing else in the file is decoded.
+    
+    Parameters
+    ----------
+    filepath : str
+        CDFTOOLS MOC file
+    var_names : list of str, optional
+        Overturning variables, e.g. ['zomsfatl'] (Atlantic)
+    y_indices : list of int, optional
+        Positions along y (94 is 26°N on ORCA2)
+        
+    Returns
+    -------
+    tuple
+        (times as cftime objects, profile array (variable, y, time, depth),
+        depth dim name, depth values or None)
+    """
+    with netCDF4.Dataset(filepath) as nc:
+        rows = []
+        for var_name in var_names:
+            var = nc.variables[var_name]
+            dims = var.dimensions
+            
+            # Drop singleton dims (e.g. x=1 in zonal integrals) but keep time
+            kept = [d for d in dims if d != 'y']
+            kept = [d for d in kept if d == 'time_counter' or nc.dimensions[d].size > 1]
+            depth_dim = [d for d in kept if d != 'time_counter'][0]
+            
+            for y_index in y_indices:
+                index = tuple(y_index if d == 'y' else slice(None) if d in kept else 0 for d in dims)
+                with instrument.stage('load'):
+                    profile = var[index]
+                if profile.dtype.kind != 'f':
+                    profile = profile.astype(float)
+                rows.append(np.ma.filled(profile, np.nan).transpose(
+                    kept.index('time_counter'), kept.index(depth_dim)))
+        
+        time_var = nc.variables['time_counter']
+        times = cftime.num2date(time_var[:], time_var.units,
+                                getattr(time_var, 'calendar', 'standard'))
+        depths = nc.variables[depth_dim][:].filled(np.nan) if depth_dim in nc.variables else None
+    
+    profiles = np.stack(rows).reshape(len(var_names), len(y_indices), *rows[0].shape)
+    return np.atleast_1d(times), profiles, depth_dim, depths
+
+
+def read_moc_profiles(file_list, var_names=('zomsfatl',), y_indices=(94,), n_readers=1):
+    """
+    Read latitude rows of overturning variables from many MOC files.
+    
+    Files are read concurrently (see read_moc_profile) and the profiles are
+    copied in file order into one preallocated array, instead of opening
+    and aligning every file with open_mfdataset.
+    
+    Parameters
+    ----------
+    file_list : list of str
+        MOC files in time order
+    var_names : list of str, optional
+        Overturning variables, e.g. ['zomsfatl'] (Atlantic)
+    y_indices : list of int, optional
+        Positions along y (94 is 26°N on ORCA2)
+    n_readers : int, optional
+        Number of reader processes; 1 reads serially
+        
+    Returns
+    -------
+    xr.DataArray
+        Overturning with dims (variable, y, time_counter, depth)
+    """
+    var_names = list(var_names)
+    y_indices = list(y_indices)
+    units = [(f, var_names, y_indices) for f in file_list]
+    results = run_units(read_moc_profile, units, n_readers, error_format='  Error reading {0}: {e}')
+    if any(r is None for r in results):
+        raise IOError("Could not read all MOC files")
+    
+    _, first, depth_dim, depths = results[0]
+    n_time = sum(len(r[0]) for r in results)
+    profiles = np.empty(first.shape[:2] + (n_time, first.shape[3]), dtype=first.dtype)
+    times = []
+    
+    start = 0
+    for file_times, profile, _, _ in results:
+        profiles[:, :, start:start + len(file_times)] = profile
+        times.extend(file_times)
+        start += len(file_times)
+    
+    coords = {'variable': var_names, 'y': y_indices, 'time_counter': times}
+    if depths is not None:
+        coords[depth_dim] = depths
+    return xr.DataArray(profiles, dims=('variable', 'y', 'time_counter', depth_dim), coords=coords)
+
+
+def moc_y_indices(filepath, latitudes):
+    """
+    Resolve target latitudes to y positions in a MOC file.
+    
+    Parameters
+    ----------
+    filepath : str
+        CDFTOOLS MOC file (with nav_lat)
+    latitudes : dict
+        Mapping of latitude (degrees N) to a y index, or None to use the
+        row whose nav_lat is nearest
+        
+    Returns
+    -------
+    list of int
+        y index for each latitude, in order
+    """
+    if all(y is not None for y in latitudes.values()):
+        return [int(y) for y in latitudes.values()]
+    
+    with netCDF4.Dataset(filepath) as nc:
+        nav_lat = np.ma.filled(nc.variables['nav_lat'][:], np.nan)
+    row_lat = np.nanmean(nav_lat.reshape(nav_lat.shape[0], -1), axis=1)
+    
+    return [int(y) if y is not None else int(np.nanargmin(np.abs(row_lat - lat)))
+            for lat, y in latitudes.items()]
+
+
+def overturning_rows(basins, y_indices):
+    """
+    Variables and y indices to read for the metrics and the AMOC in one pass.
+    
+    The metrics rows come first, in order; the AMOC row (amoc_variable at
+    amoc_y_index) is added only if they don't already include it.
+    
+    Returns
+    -------
+    tuple of list
+        (variable names, y indices) for read_moc_profiles
+    """
+    var_names = list(basins.values())
+    y_indices = list(y_indices)
+    if amoc_variable not in var_names:
+        var_names.append(amoc_variable)
+    if amoc_y_index not in y_indices:
+        y_indices.append(amoc_y_index)
+    return var_names, y_indices
+
+
+def pandas_times(da):
+    """Replace the cftime time_counter of MOC rows with pandas datetimes"""
+    time_pd = pd.to_datetime([pd.Timestamp(t.isoformat()) for t in da.time_counter.values])
+    return da.assign_coords(time_counter=time_pd)
+
+
+def amoc_from_rows(moc):
+    """
+    AMOC timeseries from MOC rows: the maximum over depth of amoc_variable at amoc_y_index.
+    
+    Parameters
+    ----------
+    moc : xr.DataArray
+        Rows with dims (variable, y, ..., time_counter, depth), from
+        read_moc_profiles or read_ensemble_moc
+        
+    Returns
+    -------
+    xr.DataArray
+        AMOC with dims (..., time_counter)
+    """
+    atl_at_26 = moc.isel(variable=list(moc['variable'].values).index(amoc_variable),
+                         y=list(moc['y'].values).index(amoc_y_index), drop=True)
+    max_atl = atl_at_26.max(dim=moc.dims[-1])
+    max_atl.name = 'AMOC'
+    return pandas_times(max_atl)
+
+
+def metrics_from_rows(moc, basins, latitudes, y_indices, depth_band=(500, 2000), rolling_years=10):
+    """
+    Overturning metrics from MOC rows read with overturning_rows(basins, y_indices).
+    
+    Returns
+    -------
+    xr.Dataset
+        The metrics (see overturning_metrics)
+    """
+    moc = moc.isel(variable=slice(0, len(basins)), y=slice(0, len(y_indices)))
+    moc = moc.rename({'variable': 'basin', 'y': 'latitude'})
+    moc = moc.assign_coords(basin=list(basins), latitude=list(latitudes), y_index=('latitude', list(y_indices)))
+    return overturning_metrics(pandas_times(moc), depth_band, rolling_years)
+
+
+def overturning_metrics(moc, depth_band=(500, 2000), rolling_years=10):
+    """
+    Overturning statistics per latitude and basin from MOC profiles.
+    
+    Parameters
+    ----------
+    moc : xr.DataArray
+        Overturning with dims (basin, latitude, time_counter, depth)
+    depth_band : tuple of float, optional
+        Depth range (m) for the band mean, averaged over the levels inside it
+        (compared with the absolute depths, so negative depths work too)
+    rolling_years : int, optional
+        Window (years) of the centred rolling mean of the annual values
+        
+    Returns
+    -------
+    xr.Dataset
+        moc_max, moc_depth_of_max and moc_band_mean (basin, latitude,
+        time_counter), their annual means (*_annual, dims basin, latitude,
+        year) and rolling means of those (*_rolling)
+    """
+    depth_dim = moc.dims[-1]
+    if depth_dim not in moc.coords:
+        print(f"  Warning: {depth_dim} has no depth values, using level indices as depths")
+        moc = moc.assign_coords({depth_dim: np.arange(moc.sizes[depth_dim])})
+    depths = abs(moc[depth_dim])
+    
+    metrics = xr.Dataset()
+    metrics['moc_max'] = moc.max(depth_dim)
+    metrics['moc_depth_of_max'] = moc.fillna(-np.inf).idxmax(depth_dim).where(metrics['moc_max'].notnull())
+    in_band = (depths >= depth_band[0]) & (depths <= depth_band[1])
+    if not in_band.any():
+        print(f"  Warning: no {depth_dim} level lies in {depth_band[0]}-{depth_band[1]} m "
+              f"(levels at {float(depths.min()):g}-{float(depths.max()):g}), moc_band_mean is all NaN")
+    metrics['moc_band_mean'] = moc.where(in_band).mean(depth_dim)
+    
+    for var in list(metrics.data_vars):
+        annual = metrics[var].groupby('time_counter.year').mean('time_counter')
+        metrics[f'{var}_annual'] = annual
+        metrics[f'{var}_rolling'] = annual.rolling(year=rolling_years, center=True, min_periods=1).mean()
+    
+    metrics['moc_max'].attrs['description'] = 'Maximum overturning over depth'
+    metrics['moc_depth_of_max'].attrs['description'] = 'Depth of the maximum overturning'
+    metrics['moc_band_mean'].attrs['description'] = f'Mean overturning over {depth_band[0]}-{depth_band[1]} m'
+    return metrics
+
+
+def save_moc_metrics(metrics, model, yrst, yrend, basins, output_dir):
+    """Add metadata to overturning metrics and save them as <model>_MOC_metrics_<yrst>_<yrend>.nc"""
+    metrics.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/get_AMOC.py'
+    metrics.attrs['source_years'] = f'{yrst}-{yrend}'
+    metrics.attrs['source_model'] = model
+    metrics.attrs['basin_variables'] = ', '.join(f'{b}: {v}' for b, v in basins.items())
+    
+    output_file = Path(output_dir) / f'{model}_MOC_metrics_{yrst}_{yrend}.nc'
+    with instrument.stage('write'):
+        metrics.to_netcdf(output_file, encoding=netcdf_encoding(metrics))
+    print(f"  Saved to {output_file}")
+
+
+def save_amoc(max_atl, model, yrst, yrend, output_dir):
+    """Add metadata to an AMOC timeseries and save it as <model>_AMOC_<yrst>_<yrend>.nc"""
+    amoc_ds = max_atl.to_dataset()
+    amoc_ds.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/get_AMOC.py'
+    amoc_ds.attrs['source_years'] = f'{yrst}-{yrend}'
+    amoc_ds.attrs['source_model'] = model
+    amoc_ds.attrs['description'] = 'Maximum Atlantic overturning at 26°N'
+    
+    output_file = Path(output_dir) / f'{model}_AMOC_{yrst}_{yrend}.nc'
+    with instrument.stage('write'):
+        amoc_ds.to_netcdf(output_file, encoding=netcdf_encoding(amoc_ds))
+    print(f"  Saved to {output_file}")
+
+
+def compute_moc_metrics(model, yrst, yrend, baseDir, clims_dir, basins, latitudes,
+                        depth_band=(500, 2000), rolling_years=10, n_readers=1):
+    """
+    Overturning metrics for several latitudes and basins from one read per file.
+    
+    Parameters
+    ----------
+    model : str
+        Model name (e.g., 'TOM12_TJ_LA50')
+    yrst : int
+        Start year
+    yrend : int
+        End year
+    baseDir : str
+        Directory containing MOC result files
+    clims_dir : str
+        Directory to save outputs
+    basins : dict
+        Mapping of basin name to MOC variable, e.g. {'atl': 'zomsfatl'}
+    latitudes : dict
+        Mapping of latitude (degrees N) to y index, or None to look it up
+        from nav_lat (see moc_y_indices)
+    depth_band : tuple of float, optional
+        Depth range (m) for the band mean
+    rolling_years : int, optional
+        Window (years) of the rolling mean
+    n_readers : int, optional
+        Number of processes reading MOC files
+        
+    Returns
+    -------
+    xr.Dataset or None
+        The metrics (see overturning_metrics), or None if processing failed
+    """
+    output_dir = Path(clims_dir) / model
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    print(f"Processing overturning metrics for {model}")
+    
+    file_list = [str(f) for f in catalog.files_by_year(baseDir, 'MOC', model, range(yrst, yrend + 1)).values()]
+    
+    if not file_list:
+        print(f"  No files found for {model}")
+        return None
+    
+    try:
+        y_indices = moc_y_indices(file_list[0], latitudes)
+        moc = read_moc_profiles(file_list, basins.values(), y_indices, n_readers)
+        metrics = metrics_from_rows(moc, basins, latitudes, y_indices, depth_band, rolling_years)
+        save_moc_metrics(metrics, model, yrst, yrend, basins, output_dir)
+        return metrics
+    
+    except Exception as e:
+        print(f"  ERROR processing {model}: {e}")
+        return None
+
+
+def compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir, n_readers=1):
     """
     Compute AMOC timeseries as maximum overturning at 26°N in the Atlantic.
     
@@ -28,6 +375,8 @@ def compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir):
         Directory containing MOC result files
     clims_dir : str
         Directory to save AMOC timeseries outputs
+    n_readers : int, optional
+        Number of processes reading MOC files
     
     Returns:
     --------
@@ -42,15 +391,8 @@ def compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir):
     print(f"Processing AMOC for {model}")
     print(f"  Years: {yrst} to {yrend}")
     
-    # Build file list
-    yrs = np.arange(yrst, yrend + 1, 1)
-    file_list = []
-    
-    for yr in yrs:
-        pattern = f'{baseDir}{model}_1m_{yr}0101*MOC.nc'
-        matching_files = glob.glob(pattern)
-        if matching_files:
-            file_list.append(matching_files[0])
+    # Build file list (the MOC directory is listed once for all models, see catalog.py)
+    file_list = [str(f) for f in catalog.files_by_year(baseDir, 'MOC', model, range(yrst, yrend + 1)).values()]
     
     if not file_list:
         print(f"  No files found for {model}")
@@ -59,34 +401,14 @@ def compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir):
     print(f"  Found {len(file_list)} files")
     
     try:
-        # Open all MOC files
-        moc_dataset = xr.open_mfdataset(file_list)
-        
-        # Extract Atlantic overturning at 26°N (y=94)
-        atl_at_26 = moc_dataset.zomsfatl.sel(y=94).squeeze()
-        
-        # Calculate max along the depth dimension
-        depth_dim = [d for d in atl_at_26.dims if d != 'time_counter'][0]
-        max_atl = atl_at_26.max(dim=depth_dim)
+        # Read only the Atlantic overturning at 26°N (y=94) from each file
+        moc = read_moc_profiles(file_list, [amoc_variable], [amoc_y_index], n_readers)
         
-        # Rename to AMOC
-        max_atl.name = 'AMOC'
+        # Max along the depth dimension, as 'AMOC' with pandas times
+        max_atl = amoc_from_rows(moc)
         
-        # Convert cftime to pandas datetime
-        time_pd = pd.to_datetime([pd.Timestamp(t.isoformat()) for t in max_atl.time_counter.values])
-        max_atl = max_atl.assign_coords(time_counter=time_pd)
-        
-        # Convert to dataset and add metadata
-        amoc_ds = max_atl.to_dataset()
-        amoc_ds.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/get_AMOC.py'
-        amoc_ds.attrs['source_years'] = f'{yrst}-{yrend}'
-        amoc_ds.attrs['source_model'] = model
-        amoc_ds.attrs['description'] = 'Maximum Atlantic overturning at 26°N'
-        
-        # Save to output directory
-        output_file = output_dir / f'{model}_AMOC_{yrst}_{yrend}.nc'
-        amoc_ds.to_netcdf(output_file)
-        print(f"  Saved to {output_file}")
+        # Convert to dataset, add metadata and save
+        save_amoc(max_atl, model, yrst, yrend, output_dir)
         
         return max_atl
         
@@ -95,59 +417,203 @@ def compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir):
         return None
 
 
-def read_models_from_file(filepath):
+def compute_overturning(model, yrst, yrend, baseDir, clims_dir, basins, latitudes,
+                        depth_band=(500, 2000), rolling_years=10, n_readers=1):
     """
-    Read model names from a text file (one per line).
+    AMOC timeseries and overturning metrics from one read per MOC file.
+    
+    The rows of every basin and latitude (see overturning_rows) are read in
+    one pass; the AMOC comes from its row of that read. Writes the files of
+    compute_amoc_timeseries() and compute_moc_metrics(), and takes the same
+    parameters. The AMOC doesn't depend on the metrics: if their rows can't
+    be read (e.g. a missing basin variable or nav_lat) it is read on its own
+    with compute_amoc_timeseries(), and if they fail it is still written.
     
-    Parameters
-    ----------
-    filepath : str or Path
-        Path to text file containing model names
-        
     Returns
     -------
-    list of str
-        List of model names
+    tuple or None
+        (AMOC timeseries, metrics or None), or None if the AMOC failed
     """
-    models = []
+    output_dir = Path(clims_dir) / model
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    print(f"Processing AMOC and overturning metrics for {model}")
+    print(f"  Years: {yrst} to {yrend}")
+    
+    file_list = [str(f) for f in catalog.files_by_year(baseDir, 'MOC', model, range(yrst, yrend + 1)).values()]
+    
+    if not file_list:
+        print(f"  No files found for {model}")
+        return None
+    
+    print(f"  Found {len(file_list)} files")
+    
+    try:
+        y_indices = moc_y_indices(file_list[0], latitudes)
+        moc = read_moc_profiles(file_list, *overturning_rows(basins, y_indices), n_readers)
+    except Exception as e:
+        print(f"  Overturning metrics skipped, reading the AMOC row only: {e}")
+        max_atl = compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir, n_readers)
+        return None if max_atl is None else (max_atl, None)
+    
     try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if line and not line.startswith('#'):
-                    models.append(line)
-        print(f"Loaded {len(models)} models from {filepath}")
-        return models
-    except FileNotFoundError:
-        print(f"ERROR: Models file not found: {filepath}")
-        return []
+        max_atl = amoc_from_rows(moc)
+        save_amoc(max_atl, model, yrst, yrend, output_dir)
+    except Exception as e:
+        print(f"  ERROR processing {model}: {e}")
+        return None
+    
+    try:
+        metrics = metrics_from_rows(moc, basins, latitudes, y_indices, depth_band, rolling_years)
+        save_moc_metrics(metrics, model, yrst, yrend, basins, output_dir)
+    except Exception as e:
+        print(f"  ERROR computing the overturning metrics of {model}: {e}")
+        metrics = None
+    return max_atl, metrics
+
+
+def read_ensemble_moc(models, yrst, yrend, baseDir, var_names, y_indices, n_readers=1):
+    """
+    Latitude rows of overturning variables for every model, from one pool of reads.
+    
+    Only the years every model has are read (see ensemble.ensemble_files).
+    
+    Returns
+    -------
+    xr.DataArray or None
+        Overturning with dims (variable, y, model, time_counter, depth), or
+        None if no year has a MOC file for every model
+    """
+    files = ensemble.ensemble_files({m: baseDir for m in models}, 'MOC', models=models, years=range(yrst, yrend + 1))
+    if not files:
+        return None
+    print(f"  Found {len(files)} common years from {min(files)} to {max(files)}")
+    
+    # Model after model, so the time axis splits into (model, time)
+    file_list = [str(paths[i]) for i in range(len(models)) for paths in files.values()]
+    moc = read_moc_profiles(file_list, var_names, y_indices, n_readers)
+    
+    n_time = moc.sizes['time_counter'] // len(models)
+    values = moc.values.reshape(moc.shape[:2] + (len(models), n_time) + moc.shape[3:])
+    coords = {k: v for k, v in moc.coords.items() if k != 'time_counter'}
+    coords.update(model=list(models), time_counter=moc.time_counter.values[:n_time])
+    return xr.DataArray(values, dims=moc.dims[:2] + ('model',) + moc.dims[2:], coords=coords)
+
+
+def compute_ensemble_amoc(models, yrst, yrend, baseDir, clims_dir, n_readers=1):
+    """
+    AMOC timeseries (and overturning metrics) of every model at once.
+    
+    The MOC rows of all models (for the AMOC and, with moc_metrics, every
+    basin and latitude) are read in one pass by one pool and reduced
+    together along a 'model' dim. Each model's files are written as by
+    compute_amoc_timeseries() and compute_moc_metrics(), plus the ensemble
+    files with the 'model' dim under clims_dir/ENSEMBLE/.
+    
+    Returns
+    -------
+    xr.DataArray or None
+        AMOC with dims (model, time_counter), or None if processing failed
+    """
+    print(f"Processing AMOC for {len(models)} models")
+    print(f"  Years: {yrst} to {yrend}")
+    
+    try:
+        y_indices = None
+        if moc_metrics:
+            # The y index of each latitude comes from the first model's first file
+            first = ensemble.ensemble_files({models[0]: baseDir}, 'MOC', models=models[:1],
+                                            years=range(yrst, yrend + 1))
+            if not first:
+                print("  No years with MOC files for every model")
+                return None
+            try:
+                y_indices = moc_y_indices(str(next(iter(first.values()))[0]), moc_latitudes)
+                moc = read_ensemble_moc(models, yrst, yrend, baseDir, *overturning_rows(moc_basins, y_indices),
+                                        n_readers)
+            except Exception as e:
+                # The AMOC doesn't need the other basins or nav_lat
+                print(f"  Overturning metrics skipped, reading the AMOC rows only: {e}")
+                y_indices = None
+        
+        if y_indices is None:
+            moc = read_ensemble_moc(models, yrst, yrend, baseDir, [amoc_variable], [amoc_y_index], n_readers)
+        if moc is None:
+            print("  No years with MOC files for every model")
+            return None
+        
+        max_atl = amoc_from_rows(moc)
+        
+        for model, model_amoc in ensemble.split_models(max_atl).items():
+            output_dir = Path(clims_dir) / model
+            output_dir.mkdir(parents=True, exist_ok=True)
+            save_amoc(model_amoc, model, yrst, yrend, output_dir)
+        save_amoc(max_atl, ensemble.ensemble_name, yrst, yrend, ensemble.ensemble_dir(clims_dir))
+        
+        if y_indices is not None:
+            try:
+                metrics = metrics_from_rows(moc, moc_basins, moc_latitudes, y_indices, moc_depth_band,
+                                            moc_rolling_years)
+                for model, model_metrics in ensemble.split_models(metrics).items():
+                    save_moc_metrics(model_metrics, model, yrst, yrend, moc_basins, Path(clims_dir) / model)
+                save_moc_metrics(metrics.transpose('model', ...), ensemble.ensemble_name, yrst, yrend, moc_basins,
+                                 ensemble.ensemble_dir(clims_dir))
+            except Exception as e:
+                print(f"  ERROR computing the overturning metrics: {e}")
+        
+        return max_atl
+    
+    except Exception as e:
+        print(f"  ERROR processing the ensemble: {e}")
+        return None
+
+
+def amoc_unit(model, yrst, yrend, readers=None):
+    """Work unit for run_units: compute one model's AMOC timeseries (and overturning metrics)"""
+    readers = n_readers if readers is None else readers
+    with instrument.unit(model=model):
+        if moc_metrics:
+            # One read per MOC file for the AMOC and the metrics
+            result = compute_overturning(model, yrst, yrend, baseDir, clims_dir, moc_basins, moc_latitudes,
+                                         moc_depth_band, moc_rolling_years, readers)
+        else:
+            result = compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir, readers)
+    return result is not None
 
 
 # ===== RUN =====
 
-# Read models from file
-models = read_models_from_file(models_file)
+def main():
+    """Compute the AMOC timeseries (and overturning metrics) of every model in models_file"""
+    # Read models from file
+    models = read_models_from_file(models_file)
 
-if not models:
-    print("No models to process. Exiting.")
-    exit(1)
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
 
-# Define year range
-yrst = 1940
-yrend = 2024
+    if ensemble_mode:
+        # All models at once; the MOC files are read by n_readers processes
+        with instrument.unit(model=ensemble.ensemble_name):
+            compute_ensemble_amoc(models, yrst, yrend, baseDir, clims_dir, n_readers)
+        instrument.print_summary()
+        return
+
+    # Run every model unit; with several model workers each reads its files
+    # serially rather than starting a pool of readers of its own
+    workers = min(n_workers, len(models))
+    readers = n_readers if workers <= 1 else 1
+    print(f"Processing models: {', '.join(models)} with {workers} worker(s) x {readers} reader(s)")
+
+    units = [(model, yrst, yrend, readers) for model in models]
+    run_units(amoc_unit, units, workers, error_format='ERROR processing {0}: {e}')
+
+    instrument.print_summary()
 
-# Loop over models
-for model in models:
     print(f"\n{'='*60}")
-    print(f"Processing model: {model}")
+    print("All processing complete!")
     print(f"{'='*60}")
-    
-    try:
-        result = compute_amoc_timeseries(model, yrst, yrend, baseDir, clims_dir)
-    except Exception as e:
-        print(f"ERROR processing {model}: {e}")
 
-print(f"\n{'='*60}")
-print("All processing complete!")
-print(f"{'='*60}")
+
+if __name__ == '__main__':
+    main()
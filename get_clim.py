@@ -1,9 +1,18 @@
 import xarray as xr
 import numpy as np
-import glob
-import os
+import pandas as pd
 from pathlib import Path
 
+import cftime
+
+import backend
+import catalog
+import ensemble
+import instrument
+import memory_budget
+from cli import read_models_from_file
+from executor import default_workers, run_units
+
 # ===== INPUTS =====
 # Define year range
 yrst = 2010
@@ -12,9 +21,13 @@ yrend = 2019
 runs_dir = '/gpfs/data/greenocean/software/runs/'
 clims_dir = '/gpfs/data/greenocean/users/mep22dku/clims/'
 models_file = 'models.txt'  # Path to text file containing model names
+n_workers = default_workers()  # Processes for (model, filetype) units; 1 runs serially
+streaming = False  # Read one year at a time (flat memory) instead of open_mfdataset (eager backend only)
+with_std = False   # With streaming, also write the monthly standard deviation ({var}_std)
+ensemble_mode = False  # All models at once, one year at a time stacked along a 'model' dim (streams; see ensemble.py)
 
 # ===== FUNCTION =====
-def compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir):
+def compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir, streaming=False, with_std=False):
     """
     Compute monthly climatology for a model and file type across specified years.
     
@@ -32,6 +45,11 @@ def compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir):
         Directory containing model run files
     clims_dir : str
         Directory to save climatology outputs
+    streaming : bool, optional
+        Read the yearly files one at a time with running monthly sums
+        (see streaming_climatology) instead of one open_mfdataset
+    with_std : bool, optional
+        With streaming, add the monthly standard deviation of each variable
     
     Returns:
     --------
@@ -46,15 +64,9 @@ def compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir):
     print(f"Processing {model} - {filetype}")
     print(f"  Years: {yrst} to {yrend}")
     
-    # Build file list
-    yrs = np.arange(yrst, yrend + 1, 1)
-    file_list = []
-    
-    for yr in yrs:
-        pattern = f'{runs_dir}{model}/ORCA2_1m_{yr}*{filetype}*.nc'
-        matching_files = glob.glob(pattern)
-        if matching_files:
-            file_list.append(matching_files[0])
+    # Build file list (one listing of the run directory, see catalog.py)
+    yrs = range(yrst, yrend + 1)
+    file_list = [str(f) for f in catalog.files_by_year(f'{runs_dir}{model}', filetype, years=yrs).values()]
     
     if not file_list:
         print(f"  No files found for {model} {filetype}")
@@ -62,11 +74,20 @@ def compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir):
     
     print(f"  Found {len(file_list)} files")
     
+    if streaming and backend.use_dask():
+        # open_mfdataset is reduced lazily on the cluster, within its workers' memory limits
+        print("  Dask backend: open_mfdataset instead of streaming")
+        streaming = False
+    
     try:
-        # Open all files and compute monthly climatology
-        ds = xr.open_mfdataset(file_list)
-        clim = ds.groupby('time_counter.month').mean('time_counter')
-        clim = clim.rename({'month': 'time'})
+        streaming, batches = climatology_plan(file_list[0], len(file_list), streaming, with_std)
+        if streaming:
+            clim = batched_climatology(file_list, batches, with_std)
+        else:
+            # Open all files and compute monthly climatology
+            ds = backend.open_mfdataset(file_list)
+            clim = ds.groupby('time_counter.month').mean('time_counter')
+            clim = clim.rename({'month': 'time'})
         
         # Add metadata
         clim.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/get_clim.py'
@@ -75,7 +96,7 @@ def compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir):
         
         # Save to output directory
         output_file = output_dir / f'ORCA2_1m_clim_{yrst}_{yrend}_{filetype}.nc'
-        clim.to_netcdf(output_file)
+        backend.write_netcdf(clim, output_file)
         print(f"  Saved to {output_file}")
         
         return clim
@@ -85,59 +106,474 @@ def compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir):
         return None
 
 
-def read_models_from_file(filepath):
+def climatology_memory(sample, with_std=False, n_models=1, time_dim='time_counter'):
     """
-    Read model names from a text file (one per line).
+    Working set of a streaming climatology, per variable, from one yearly file.
     
     Parameters
     ----------
-    filepath : str or Path
-        Path to text file containing model names
+    sample : str or Path
+        One yearly file (only its variable shapes and dtypes are read)
+    with_std : bool, optional
+        Standard deviations are accumulated too
+    n_models : int, optional
+        Models stacked along 'model' (ensemble mode)
+    time_dim : str, optional
+        Name of the time dimension
+    
+    Returns
+    -------
+    sizes : dict
+        Variable -> {'step': one month of input, 'acc': twelve months of
+        accumulators, 'out': the climatology (and std)}, in bytes
+    static : list of str
+        Variables without the time dimension
+    file_bytes : int
+        The time-dependent variables of the whole file (as float64)
+    """
+    # sum (or mean and m2 with std) and a count, float64/int64; counts are shared
+    # by variables with the same NaN pattern, but one per variable is planned for
+    n_acc = 3 if with_std else 2
+    n_out = 2 if with_std else 1
+    sizes, static, file_bytes = {}, [], 0
+    with xr.open_dataset(sample) as ds:
+        steps_per_month = max(ds.sizes.get(time_dim, 12) // 12, 1)
+        for var, da in ds.data_vars.items():
+            if time_dim not in da.dims:
+                static.append(var)
+                continue
+            if not np.issubdtype(da.dtype, np.number):
+                continue
+            field = memory_budget.field_bytes(da.shape, float) * n_models
+            step = field // da.sizes[time_dim]
+            out_dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else float
+            sizes[var] = {'step': step * steps_per_month, 'acc': 12 * step * n_acc,
+                          'out': 12 * step // 8 * np.dtype(out_dtype).itemsize * n_out}
+            file_bytes += field
+    return sizes, static, file_bytes
+
+
+def smallest_climatology_bytes(sample, with_std=False, n_models=1):
+    """Working set of a climatology streamed one variable at a time (the least climatology_plan can do)"""
+    sizes, _, _ = climatology_memory(sample, with_std, n_models)
+    if not sizes:
+        return 0
+    return (sum(s['out'] for s in sizes.values()) + 3 * max(s['step'] for s in sizes.values())
+            + max(s['acc'] for s in sizes.values()))
+
+
+def climatology_plan(sample, n_files, streaming, with_std=False, n_models=1):
+    """
+    How to compute a climatology within the memory budget (see memory_budget.py).
+    
+    open_mfdataset followed by groupby().mean() holds every year of input;
+    when that doesn't fit it is reported, but streaming is only used when
+    requested. Streaming holds twelve months of accumulators per variable;
+    when those don't fit together the variables are split into batches,
+    each streamed in its own pass over the files. Without a budget the
+    request is kept as is.
+    
+    Parameters
+    ----------
+    sample : str or Path
+        One yearly file
+    n_files : int
+        Number of yearly files
+    streaming : bool
+        Streaming was requested
+    with_std : bool, optional
+        Standard deviations are accumulated too
+    n_models : int, optional
+        Models stacked along 'model' (ensemble mode)
+    
+    Returns
+    -------
+    streaming : bool
+        Whether to stream
+    batches : list
+        Lists of variables for streaming passes (variables without the time
+        dimension go with the first), or [None] for one pass over all
+    """
+    share = memory_budget.budget()
+    if share is None or (backend.use_dask() and not streaming):
+        return streaming, [None]
+    
+    sizes, static, file_bytes = climatology_memory(sample, with_std, n_models)
+    whole = file_bytes * n_files
+    fmt = memory_budget.format_size
+    if not streaming:
+        if whole <= share:
+            memory_budget.report('get_clim', f"open_mfdataset, ~{fmt(whole)} of {fmt(share)}", streaming=False)
+            return False, [None]
+        memory_budget.report('get_clim', f"~{fmt(whole)} of input for open_mfdataset exceeds {fmt(share)}, "
+                                         "memory may run over (streaming = True reads one year at a time)", streaming=False, fits=False)
+        return False, [None]
+    if not sizes:
+        return True, [None]
+    
+    # Every pass keeps its climatology until the file is written; the rest is for accumulators
+    out = sum(s['out'] for s in sizes.values())
+    free = share - out - 3 * max(s['step'] for s in sizes.values())
+    batches, used = [list(static)], 0
+    for var, s in sizes.items():
+        if used and used + s['acc'] > free:
+            batches.append([])
+            used = 0
+        batches[-1].append(var)
+        used += s['acc']
+    
+    if len(batches) == 1:
+        text = f"streaming in one pass, ~{fmt(share - free + used)} of {fmt(share)}"
+        batches = [None]
+    else:
+        text = f"streaming in {len(batches)} passes over the files ({len(sizes)} variables)"
+    if free <= 0:
+        text += f"; the climatology alone (~{fmt(out)}) exceeds {fmt(share)}, memory may run over"
+    elif max(s['acc'] for s in sizes.values()) > free:
+        text += f"; one variable's accumulators exceed the {fmt(free)} left, memory may run over"
+    memory_budget.report('get_clim', text, streaming=True, passes=len(batches))
+    return True, batches
+
+
+def batched_climatology(file_list, batches, with_std=False, opener=None):
+    """Streaming climatology in one pass over the files per batch of variables (see climatology_plan)"""
+    if batches == [None]:
+        return streaming_climatology(file_list, with_std, opener=opener)
+    
+    clims = []
+    for i, batch in enumerate(batches):
+        print(f"  Pass {i + 1}/{len(batches)}: {', '.join(batch)}")
+        clims.append(streaming_climatology(file_list, with_std, opener=opener, variables=batch))
+    return xr.merge(clims, compat='override', join='override', combine_attrs='override')
+
+
+def streaming_climatology(file_list, with_std=False, time_dim='time_counter', opener=None, variables=None):
+    """
+    Monthly climatology from yearly files, reading one file at a time.
+    
+    Per-month running sums and counts of non-NaN values are updated from
+    each file, so memory stays at one month of input plus twelve months of
+    accumulators however many years are used. The means match
+    groupby('time_counter.month').mean(): NaNs are skipped and months with
+    no valid values are NaN. With with_std, the per-month mean and sum of
+    squared deviations are combined across years instead of the sum
+    (Welford/Chan update) to give the population standard deviation as
+    {var}_std. Variables with the same NaN pattern share one count array
+    (see _update_count).
+    
+    Variables without the time dimension are repeated for every month, as
+    open_mfdataset does when it concatenates them. Times (e.g. the
+    time_counter bounds) are averaged as nanoseconds after their first value
+    and converted back, as .mean() does; other non-numeric variables are
+    left out.
+    
+    Parameters
+    ----------
+    file_list : list of str
+        Yearly files in time order
+    with_std : bool, optional
+        Also compute the monthly standard deviation
+    time_dim : str, optional
+        Name of the time dimension
+    opener : callable, optional
+        opener(item, variables) opens one item of file_list as a dataset
+        (default backend.open_dataset); e.g. one year of every model stacked
+        along 'model' (see ensemble.py)
+    variables : list of str, optional
+        Variables to include (default all), e.g. one batch of a
+        memory-budgeted climatology (see climatology_plan)
         
     Returns
     -------
-    list of str
-        List of model names
+    xr.Dataset
+        Climatology with a 'time' (month) dimension
+    """
+    acc = {}
+    templates = {}
+    time_refs = {}  # time variable -> reference its values are averaged relative to
+    static = {}
+    fresh_counts = {}  # shape -> count group started at the current step, open to new variables
+    months_seen = set()
+    
+    for i, filepath in enumerate(file_list):
+        # Both openers time themselves as the 'open' stage
+        ds = opener(filepath, variables) if opener else backend.open_dataset(filepath)
+        with ds:
+            months = ds[time_dim].dt.month.values
+            names = []
+            for var in ds.data_vars:
+                if variables is not None and var not in variables:
+                    continue
+                da = ds[var]
+                if time_dim not in da.dims:
+                    if var not in static:
+                        static[var] = da.load()
+                    continue
+                is_time = _is_time(da)
+                if not is_time and not np.issubdtype(da.dtype, np.number):
+                    continue
+                
+                if var not in acc:
+                    da = da.transpose(time_dim, ...)
+                    shape = (12,) + da.shape[1:]
+                    acc[var] = ({'mean': np.zeros(shape), 'm2': np.zeros(shape)} if with_std and not is_time
+                                else {'sum': np.zeros(shape)})
+                    templates[var] = da.isel({time_dim: 0}, drop=True)
+                    if is_time:
+                        values = da.values.ravel()
+                        time_refs[var] = values[~pd.isnull(values)][0]
+                names.append(var)
+            
+            # Month by month, every variable: the variables of a count group see each step together
+            for month in np.unique(months):
+                m = month - 1
+                step = (i, m)
+                months_seen.add(int(month))
+                for var in names:
+                    a = acc[var]
+                    with instrument.stage('load'):
+                        da = ds[var].transpose(time_dim, ...)
+                        x = da.isel({time_dim: np.nonzero(months == month)[0]}).values
+                        x = _time_offsets(x, time_refs[var]) if var in time_refs else x.astype(float)
+                    with instrument.stage('compute'):
+                        valid = ~np.isnan(x)
+                        x[~valid] = 0
+                        n_b = valid.sum(axis=0)
+                        sum_b = x.sum(axis=0)
+                        
+                        if 'count' not in a:
+                            group = fresh_counts.get(x.shape[1:])
+                            if group is None or group['created'] != step:
+                                group = {'count': np.zeros((12,) + x.shape[1:], dtype=np.int64),
+                                         'created': step, 'step': None, 'increment': None}
+                                fresh_counts[x.shape[1:]] = group
+                            a['count'] = group
+                        n_a = _update_count(a, m, n_b, step)
+                        
+                        if 'm2' in a:
+                            with np.errstate(invalid='ignore', divide='ignore'):
+                                mean_b = np.where(n_b > 0, sum_b / n_b, 0)
+                                m2_b = (np.where(valid, x - mean_b, 0) ** 2).sum(axis=0)
+                                n = n_a + n_b
+                                delta = mean_b - a['mean'][m]
+                                frac = np.where(n > 0, n_b / n, 0)
+                                a['m2'][m] += m2_b + delta ** 2 * n_a * frac
+                                a['mean'][m] += delta * frac
+                        else:
+                            a['sum'][m] += sum_b
+    
+    months = sorted(months_seen)
+    index = [m - 1 for m in months]
+    clim = xr.Dataset()
+    
+    for var, a in acc.items():
+        template = templates[var]
+        dims = ('time',) + template.dims
+        coords = {c: v for c, v in template.coords.items()}
+        count = a['count']['count'][index]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if 'm2' in a:
+                mean = np.where(count > 0, a['mean'][index], np.nan)
+            else:
+                mean = np.where(count > 0, a['sum'][index] / count, np.nan)
+        if var in time_refs:
+            clim[var] = xr.DataArray(_offset_times(mean, time_refs[var]), dims=dims, coords=coords, attrs=template.attrs)
+            continue
+        dtype = template.dtype if np.issubdtype(template.dtype, np.floating) else float
+        clim[var] = xr.DataArray(mean.astype(dtype), dims=dims, coords=coords, attrs=template.attrs)
+        if with_std:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                std = np.where(count > 0, np.sqrt(a['m2'][index] / count), np.nan)
+            clim[f'{var}_std'] = xr.DataArray(std.astype(dtype), dims=dims, coords=coords)
+    
+    for var, da in static.items():
+        clim[var] = da.expand_dims(time=len(months))
+    
+    clim = clim.assign_coords(time=months)
+    return clim
+
+
+def _is_time(da):
+    """Whether a variable holds times (datetime64, or cftime objects for non-standard calendars)"""
+    if np.issubdtype(da.dtype, np.datetime64):
+        return True
+    if da.dtype != object or da.size == 0:
+        return False
+    return isinstance(da.isel({d: 0 for d in da.dims}).values.item(), cftime.datetime)
+
+
+def _time_offsets(values, reference):
+    """Times as float nanoseconds after reference, NaN where missing"""
+    missing = pd.isnull(values)
+    deltas = np.where(missing, reference, values) - reference
+    offsets = np.asarray(deltas).astype('timedelta64[ns]').astype(np.int64).astype(float)
+    offsets[missing] = np.nan
+    return offsets
+
+
+def _offset_times(offsets, reference):
+    """Inverse of _time_offsets: times at float nanoseconds after reference, NaT (None) where NaN"""
+    missing = np.isnan(offsets)
+    deltas = np.round(np.where(missing, 0, offsets)).astype(np.int64).astype('timedelta64[ns]')
+    if isinstance(reference, np.datetime64):
+        times = reference.astype('datetime64[ns]') + deltas
+        times[missing] = np.datetime64('NaT')
+        return times
+    times = np.array([reference + delta for delta in pd.to_timedelta(deltas.ravel()).to_pytimedelta()], dtype=object)
+    times[missing.ravel()] = None
+    return times.reshape(offsets.shape)
+
+
+def _update_count(a, m, n_b, step):
+    """
+    Add one block's valid counts to a variable's (shared) count of month m.
+    
+    Variables with the same NaN pattern share a count group: the first of
+    them to reach a step adds its counts, the others check theirs are the
+    same. A variable whose counts differ gets its own copy of the group
+    from then on.
+    
+    Parameters
+    ----------
+    a : dict
+        Accumulators of the variable; a['count'] is its count group
+        ({'count': (12, ...) int64, 'step', 'increment'})
+    m : int
+        Month index (0-11)
+    n_b : np.ndarray
+        Valid values per cell in this block
+    step : tuple
+        (file index, month index) of the block
+    
+    Returns
+    -------
+    np.ndarray
+        The variable's count of month m before this block
     """
-    models = []
+    group = a['count']
+    if group['step'] != step:
+        n_a = group['count'][m].copy()
+        group['count'][m] += n_b
+        group['step'], group['increment'] = step, n_b
+        return n_a
+    
+    n_a = group['count'][m] - group['increment']
+    if not np.array_equal(n_b, group['increment']):
+        own = {'count': group['count'].copy(), 'created': None, 'step': step, 'increment': n_b}
+        own['count'][m] = n_a + n_b
+        a['count'] = own
+    return n_a
+
+
+def compute_ensemble_climatology(models, filetype, yrst, yrend, runs_dir, clims_dir, with_std=False):
+    """
+    Monthly climatologies of every model at once.
+    
+    Each year of all models is opened stacked along 'model' (see
+    ensemble.py) and added to the running monthly sums of
+    streaming_climatology, for the years every model has. Each model's
+    climatology is written as by compute_climatology(), plus the ensemble
+    file with the 'model' dim under clims_dir/ENSEMBLE/.
+    
+    Returns
+    -------
+    xarray.Dataset or None
+        The ensemble climatology, or None if processing failed
+    """
+    print(f"Processing {len(models)} models - {filetype}")
+    print(f"  Years: {yrst} to {yrend}")
+    
+    files = ensemble.ensemble_files({m: f'{runs_dir}{m}' for m in models}, filetype, years=range(yrst, yrend + 1))
+    if not files:
+        print(f"  No years with {filetype} files for every model")
+        return None
+    
+    print(f"  Found {len(files)} common years")
+    
     try:
-        with open(filepath, 'r') as f:
-            for line in f:
-                line = line.strip()
-                # Skip empty lines and comments
-                if line and not line.startswith('#'):
-                    models.append(line)
-        print(f"Loaded {len(models)} models from {filepath}")
-        return models
-    except FileNotFoundError:
-        print(f"ERROR: Models file not found: {filepath}")
-        return []
+        _, batches = climatology_plan(next(iter(files.values()))[0], len(files), True, with_std, len(models))
+        clim = batched_climatology(list(files.values()), batches, with_std,
+                                   opener=lambda paths, variables: ensemble.open_ensemble(paths, models, variables))
+        clim.attrs['made_in'] = '/gpfs/home/mep22dku/scratch/EXTRACT/get_clim.py'
+        clim.attrs['source_years'] = f'{yrst}-{yrend}'
+        
+        name = f'ORCA2_1m_clim_{yrst}_{yrend}_{filetype}.nc'
+        for model, model_clim in ensemble.split_models(clim).items():
+            model_clim.attrs['source_model'] = model
+            output_dir = Path(clims_dir) / model
+            output_dir.mkdir(parents=True, exist_ok=True)
+            backend.write_netcdf(model_clim, output_dir / name)
+            print(f"  Saved to {output_dir / name}")
+        
+        clim.attrs['source_model'] = ', '.join(models)
+        output_file = ensemble.ensemble_dir(clims_dir) / name
+        backend.write_netcdf(clim.transpose('model', ...), output_file)
+        print(f"  Saved to {output_file}")
+        return clim
+    
+    except Exception as e:
+        print(f"  ERROR processing the ensemble - {filetype}: {e}")
+        return None
+
+
+def ensemble_unit(models, filetype):
+    """Work unit for run_units: compute one file type's climatologies for every model together"""
+    with instrument.unit(model=ensemble.ensemble_name, filetype=filetype):
+        return compute_ensemble_climatology(models, filetype, yrst, yrend, runs_dir, clims_dir,
+                                            with_std) is not None
+
+
+def climatology_unit(model, filetype):
+    """Work unit for run_units: compute one climatology without returning it to the parent"""
+    with instrument.unit(model=model, filetype=filetype):
+        return compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir,
+                                   streaming, with_std) is not None
 
 
 # ===== RUN =====
 
-# Read models from file
-models = read_models_from_file(models_file)
+def main():
+    """Compute the ptrc_T and diad_T climatologies of every model in models_file"""
+    # Read models from file
+    models = read_models_from_file(models_file)
 
-if not models:
-    print("No models to process. Exiting.")
-    exit(1)
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
 
-# Define file types to process
-filetypes = ['ptrc_T', 'diad_T']
+    # Define file types to process
+    filetypes = ['ptrc_T', 'diad_T']
+
+    # Run every (model, filetype) unit
+    client = backend.start_cluster()
+    workers = backend.unit_workers(n_workers)
+    if memory_budget.budget() is not None:
+        # As many concurrent units as fit the budget streamed one variable at a time
+        years = range(yrst, yrend + 1)
+        samples = [next(iter(catalog.files_by_year(f'{runs_dir}{models[0]}', ft, years=years).values()), None)
+                   for ft in filetypes]
+        n_models = len(models) if ensemble_mode else 1
+        unit_bytes = [smallest_climatology_bytes(s, with_std, n_models) for s in samples if s is not None]
+        if unit_bytes:
+            n_units = len(filetypes) * (1 if ensemble_mode else len(models))
+            workers = memory_budget.plan_workers('get_clim', max(unit_bytes), min(workers, n_units))
+    print(f"Processing models: {', '.join(models)} with {workers} worker(s)")
+
+    if ensemble_mode:
+        # One unit per file type for all models, stacked along 'model'
+        units = [(models, filetype) for filetype in filetypes]
+        run_units(ensemble_unit, units, workers, error_format='ERROR processing the ensemble - {1}: {e}')
+    else:
+        units = [(model, filetype) for model in models for filetype in filetypes]
+        run_units(climatology_unit, units, workers, error_format='ERROR processing {0} - {1}: {e}')
+    backend.compute_pending()
+
+    instrument.print_summary()
 
-# Loop over models and file types
-for model in models:
     print(f"\n{'='*60}")
-    print(f"Processing model: {model}")
+    print("All processing complete!")
     print(f"{'='*60}")
-    
-    for filetype in filetypes:
-        try:
-            result = compute_climatology(model, filetype, yrst, yrend, runs_dir, clims_dir)
-        except Exception as e:
-            print(f"ERROR processing {model} - {filetype}: {e}")
 
-print(f"\n{'='*60}")
-print("All processing complete!")
-print(f"{'='*60}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+import json
+import os
+import resource
+import socket
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# ===== INPUTS =====
+
+# JSON-lines run report, appended to by every process of a run
+# (EXTRACT_REPORT overrides; an empty value turns instrumentation off)
+report_file = os.environ.get('EXTRACT_REPORT', 'extract_report.jsonl')
+
+# Print a progress line (throughput, ETA) as work units complete
+show_progress = True
+
+# Context of the work unit running in this process (model, year, ...) and
+# the stage totals collected for it, written out when the unit ends
+_context = {}
+_totals = {}
+
+# ===== FUNCTIONS =====
+
+def enabled():
+    """True when a report file is configured"""
+    return bool(report_file)
+
+
+def run_id():
+    """
+    Identifier shared by every process of this run.
+
+    Set in the environment on first use, so pool workers (forked) and
+    dask workers (spawned) write their records under the same run.
+    """
+    if 'EXTRACT_RUN_ID' not in os.environ:
+        os.environ['EXTRACT_RUN_ID'] = f"{time.strftime('%Y%m%dT%H%M%S')}-{socket.gethostname()}-{os.getpid()}"
+    return os.environ['EXTRACT_RUN_ID']
+
+
+def io_bytes():
+    """Bytes read and written by this process so far (Linux /proc/self/io), or None"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process (Linux only; no-op elsewhere)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Peak resident set size in MB, since the last reset_peak_rss() where supported"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def emit(record):
+    """
+    Append one record to the report.
+
+    Each record is a single write of one line in append mode, so records
+    from concurrent processes don't interleave.
+    """
+    if not enabled():
+        return
+    record = {'run': run_id(), 'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time(), **record}
+    with open(report_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def _snapshot():
+    """Wall time, CPU time and I/O counters of this process"""
+    io = io_bytes() or (0, 0)
+    return time.perf_counter(), time.process_time(), io[0], io[1]
+
+
+def _difference(start, end):
+    """Measurements between two snapshots"""
+    return {
+        'wall_s': end[0] - start[0],
+        'cpu_s': end[1] - start[1],
+        'read_mb': (end[2] - start[2]) / 2**20,
+        'written_mb': (end[3] - start[3]) / 2**20,
+    }
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure one stage of the current work unit (e.g. 'open', 'load', 'compute', 'write').
+
+    Inside a unit (see unit()), repeated stages such as per-time-block loads
+    are summed and written as one record per stage when the unit ends, with
+    the unit's peak RSS at the end of the stage. Outside a unit, the stage
+    is written straight away.
+
+    Parameters
+    ----------
+    name : str
+        Stage name
+    """
+    if not enabled():
+        yield
+        return
+
+    start = _snapshot()
+    try:
+        yield
+    finally:
+        measured = _difference(start, _snapshot())
+        peak = peak_rss_mb()
+        if _context:
+            totals = _totals.setdefault(name, defaultdict(float))
+            for key, value in measured.items():
+                totals[key] += value
+            totals['calls'] += 1
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], peak)
+        else:
+            emit({'event': 'stage', 'stage': name, **measured, 'calls': 1, 'peak_rss_mb': peak})
+
+
+@contextmanager
+def unit(**context):
+    """
+    Run a work unit, e.g. unit(model='TOM12_TJ_LA50', year=1990).
+
+    Writes one 'stage' record per stage used within the unit and one
+    'unit' record with its totals, each tagged with the context. The peak
+    RSS is reset when the unit starts, so it is the unit's own peak.
+    """
+    if not enabled() or _context:
+        # Units nested in a unit (e.g. an in-process regrid) count towards the outer one
+        yield
+        return
+
+    _context.clear()
+    _context.update(context)
+    _totals.clear()
+    reset_peak_rss()
+    start = _snapshot()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        peak = peak_rss_mb()
+        for name, totals in _totals.items():
+            emit({'event': 'stage', **_context, 'stage': name, **totals, 'calls': int(totals['calls'])})
+        emit({'event': 'unit', **_context, **_difference(start, _snapshot()), 'peak_rss_mb': peak, 'ok': ok})
+        _context.clear()
+        _totals.clear()
+
+
+def plan(n_units):
+    """
+    Record how many work units a run_units() call will run (used for the ETA).
+
+    run_units() calls made from inside a unit (e.g. parallel file reads
+    within one model) are part of that unit and aren't counted.
+    """
+    if not _context:
+        emit({'event': 'plan', 'n_units': n_units})
+
+
+def format_duration(seconds):
+    """Short human-readable duration, e.g. '2.4 h' or '35 s'"""
+    if seconds >= 3600:
+        return f'{seconds / 3600:.1f} h'
+    if seconds >= 60:
+        return f'{seconds / 60:.1f} min'
+    return f'{seconds:.0f} s'
+
+
+def unit_done(n_done, n_total, started):
+    """Record a completed run_units() unit and print progress, throughput and ETA"""
+    if not enabled() or _context:
+        return
+    emit({'event': 'done'})
+    if show_progress:
+        elapsed = time.time() - started
+        rate = n_done / elapsed * 3600
+        eta = (n_total - n_done) * elapsed / n_done
+        print(f"  [{n_done}/{n_total}] {rate:.1f} units/h, ETA {format_duration(eta)}", flush=True)
+
+
+def read_report(path=None, run=None):
+    """
+    Records of one run from a report file.
+
+    Parameters
+    ----------
+    path : str, optional
+        Report file; defaults to report_file
+    run : str, optional
+        Run id; defaults to the last run in the file
+
+    Returns
+    -------
+    list of dict
+        The run's records
+    """
+    records = []
+    with open(path or report_file, 'r') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # a line cut short by a killed job
+    if not records:
+        return []
+    run = run or records[-1]['run']
+    return [r for r in records if r['run'] == run]
+
+
+def summary(records):
+    """
+    End-of-run summary: time per stage, throughput and ETA.
+
+    Throughput counts completed units that have a year, so for (model, year)
+    units it is years/hour. The ETA covers the units still to run out of
+    those announced with plan().
+
+    Parameters
+    ----------
+    records : list of dict
+        Records of one run (see read_report)
+
+    Returns
+    -------
+    str
+        Summary text
+    """
+    if not records:
+        return 'No instrumentation records'
+
+    units = [r for r in records if r['event'] == 'unit']
+    stages = defaultdict(lambda: defaultdict(float))
+    for r in records:
+        if r['event'] == 'stage':
+            totals = stages[r['stage']]
+            for key in ('wall_s', 'cpu_s', 'read_mb', 'written_mb', 'calls'):
+                totals[key] += r[key]
+            totals['peak_rss_mb'] = max(totals['peak_rss_mb'], r.get('peak_rss_mb') or 0)
+
+    lines = [f"Run {records[0]['run']}"]
+    lines.append(f"{'stage':<16}{'wall s':>10}{'cpu s':>10}{'read MB':>10}{'write MB':>10}{'peak MB':>10}{'calls':>8}")
+    for name, t in sorted(stages.items(), key=lambda item: -item[1]['wall_s']):
+        lines.append(f"{name:<16}{t['wall_s']:10.1f}{t['cpu_s']:10.1f}{t['read_mb']:10.1f}{t['written_mb']:10.1f}"
+                     f"{t['peak_rss_mb']:10.0f}{int(t['calls']):8d}")
+
+    starts = [r['time'] - r['wall_s'] for r in units] + [r['time'] for r in records if r['event'] == 'plan']
+    elapsed = max(r['time'] for r in records) - min(starts or [r['time'] for r in records])
+    n_ok = sum(1 for r in units if r['ok'])
+    lines.append(f"Units: {n_ok} done, {len(units) - n_ok} failed in {format_duration(elapsed)}")
+    if units:
+        peak = max(r['peak_rss_mb'] for r in units)
+        lines.append(f"Peak RSS of a unit: {peak:.0f} MB")
+
+    n_years = sum(1 for r in units if r['ok'] and 'year' in r)
+    if n_years and elapsed > 0:
+        lines.append(f"Throughput: {n_years / elapsed * 3600:.1f} years/hour")
+
+    plans = dict.fromkeys(f"[{r['name']}] {r['text']}" for r in records if r['event'] == 'memory_plan')
+    if plans:
+        lines.append('Memory plans:')
+        lines.extend(f'  {text}' for text in plans)
+
+    n_planned = sum(r['n_units'] for r in records if r['event'] == 'plan')
+    n_done = sum(1 for r in records if r['event'] == 'done')
+    remaining = n_planned - n_done
+    if remaining > 0 and n_done and elapsed > 0:
+        lines.append(f"ETA: {format_duration(remaining * elapsed / n_done)} for {remaining} remaining units")
+    return '\n'.join(lines)
+
+
+def print_summary():
+    """Print the summary of this run's records (end of a script's RUN section)"""
+    if not enabled() or not os.path.exists(report_file):
+        return
+    print(f"\n{summary(read_report(report_file, run_id()))}")
+    print(f"Report: {report_file}")
+
+
+# ===== RUN =====
+
+def main():
+    """Summarise the latest run in the report (also works while it is still running)"""
+    print(summary(read_report()))
+
+
+if __name__ == '__main__':
+    main()
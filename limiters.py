@@ -0,0 +1,205 @@
+import numpy as np
+import xarray as xr
+
+import instrument
+import memory_budget
+
+# PFTs
+pfts = ['dia', 'mix', 'coc', 'pic', 'pha', 'fix']
+
+# Nutrient slots of the limiter stack (Si only exists for diatoms) and their codes
+nutrient_order = ['fe', 'p', 'si', 'n']
+limiter_codes = dict(fe=3, p=4, si=5, n=6)
+nutrient_prefixes = dict(fe='lim3fe', p='lim4po4', si='lim5si', n='lim6din')
+
+# ===== FUNCTIONS =====
+
+def limiter_kernel(stack, ocean):
+    """
+    Limiting value and limiting nutrient for a stack of nutrient limitation terms.
+    
+    Zero and NaN terms never limit. Unused nutrient slots (Si for non-diatoms)
+    must be filled with +inf. Ties go to the first nutrient in nutrient_order.
+    
+    Parameters
+    ----------
+    stack : np.ndarray
+        Limitation terms with shape (pft, nutrient, time, depth, y, x), or
+        (pft, nutrient, time, model, depth, y, x) for an ensemble. Overwritten
+        in place.
+    ocean : np.ndarray
+        Boolean (depth, y, x) ocean mask; LN is NaN on land
+        
+    Returns
+    -------
+    tuple of np.ndarray
+        LV (stack dtype) and LN (float64 codes), each (pft, time, [model,] depth, y, x)
+    """
+    # Zeros and NaNs can't be the limiter
+    np.putmask(stack, (stack == 0) | np.isnan(stack), np.inf)
+    
+    min_idx = stack.argmin(axis=1)
+    lv = np.take_along_axis(stack, min_idx[:, np.newaxis], axis=1)[:, 0]
+    lv[~np.isfinite(lv)] = np.nan
+    
+    # Lookup table from nutrient slot to limiter code, NaN on land
+    codes = np.array([limiter_codes[nutr] for nutr in nutrient_order], dtype=float)
+    ln = codes[min_idx]
+    ln[..., ~ocean] = np.nan
+    
+    return lv, ln
+
+
+def limiter_inputs():
+    """Names of the limphy variables compute_limiters reads"""
+    return [f'{nutrient_prefixes[nutr]}_{pft}' for pft in pfts for nutr in nutrient_order
+            if nutr != 'si' or pft == 'dia']
+
+
+def limiter_memory(shape, dtype):
+    """
+    Working set of compute_limiters for limitation terms of one shape and dtype.
+    
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of one limitation term, (time, [model,] depth, y, x)
+    dtype : np.dtype
+        Its dtype
+        
+    Returns
+    -------
+    fixed : int
+        Bytes of the LV and LN outputs of every PFT
+    step : int
+        Bytes of the limiter stack and kernel temporaries per time step
+    """
+    itemsize = np.dtype(dtype).itemsize
+    cells = int(np.prod(shape[1:], dtype=np.int64))
+    fixed = len(pfts) * int(np.prod(shape, dtype=np.int64)) * (itemsize + 8)
+    # Stack and its zero/NaN masks, then argmin indices, LV and LN per PFT
+    step = cells * (len(pfts) * len(nutrient_order) * (itemsize + 2) + len(pfts) * (8 + itemsize + 8))
+    return fixed, step
+
+
+def smallest_limiter_bytes(limphy_file, n_models=1):
+    """
+    Working set of compute_limiters on a limphy file one time step at a time.
+    
+    With n_models the files of an ensemble are stacked (see ensemble.py),
+    which reads them whole.
+    """
+    with xr.open_dataset(limphy_file) as w:
+        template = w[f'{nutrient_prefixes["fe"]}_{pfts[0]}']
+        fixed, step = limiter_memory(template.shape, template.dtype)
+        stacked = sum(da.nbytes for da in w.data_vars.values()) if n_models > 1 else 0
+    return (fixed + step + stacked) * n_models
+
+
+def compute_limiters(w, tmask, time_block=None):
+    """
+    Compute LV and LN for all PFTs from an open limphy dataset.
+    
+    The limitation terms of all PFTs are stacked into one array per block of
+    time steps and passed through limiter_kernel(), so only time_block steps
+    of the inputs are in memory at once. With dask-backed data the result
+    is lazy instead (see lazy_limiters).
+    
+    Parameters
+    ----------
+    w : xr.Dataset
+        limphy dataset with lim* variables (time, depth, y, x)
+    tmask : xr.DataArray
+        3D (depth, y, x) T-point mask
+    time_block : int, optional
+        Number of time steps per kernel call; by default the most that fit
+        the memory budget (see memory_budget.py), or 1 without one
+        
+    Returns
+    -------
+    xr.Dataset
+        Dataset containing LV and LN variables for each PFT, as written to
+        the LoP_T files
+    """
+    template = w[f'{nutrient_prefixes["fe"]}_{pfts[0]}']
+    time_dim = template.dims[0]
+    ntime = template.sizes[time_dim]
+    varlists = [[f'{nutrient_prefixes[nutr]}_{pft}' for nutr in nutrient_order] for pft in pfts]
+    dtype = np.result_type(*[w[v].dtype for varlist in varlists for v in varlist if v in w])
+    ocean = np.asarray(tmask.values) != 0
+    
+    if any(w[v].chunks for varlist in varlists for v in varlist if v in w):
+        lv_out, ln_out = lazy_limiters(w, varlists, ocean, dtype)
+        return limiter_dataset(w, template, lv_out, ln_out)
+    
+    lv_out = np.empty((len(pfts),) + template.shape, dtype=dtype)
+    ln_out = np.empty((len(pfts),) + template.shape, dtype=float)
+    
+    if time_block is None:
+        fixed, step = limiter_memory(template.shape, dtype)
+        time_block = memory_budget.time_block('limiters', step, ntime, fixed)
+    
+    for t0 in range(0, ntime, time_block):
+        t1 = min(t0 + time_block, ntime)
+        stack = np.full((len(pfts), len(nutrient_order), t1 - t0) + template.shape[1:], np.inf, dtype=dtype)
+        with instrument.stage('load'):
+            for i, varlist in enumerate(varlists):
+                for j, var in enumerate(varlist):
+                    if nutrient_order[j] == 'si' and pfts[i] != 'dia':
+                        continue
+                    stack[i, j] = w[var].isel({time_dim: slice(t0, t1)}).values
+        with instrument.stage('compute'):
+            lv_out[:, t0:t1], ln_out[:, t0:t1] = limiter_kernel(stack, ocean)
+    
+    return limiter_dataset(w, template, lv_out, ln_out)
+
+
+def lazy_limiters(w, varlists, ocean, dtype):
+    """
+    LV and LN of every PFT as lazy dask arrays, for dask-backed limphy data.
+    
+    limiter_kernel() runs on each chunk of time steps; depth, y and x must
+    each be a single chunk (see backend.chunk_policy).
+    
+    Returns
+    -------
+    tuple of list
+        LV and LN DataArrays, one per PFT
+    """
+    lv_out, ln_out = [], []
+    for pft, varlist in zip(pfts, varlists):
+        slots = [j for j, var in enumerate(varlist) if nutrient_order[j] != 'si' or pft == 'dia']
+        terms = [w[varlist[j]] for j in slots]
+        core_dims = terms[0].dims[1:]
+        
+        def block_kernel(*blocks, slots=slots):
+            stack = np.full((1, len(nutrient_order)) + blocks[0].shape, np.inf, dtype=dtype)
+            for j, block in zip(slots, blocks):
+                stack[0, j] = block
+            lv, ln = limiter_kernel(stack, ocean)
+            return lv[0], ln[0]
+        
+        lv, ln = xr.apply_ufunc(
+            block_kernel, *terms,
+            input_core_dims=[core_dims] * len(terms), output_core_dims=[core_dims, core_dims],
+            dask='parallelized', output_dtypes=[dtype, float],
+        )
+        lv_out.append(lv.data)
+        ln_out.append(ln.data)
+    return lv_out, ln_out
+
+
+def limiter_dataset(w, template, lv_out, ln_out):
+    """Build the LoP_T dataset from per-PFT LV and LN arrays"""
+    # Fresh arrays (no attrs or source encoding), then subset like w[outvars]
+    w = w.copy()
+    outvars = []
+    for i, pft in enumerate(pfts):
+        lv_name, ln_name = f'LV_{pft.upper()}', f'LN_{pft.upper()}'
+        w[lv_name] = xr.DataArray(lv_out[i], dims=template.dims, coords=template.coords)
+        w[ln_name] = xr.DataArray(ln_out[i], dims=template.dims, coords=template.coords)
+        outvars.extend([lv_name, ln_name])
+    
+    output_ds = w[outvars]
+    output_ds.attrs['limiter_codes'] = "3 = Fe, 4 = P, 5 = Si, 6 = N"
+    return output_ds
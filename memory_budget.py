@@ -0,0 +1,145 @@
+import os
+import re
+
+import numpy as np
+
+import instrument
+
+# ===== INPUTS =====
+
+# Memory budget of the whole job (all worker processes together), e.g. '28G'
+# (cli.py --max-memory or EXTRACT_MAX_MEMORY). Only an explicit budget turns
+# planning on; None plans nothing and keeps the defaults
+max_memory = os.environ.get('EXTRACT_MAX_MEMORY') or None
+
+# Share of the budget the plans fill; the rest is for the interpreter, libraries,
+# memory-mapped masks and allocator overhead
+usable_fraction = 0.75
+
+# Worker processes sharing the budget (set by plan_workers, inherited by forked workers)
+_workers = 1
+
+# Plans already reported by this process, so per-unit plans are printed once
+_reported = set()
+
+# ===== FUNCTIONS =====
+
+def parse_size(size):
+    """
+    Bytes in a memory size such as '32G', '28GB', '1.5T' or '512M' (plain numbers are bytes).
+
+    Raises
+    ------
+    ValueError
+        If the size can't be read
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    m = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(size), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Can't read memory size '{size}' (e.g. 32G, 512M)")
+    return int(float(m[1]) * 1024 ** 'BKMGT'.index(m[2].upper() or 'B'))
+
+
+def format_size(n_bytes):
+    """Short human-readable size, e.g. '3.2 GB'"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n_bytes) < 1024:
+            return f'{n_bytes:.1f} {unit}' if unit != 'B' else f'{n_bytes:.0f} B'
+        n_bytes /= 1024
+    return f'{n_bytes:.1f} TB'
+
+
+def budget():
+    """Bytes one worker process may plan for, or None without a budget"""
+    if not max_memory:
+        return None
+    return parse_size(max_memory) * usable_fraction / _workers
+
+
+def field_bytes(shape, dtype):
+    """Size of an array of this shape and dtype"""
+    return int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+
+
+def report(name, text, **plan):
+    """Print a plan (once per process) and record it in the run report"""
+    if (name, text) in _reported:
+        return
+    _reported.add((name, text))
+    print(f"  Memory plan [{name}]: {text}", flush=True)
+    instrument.emit({'event': 'memory_plan', 'name': name, 'text': text, 'budget_bytes': budget(), **plan})
+
+
+def plan_workers(name, unit_bytes, n_workers):
+    """
+    Most worker processes, up to n_workers, whose units fit the budget together.
+
+    Later plans in this process and its (forked) workers divide the budget
+    by the number returned.
+
+    Parameters
+    ----------
+    name : str
+        What is planned (for the report)
+    unit_bytes : int
+        Smallest working set of one unit (e.g. one time step at a time);
+        0 when unknown, so the workers only share the budget
+    n_workers : int
+        Workers requested
+
+    Returns
+    -------
+    int
+        Workers to use (at least 1)
+    """
+    global _workers
+    _workers = 1
+    total = budget()
+    if total is None:
+        return n_workers
+
+    workers = max(1, min(n_workers, int(total // max(unit_bytes, 1))))
+    _workers = workers
+    if unit_bytes:
+        text = f"{workers} of {n_workers} workers, ~{format_size(unit_bytes)} per unit at least"
+    else:
+        text = f"{workers} workers"
+    report(name, f"{text}, {format_size(total / workers)} each", workers=workers, unit_bytes=unit_bytes)
+    return workers
+
+
+def time_block(name, step_bytes, n_time, fixed_bytes=0):
+    """
+    Largest number of time steps to process at once within this process's budget.
+
+    Parameters
+    ----------
+    name : str
+        What is planned (for the report)
+    step_bytes : int
+        Working set per time step (inputs and temporaries)
+    n_time : int
+        Time steps in total
+    fixed_bytes : int, optional
+        Working set independent of the block (e.g. preallocated outputs)
+
+    Returns
+    -------
+    int
+        Time steps per block: 1 (the streaming default) without a budget or
+        when even one step doesn't fit, otherwise up to n_time
+    """
+    share = budget()
+    if share is None:
+        return 1
+
+    block = int((share - fixed_bytes) // max(step_bytes, 1))
+    if block < 1:
+        report(name, f"~{format_size(fixed_bytes + step_bytes)} for one time step exceeds "
+                     f"{format_size(share)}; streaming one step at a time", block=1, fits=False)
+        return 1
+    block = min(block, n_time)
+    report(name, f"{block} of {n_time} time steps per block, "
+                 f"~{format_size(fixed_bytes + block * step_bytes)} of {format_size(share)}", block=block, fits=True)
+    return block
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+# ===== INPUTS =====
+
+# Bump when the on-disk layout changes; old entries are then ignored
+CACHE_VERSION = 1
+
+# Cache location (EXTRACT_CACHE_DIR overrides)
+cache_dir = os.environ.get('EXTRACT_CACHE_DIR', str(Path.home() / '.cache' / 'EXTRACT'))
+
+# ===== FUNCTIONS =====
+
+def file_hash(path):
+    """
+    SHA-256 of a file's contents.
+
+    Hashes are remembered in the cache keyed by path, size and mtime, so a
+    source file is only read in full again after it changes.
+
+    Parameters
+    ----------
+    path : str or Path
+        File to hash
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = f'{path}:{st.st_size}:{st.st_mtime_ns}'
+
+    index_file = Path(cache_dir) / f'v{CACHE_VERSION}' / 'hashes.json'
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        index = {}
+    if stat_key in index:
+        return index[stat_key]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            digest.update(block)
+    index[stat_key] = digest.hexdigest()
+
+    # Lost updates from concurrent writers only cost a rehash later
+    _atomic_write(index_file, json.dumps(index, indent=1).encode())
+    return index[stat_key]
+
+
+def _atomic_write(path, data):
+    """Write bytes to path via a unique temporary file and rename"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.parent / f'.{path.name}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _save_field(field_dir, da):
+    """Store a DataArray as .npy data/coords plus a JSON description"""
+    field_dir.mkdir(parents=True, exist_ok=True)
+    meta = {'dims': list(da.dims), 'attrs': {k: str(v) for k, v in da.attrs.items()}, 'coords': {}}
+
+    for name, coord in da.coords.items():
+        if coord.dtype.kind == 'O':
+            continue
+        fname = f'coord_{uuid.uuid4().hex}.npy'
+        np.save(field_dir / fname, np.asarray(coord.values), allow_pickle=False)
+        meta['coords'][name] = {'dims': list(coord.dims), 'file': fname}
+
+    # Data last, under a unique name: the meta file only points to it once complete
+    fname = f'data_{uuid.uuid4().hex}.npy'
+    np.save(field_dir / fname, np.asarray(da.values), allow_pickle=False)
+    meta['file'] = fname
+    _atomic_write(field_dir / 'meta.json', json.dumps(meta).encode())
+
+
+def _load_field(field_dir, name):
+    """Open a stored field as a DataArray over memory-mapped arrays, or None if absent"""
+    try:
+        with open(field_dir / 'meta.json', 'r') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    coords = {
+        cname: (c['dims'], np.load(field_dir / c['file'], mmap_mode='r'))
+        for cname, c in meta['coords'].items()
+    }
+    data = np.load(field_dir / meta['file'], mmap_mode='r')
+    return xr.DataArray(data, dims=meta['dims'], coords=coords, attrs=meta['attrs'], name=name)
+
+
+def cached_dataset(path, fields):
+    """
+    Geometry fields of a NetCDF file as memory-mapped arrays.
+
+    On first use each field is decoded from the NetCDF file and stored as
+    .npy files under the source file's hash; later calls (from any script or
+    worker process) map them straight from disk.
+
+    Parameters
+    ----------
+    path : str or Path
+        Source NetCDF file, e.g. a mesh_mask file
+    fields : list of str
+        Variables to load, e.g. ['e3t_0', 'tmask']
+
+    Returns
+    -------
+    xr.Dataset
+        Dataset with the requested fields
+    """
+    entry_dir = Path(cache_dir) / f'v{CACHE_VERSION}' / file_hash(path)
+    output_ds = xr.Dataset()
+    source = None
+
+    for field in fields:
+        da = _load_field(entry_dir / field, field)
+        if da is None:
+            if source is None:
+                source = xr.open_dataset(path)
+            _save_field(entry_dir / field, source[field])
+            da = _load_field(entry_dir / field, field)
+        output_ds[field] = da
+
+    if source is not None:
+        source.close()
+    return output_ds
+
+
+def cached_derived(name, sources, builder):
+    """
+    A field derived from one or more source files, cached under their hashes.
+
+    Parameters
+    ----------
+    name : str
+        Name of the derived field, e.g. 'AB_csize'. Must identify how it is
+        built, since the cache key is the name plus the source hashes.
+    sources : list of str or Path
+        Files the field is built from
+    builder : callable
+        Called with no arguments on a cache miss; returns an xr.DataArray
+
+    Returns
+    -------
+    xr.DataArray
+        The derived field over memory-mapped arrays
+    """
+    key = hashlib.sha256(
+        json.dumps([name] + [file_hash(p) for p in sources]).encode()
+    ).hexdigest()
+    field_dir = Path(cache_dir) / f'v{CACHE_VERSION}' / 'derived' / key
+
+    da = _load_field(field_dir, name)
+    if da is None:
+        _save_field(field_dir, builder())
+        da = _load_field(field_dir, name)
+    return da
@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+# ===== INPUTS =====
+
+# Encoding profile for every NetCDF output (EXTRACT_ENCODING overrides):
+#   'compressed' - zlib + shuffle, native dtype (stored values unchanged)
+#   'archive'    - as 'compressed', but floats stored as float32 (smaller, lossy for float64)
+#   'fast'       - uncompressed, native dtype, chunked like 'compressed'
+#   'default'    - xarray's defaults (uncompressed, contiguous), as before
+profile = os.environ.get('EXTRACT_ENCODING', 'compressed')
+
+# Time dimensions of the outputs (chunked one step at a time)
+time_dims = ('time_counter', 'time')
+
+profiles = {
+    'compressed': {'zlib': True, 'complevel': 4, 'shuffle': True, 'float32': False, 'chunked': True},
+    'archive': {'zlib': True, 'complevel': 4, 'shuffle': True, 'float32': True, 'chunked': True},
+    'fast': {'zlib': False, 'float32': False, 'chunked': True},
+    'default': None,
+}
+
+# ===== FUNCTIONS =====
+
+def output_dtype(dtype, profile_name=None):
+    """Storage dtype of a variable under a profile (floats become float32 for 'archive')"""
+    settings = profiles[profile_name or profile]
+    if settings and settings['float32'] and np.issubdtype(dtype, np.floating):
+        return np.dtype('float32')
+    return np.dtype(dtype)
+
+
+def chunk_shape(dims, sizes):
+    """
+    Chunks matching how outputs are read back: one time step and one level
+    by the full horizontal slab (the last two dims).
+
+    Parameters
+    ----------
+    dims : tuple of str
+        Dimensions of a variable
+    sizes : tuple of int
+        Their sizes
+
+    Returns
+    -------
+    tuple of int
+        Chunk size per dim
+    """
+    n = len(dims)
+    return tuple(size if i >= n - 2 else 1 for i, size in enumerate(sizes))
+
+
+def netcdf_encoding(ds, profile_name=None):
+    """
+    Per-variable encoding for to_netcdf(encoding=...) under a profile.
+
+    Only data variables are encoded; coordinates keep xarray's defaults.
+    Variables with fewer than three dims (e.g. time series) are left
+    contiguous.
+
+    Parameters
+    ----------
+    ds : xr.Dataset or xr.DataArray
+        Dataset (or DataArray) to be written
+    profile_name : str, optional
+        Profile name; defaults to the module's profile
+
+    Returns
+    -------
+    dict
+        Variable name -> encoding ({} for the 'default' profile)
+    """
+    settings = profiles[profile_name or profile]
+    if settings is None:
+        return {}
+
+    if isinstance(ds, xr.DataArray):
+        # DataArray.to_netcdf stores an unnamed array under xarray's default name
+        ds = ds.to_dataset(name=ds.name if ds.name is not None else '__xarray_dataarray_variable__')
+
+    encoding = {}
+    for var in ds.data_vars:
+        da = ds[var]
+        if not np.issubdtype(da.dtype, np.number):
+            continue
+        enc = {'zlib': settings['zlib']}
+        if settings['zlib']:
+            enc.update(complevel=settings['complevel'], shuffle=settings['shuffle'])
+        dtype = output_dtype(da.dtype, profile_name)
+        if dtype != da.dtype:
+            enc['dtype'] = dtype
+        if settings['chunked'] and da.ndim >= 3 and any(d in time_dims for d in da.dims):
+            enc['chunksizes'] = chunk_shape(da.dims, da.shape)
+        encoding[var] = enc
+    return encoding
@@ -0,0 +1,364 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import backend
+import catalog
+import instrument
+import memory_budget
+from cli import load_script, read_models_from_file
+from executor import default_workers, run_units
+from zarr_store import store_path
+
+# ===== INPUTS =====
+
+models_file = 'models.txt'  # Path to text file containing model names
+state_file = 'pipeline_state.json'  # Build records (signature per target)
+n_workers = default_workers()  # Processes for independent targets; 1 runs serially
+dry_run = False  # Only report which targets are stale
+mark_built = False  # Record existing outputs as built (e.g. made before the pipeline) instead of rebuilding them
+
+# Stages to run, in dependency order:
+# get_clim -> depth_integrate -> regrid_clim -> compute_latitudinal_profiles
+# extract-LoP -> create_LNL_files
+stages = [
+    'get_clim',
+    'depth_integrate',
+    'regrid_clim',
+    'compute_latitudinal_profiles',
+    'extract-LoP',
+    'create_LNL_files',
+]
+
+# ===== FUNCTIONS =====
+
+def make_target(stage, key, inputs, outputs, params, action):
+    """
+    Describe one buildable target.
+
+    Parameters
+    ----------
+    stage : str
+        Stage name, e.g. 'get_clim'
+    key : str
+        Unique target name within the stage, e.g. 'TOM12_TJ_OBA1 ptrc_T 2010-2019'
+    inputs : list of str
+        Files the target reads
+    outputs : list of str
+        Files the target writes
+    params : dict
+        Parameters that change the outputs (year windows, depth levels, ...)
+    action : tuple
+        (script name, function name, *args) called to build the target
+
+    Returns
+    -------
+    dict
+        Target description
+    """
+    return {
+        'name': f'{stage}: {key}',
+        'stage': stage,
+        'inputs': [os.path.normpath(p) for p in inputs],
+        'outputs': [os.path.normpath(p) for p in outputs],
+        'params': params,
+        'action': action,
+    }
+
+
+def plan_targets(models, stages):
+    """
+    Build the list of targets for every model and requested stage.
+
+    Inputs of downstream stages are the outputs of upstream ones, which is
+    how dependencies between targets are found.
+
+    Parameters
+    ----------
+    models : list of str
+        Model names
+    stages : list of str
+        Stages to include
+
+    Returns
+    -------
+    list of dict
+        Targets (see make_target)
+    """
+    targets = []
+
+    if 'get_clim' in stages or 'depth_integrate' in stages or 'regrid_clim' in stages:
+        clim = load_script('get_clim')
+        di = load_script('depth_integrate')
+        rc = load_script('regrid_clim')
+        clim_files = {}
+        for model in models:
+            for filetype in ['ptrc_T', 'diad_T']:
+                clim_file = Path(clim.clims_dir) / model / f'ORCA2_1m_clim_{clim.yrst}_{clim.yrend}_{filetype}.nc'
+                clim_files[(model, filetype)] = clim_file
+                if 'get_clim' not in stages:
+                    continue
+                inputs = list(catalog.files_by_year(Path(clim.runs_dir, model), filetype,
+                                                    years=range(clim.yrst, clim.yrend + 1)).values())
+                targets.append(make_target(
+                    'get_clim', f'{model} {filetype} {clim.yrst}-{clim.yrend}', inputs, [clim_file],
+                    {'yrst': clim.yrst, 'yrend': clim.yrend, 'streaming': clim.streaming, 'with_std': clim.with_std},
+                    ('get_clim', 'climatology_unit', model, filetype),
+                ))
+
+        for (model, filetype), clim_file in clim_files.items():
+            int_file = clim_file.parent / f'{clim_file.stem}_int.nc'
+            if 'depth_integrate' in stages:
+                var_list = di.ptrc_vars if filetype == 'ptrc_T' else di.diad_vars
+                targets.append(make_target(
+                    'depth_integrate', f'{model} {clim_file.name}', [clim_file], [int_file],
+                    {'var_list': var_list},
+                    ('depth_integrate', 'integrate_unit', str(clim_file), var_list),
+                ))
+            if 'regrid_clim' in stages:
+                rg_file = int_file.parent / f'{int_file.stem}_rg.nc'
+                targets.append(make_target(
+                    'regrid_clim', f'{model} {int_file.name}', [int_file], [rg_file],
+                    {'grid': f'r{rc.nlon}x{rc.nlat}', 'method': 'bilinear', 'mesh_file': rc.mesh_file},
+                    ('regrid_clim', 'regrid_unit', str(int_file), str(rg_file)),
+                ))
+
+    if 'compute_latitudinal_profiles' in stages:
+        lp = load_script('compute_latitudinal_profiles')
+        for model in models:
+            input_file = f'{lp.bdir}{model}/ORCA2_1m_clim_{lp.ys}_{lp.ye}_ptrc_T_int_rg.nc'
+            output_file = f'{lp.bdir}{model}/ORCA2_1m_clim_{lp.ys}_{lp.ye}_ptrc_T_int_rg_latprof.nc'
+            targets.append(make_target(
+                'compute_latitudinal_profiles', model, [input_file], [output_file],
+                {'ys': lp.ys, 'ye': lp.ye, 'phy': lp.phy},
+                ('compute_latitudinal_profiles', 'latprof_unit', model),
+            ))
+
+    if 'extract-LoP' in stages or 'create_LNL_files' in stages:
+        lop = load_script('extract-LoP')
+        lnl = load_script('create_LNL_files')
+        for model in models:
+            model_dir = Path(lnl.base_dir) / model
+            if 'extract-LoP' in stages:
+                for year in range(lop.year_start, lop.year_end + 1):
+                    limphy_file = model_dir / f'ORCA2_1m_{year}0101_{year}1231_limphy.nc'
+                    lop_file = model_dir / f'ORCA2_1m_{year}0101_{year}1231_LoP_T.nc'
+                    outputs = [lop_file] if lop.output_format != 'zarr' else [store_path(lnl.base_dir, model, 'LoP_T')]
+                    targets.append(make_target(
+                        'extract-LoP', f'{model} {year}', [limphy_file, lop.mesh_file], outputs,
+                        {'output_format': lop.output_format},
+                        ('extract-LoP', 'limiter_unit', model, year,
+                         'made in /gpfs/home/mep22dku/scratch/EXTRACT/extract-LoP.py'),
+                    ))
+            if 'create_LNL_files' in stages:
+                for year in range(lnl.year_start, lnl.year_end + 1):
+                    limphy_file = model_dir / f'ORCA2_1m_{year}0101_{year}1231_limphy.nc'
+                    lop_file = model_dir / f'ORCA2_1m_{year}0101_{year}1231_LoP_T.nc'
+                    lnl_file = model_dir / f'ORCA2_1m_{year}0101_{year}1231_LNL_T.nc'
+                    inputs = [limphy_file, lnl.mesh_file] if lnl.fused else [lop_file, limphy_file, lnl.mesh_file]
+                    outputs = [lnl_file] if lnl.output_format != 'zarr' else [store_path(lnl.base_dir, model, 'LNL_T')]
+                    targets.append(make_target(
+                        'create_LNL_files', f'{model} {year}', inputs, outputs,
+                        {'pfts': lnl.pfts, 'depth_levels': lnl.depth_levels, 'fused': lnl.fused,
+                         'partial_cells': lnl.partial_cells, 'output_format': lnl.output_format},
+                        ('pipeline', 'lnl_unit', model, year),
+                    ))
+
+    return targets
+
+
+def lnl_unit(model, year):
+    """Work unit for create_LNL_files that rebuilds the LNL file even if it already exists"""
+    # process_year() skips existing outputs; the pipeline has already decided this one is stale
+    return load_script('create_LNL_files').process_unit(model, year, overwrite=True)
+
+
+def run_action(script, func_name, *args):
+    """Work unit for run_units: call a script function by name"""
+    return getattr(load_script(script), func_name)(*args)
+
+
+def target_signature(target):
+    """
+    Hash of a target's parameters and the mtime/size of its inputs.
+
+    Returns None if any input is missing.
+    """
+    input_states = []
+    for path in target['inputs']:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        input_states.append([path, st.st_mtime_ns, st.st_size])
+
+    payload = json.dumps({'params': target['params'], 'inputs': input_states, 'action': target['action']},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def is_stale(target, signature, state):
+    """A target is stale if an output is missing or its inputs/params changed since it was built"""
+    if not all(Path(p).exists() for p in target['outputs']):
+        return True
+    return state.get(target['name']) != signature
+
+
+def load_state(path):
+    """Read the build records written by previous runs"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state, path):
+    """Write build records atomically"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def run_pipeline(targets, state_file, n_workers=1, dry_run=False, mark_built=False):
+    """
+    Rebuild stale targets in dependency order, running independent ones concurrently.
+
+    Targets are run in waves: each wave holds every target whose upstream
+    targets are done. Staleness is checked just before a wave runs, so a
+    rebuilt upstream output makes its downstream targets stale. Targets whose
+    upstream failed, or whose inputs are missing, are skipped.
+
+    With mark_built nothing is built: stale targets whose outputs all exist
+    are recorded with their current signature, so outputs made outside the
+    pipeline count as up to date on the next run.
+
+    Parameters
+    ----------
+    targets : list of dict
+        Targets from plan_targets()
+    state_file : str
+        JSON file with the signature of every target built so far
+    n_workers : int, optional
+        Processes per wave
+    dry_run : bool, optional
+        Report stale targets without building them
+    mark_built : bool, optional
+        Record stale targets with existing outputs as built instead of building them
+
+    Returns
+    -------
+    dict
+        Counts of 'built', 'up_to_date', 'marked', 'failed' and 'skipped' targets
+    """
+    state = load_state(state_file)
+    producer = {out: t['name'] for t in targets for out in t['outputs']}
+    deps = {t['name']: {producer[p] for p in t['inputs'] if p in producer} for t in targets}
+
+    counts = {'built': 0, 'up_to_date': 0, 'marked': 0, 'failed': 0, 'skipped': 0}
+    done = set()
+    failed = set()
+    pending = list(targets)
+
+    while pending:
+        wave = [t for t in pending if deps[t['name']] <= done | failed]
+        if not wave:
+            raise ValueError("Dependency cycle between targets: " + ', '.join(t['name'] for t in pending))
+        pending = [t for t in pending if t not in wave]
+
+        to_build = []
+        signatures = {}
+        for t in wave:
+            if deps[t['name']] & failed:
+                print(f"  Skipping {t['name']} (upstream failed)")
+                failed.add(t['name'])
+                counts['skipped'] += 1
+                continue
+            signature = target_signature(t)
+            if signature is None and not dry_run:
+                missing = [p for p in t['inputs'] if not Path(p).exists()]
+                print(f"  Skipping {t['name']} (missing input: {missing[0]})")
+                failed.add(t['name'])
+                counts['skipped'] += 1
+                continue
+            if signature is not None and not is_stale(t, signature, state):
+                done.add(t['name'])
+                counts['up_to_date'] += 1
+                continue
+            signatures[t['name']] = signature
+            to_build.append(t)
+
+        if dry_run:
+            for t in to_build:
+                print(f"  Stale: {t['name']}")
+            done.update(t['name'] for t in to_build)
+            counts['built'] += len(to_build)
+            continue
+
+        if mark_built:
+            for t in to_build:
+                if all(Path(p).exists() for p in t['outputs']):
+                    state[t['name']] = signatures[t['name']]
+                    counts['marked'] += 1
+                else:
+                    print(f"  Not built yet: {t['name']}")
+                    counts['skipped'] += 1
+            done.update(t['name'] for t in to_build)
+            save_state(state, state_file)
+            continue
+
+        if not to_build:
+            continue
+
+        print(f"Building {len(to_build)} target(s) with {n_workers} worker(s)")
+        results = run_units(run_action, [t['action'] for t in to_build], n_workers,
+                            error_format='  ERROR building {0} {2}: {e}')
+        # Dask backend: write this wave's outputs before the next wave reads them
+        backend.compute_pending()
+
+        for t, result in zip(to_build, results):
+            if result and all(Path(p).exists() for p in t['outputs']):
+                # Record the inputs seen before the build, so changes made during it still count
+                state[t['name']] = signatures[t['name']]
+                done.add(t['name'])
+                counts['built'] += 1
+            else:
+                print(f"  Failed: {t['name']}")
+                failed.add(t['name'])
+                counts['failed'] += 1
+        save_state(state, state_file)
+
+    return counts
+
+
+# ===== RUN =====
+
+def main():
+    """Plan and build the stale targets of every model in models_file"""
+    # Read models from file
+    models = read_models_from_file(models_file)
+
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    targets = plan_targets(models, stages)
+    print(f"Planned {len(targets)} targets over stages: {', '.join(stages)}")
+
+    client = None if dry_run or mark_built else backend.start_cluster()
+    # Stages differ in size, so the workers only share the memory budget (see memory_budget.py)
+    workers = memory_budget.plan_workers('pipeline', 0, backend.unit_workers(n_workers))
+    counts = run_pipeline(targets, state_file, workers, dry_run, mark_built)
+
+    instrument.print_summary()
+
+    print(f"\n{'='*60}")
+    print(f"Built: {counts['built']}, up to date: {counts['up_to_date']}, marked built: {counts['marked']}, "
+          f"failed: {counts['failed']}, skipped: {counts['skipped']}")
+    print(f"{'='*60}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import numpy as np
+import xarray as xr
+
+# ===== FUNCTIONS =====
+
+def build_province_weights(masks=None, labels=None, label_names=None, area=None, weighted=True):
+    """
+    Build a province x ocean-cell weight matrix for grouped province means.
+
+    Provinces can come from overlapping masks (e.g. GO/AB/HA/NA, where GO
+    contains the others), from an integer label grid (e.g. Longhurst
+    provinces, one label per cell), or both. Only cells that belong to at
+    least one province are kept, so the reduction runs over ocean cells only.
+
+    Parameters
+    ----------
+    masks : dict, optional
+        Mapping of province name to a 2D (y, x) mask, e.g. mask.csize * MA.AB.
+        Cells where the mask is > 0 belong to the province. When weighted,
+        the mask value itself is used as the weight (so csize-based masks
+        give area weights).
+    labels : xr.DataArray, optional
+        2D (y, x) integer label grid. Cells with label <= 0 or NaN belong
+        to no province.
+    label_names : dict, optional
+        Mapping of label value to province name. Defaults to every positive
+        label in the grid, named by its value.
+    area : xr.DataArray, optional
+        2D (y, x) cell area used to weight labelled provinces. Required if
+        labels are given and weighted is True.
+    weighted : bool, optional
+        If True (default), compute area-weighted means. If False, every cell
+        in a province counts equally, as in the original
+        where(prov_mask > 0).mean() reduction.
+
+    Returns
+    -------
+    xr.DataArray
+        Weights with dims (province, cell), with integer 'cell_y' and
+        'cell_x' coordinates giving the grid position of each cell
+    """
+    if masks is None and labels is None:
+        raise ValueError("Need at least one of masks or labels")
+
+    names = []
+    rows = []
+
+    for prov_name, prov_mask in (masks or {}).items():
+        values = np.asarray(prov_mask.values, dtype=float)
+        inside = np.nan_to_num(values) > 0
+        rows.append(np.where(inside, values, 0) if weighted else inside.astype(float))
+        names.append(prov_name)
+
+    if labels is not None:
+        label_values = np.nan_to_num(np.asarray(labels.values, dtype=float), nan=0).astype(int)
+        if label_names is None:
+            label_names = {int(lab): str(int(lab)) for lab in np.unique(label_values) if lab > 0}
+        if weighted:
+            if area is None:
+                raise ValueError("area is required for weighted label provinces")
+            cell_weight = np.nan_to_num(np.asarray(area.values, dtype=float))
+        else:
+            cell_weight = np.ones(label_values.shape)
+        for lab, prov_name in label_names.items():
+            rows.append(np.where(label_values == lab, cell_weight, 0))
+            names.append(prov_name)
+
+    # Keep only cells that belong to at least one province
+    dense = np.stack(rows)
+    cell_y, cell_x = np.nonzero((dense > 0).any(axis=0))
+
+    weights = xr.DataArray(
+        dense[:, cell_y, cell_x],
+        dims=('province', 'cell'),
+        coords={'province': names, 'cell_y': ('cell', cell_y), 'cell_x': ('cell', cell_x)},
+    )
+    return weights
+
+
+def grouped_province_means(var_data, weights, keep_dims=('time_counter', 'time', 'model'), spatial_dims=('y', 'x')):
+    """
+    Compute the mean of a variable over every province in one reduction.
+
+    NaN cells are left out of both the weighted sum and the total weight,
+    matching what .where(prov_mask > 0).mean() does for a single province.
+    As in that reduction, every dim not in keep_dims is averaged over, so a
+    variable that still has a depth dim is averaged over depth as well.
+
+    Parameters
+    ----------
+    var_data : xr.DataArray
+        Variable on the (y, x) grid, e.g. (time_counter, y, x)
+    weights : xr.DataArray
+        Province weights from build_province_weights()
+    keep_dims : tuple of str, optional
+        Dims that are not reduced over
+    spatial_dims : tuple of str, optional
+        Names of the horizontal dims of var_data
+
+    Returns
+    -------
+    xr.DataArray
+        Province means with dims (province, *kept dims of var_data)
+    """
+    kept = [d for d in var_data.dims if d in keep_dims]
+    other = [d for d in var_data.dims if d not in kept and d not in spatial_dims]
+    var_data = var_data.transpose(*kept, *other, *spatial_dims)
+    dtype = var_data.dtype if np.issubdtype(var_data.dtype, np.floating) else float
+
+    if var_data.chunks:
+        # Dask backend: reduce each chunk of time steps lazily (reduced dims must be whole)
+        means = xr.apply_ufunc(
+            province_block_means, var_data, kwargs={'weights': weights, 'n_other': len(other)},
+            input_core_dims=[[*other, *spatial_dims]], output_core_dims=[['province']],
+            dask='parallelized', output_dtypes=[dtype],
+            dask_gufunc_kwargs={'output_sizes': {'province': weights.sizes['province']}},
+        ).data
+    else:
+        means = province_block_means(var_data.values, weights, len(other))
+
+    reduced = set(other) | set(spatial_dims)
+    coords = {k: v for k, v in var_data.coords.items() if not set(v.dims) & reduced}
+    coords['province'] = weights.province.values
+    result = xr.DataArray(means, dims=(*kept, 'province'), coords=coords, name=var_data.name)
+    return result.transpose('province', ...)
+
+
+def province_block_means(values, weights, n_other=0):
+    """
+    Province means of a numpy array over its trailing (other, y, x) axes.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Data with shape (kept..., other..., y, x)
+    weights : xr.DataArray
+        Province weights from build_province_weights()
+    n_other : int, optional
+        Number of reduced axes before y and x
+
+    Returns
+    -------
+    np.ndarray
+        Means with shape (kept..., province)
+    """
+    lead = values.shape[:values.ndim - n_other - 2]
+
+    # Gather ocean cells only and fold any other reduced dims into the cell axis
+    data = values[..., weights.cell_y.values, weights.cell_x.values]
+    n_fold = int(np.prod(values.shape[len(lead):len(lead) + n_other]))
+    data = data.reshape(*lead, n_fold * weights.sizes['cell'])
+    w = np.tile(weights.values.T, (n_fold, 1))
+    valid = ~np.isnan(data)
+
+    # One matrix product gives the weighted sums of all provinces at every time step
+    weighted_sum = np.where(valid, data, 0) @ w
+    total_weight = valid.astype(w.dtype) @ w
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = weighted_sum / total_weight
+
+    if np.issubdtype(values.dtype, np.floating):
+        means = means.astype(values.dtype)
+    return means
+
+
+def depth_band_matrix(depths, bands):
+    """
+    Level-to-band membership for depth bands.
+
+    A level belongs to a band when its depth (the deptht coordinate, the
+    middle of the cell) lies in [top, bottom).
+
+    Parameters
+    ----------
+    depths : array-like
+        Depth of each level (m)
+    bands : list of tuple
+        (top, bottom) of each band (m), e.g. [(0, 100), (100, 500)]
+
+    Returns
+    -------
+    np.ndarray
+        (band, level) matrix of 0/1
+    """
+    depths = np.asarray(depths, dtype=float)
+    return np.stack([((depths >= top) & (depths < bottom)).astype(float) for top, bottom in bands])
+
+
+def grouped_province_profiles(var_data, weights, e3t, bands=None, depth_dim='deptht',
+                              keep_dims=('time_counter', 'time', 'model'), spatial_dims=('y', 'x')):
+    """
+    Volume-weighted province means at every depth level (or depth band) in one reduction.
+
+    Each cell counts with its province weight times its thickness, so with
+    area weights (build_province_weights(weighted=True) on csize masks) the
+    means are weighted by csize x e3t. All levels and provinces come from one
+    batched matrix product per block of time steps. NaN cells (land, below
+    the bottom) are left out of both the weighted sum and the total weight.
+
+    Parameters
+    ----------
+    var_data : xr.DataArray
+        Variable with a depth dim, e.g. (time_counter, deptht, y, x)
+    weights : xr.DataArray
+        Province weights from build_province_weights()
+    e3t : xr.DataArray
+        Cell thickness with dims (depth_dim, y, x)
+    bands : list of tuple, optional
+        (top, bottom) depth bands in m; None gives every level
+    depth_dim : str, optional
+        Name of the depth dim of var_data and e3t
+    keep_dims : tuple of str, optional
+        Dims that are not reduced over
+    spatial_dims : tuple of str, optional
+        Names of the horizontal dims of var_data
+
+    Returns
+    -------
+    xr.DataArray
+        Means with dims (province, depth_dim, *kept dims), or (province,
+        depth_band, *kept dims) with band_top/band_bottom coords for bands
+    """
+    kept = [d for d in var_data.dims if d in keep_dims]
+    var_data = var_data.transpose(*kept, depth_dim, *spatial_dims)
+    dtype = var_data.dtype if np.issubdtype(var_data.dtype, np.floating) else float
+
+    # Thickness of the province cells only, (level, cell)
+    e3t_cells = e3t.transpose(depth_dim, *spatial_dims).values[:, weights.cell_y.values, weights.cell_x.values]
+
+    if bands is None:
+        band_matrix = None
+        out_dim = depth_dim
+        out_coords = {depth_dim: var_data[depth_dim]} if depth_dim in var_data.coords else {}
+    else:
+        band_matrix = depth_band_matrix(var_data[depth_dim].values, bands)
+        out_dim = 'depth_band'
+        out_coords = {
+            'depth_band': [f'{top:g}-{bottom:g}' for top, bottom in bands],
+            'band_top': ('depth_band', [top for top, _ in bands]),
+            'band_bottom': ('depth_band', [bottom for _, bottom in bands]),
+        }
+    n_out = var_data.sizes[depth_dim] if band_matrix is None else len(bands)
+
+    kwargs = {'weights': weights, 'e3t_cells': e3t_cells, 'band_matrix': band_matrix}
+    if var_data.chunks:
+        # Dask backend: reduce each chunk of time steps lazily (depth, y and x must be whole)
+        means = xr.apply_ufunc(
+            province_block_profiles, var_data, kwargs=kwargs,
+            input_core_dims=[[depth_dim, *spatial_dims]], output_core_dims=[['__out', 'province']],
+            dask='parallelized', output_dtypes=[dtype],
+            dask_gufunc_kwargs={'output_sizes': {'__out': n_out, 'province': weights.sizes['province']}},
+        ).data
+    else:
+        means = province_block_profiles(var_data.values, **kwargs)
+
+    reduced = {depth_dim, *spatial_dims}
+    coords = {k: v for k, v in var_data.coords.items() if not set(v.dims) & reduced}
+    coords.update(out_coords)
+    coords['province'] = weights.province.values
+    result = xr.DataArray(means, dims=(*kept, out_dim, 'province'), coords=coords, name=var_data.name)
+    return result.transpose('province', out_dim, ...)
+
+
+def province_block_profiles(values, weights, e3t_cells, band_matrix=None):
+    """
+    Volume-weighted province means of a numpy array at every level (or band).
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Data with shape (kept..., level, y, x)
+    weights : xr.DataArray
+        Province weights from build_province_weights()
+    e3t_cells : np.ndarray
+        Thickness of the province cells, shape (level, cell)
+    band_matrix : np.ndarray, optional
+        (band, level) membership from depth_band_matrix()
+
+    Returns
+    -------
+    np.ndarray
+        Means with shape (kept..., level or band, province)
+    """
+    data = values[..., weights.cell_y.values, weights.cell_x.values]
+    valid = ~np.isnan(data)
+    volume = np.where(valid, e3t_cells, 0)
+
+    # Batched over time and level: (kept..., level, cell) @ (cell, province)
+    w = weights.values.T
+    weighted_sum = (np.where(valid, data, 0) * volume) @ w
+    total_weight = volume @ w
+
+    if band_matrix is not None:
+        # Sum the levels of each band before dividing, so bands are volume means too
+        weighted_sum = band_matrix @ weighted_sum
+        total_weight = band_matrix @ total_weight
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = weighted_sum / total_weight
+
+    if np.issubdtype(values.dtype, np.floating):
+        means = means.astype(values.dtype)
+    return means
@@ -0,0 +1,313 @@
+import os
+import uuid
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+import catalog
+import instrument
+from cli import read_models_from_file
+from executor import default_workers, run_units, shared_resource
+from mesh_cache import CACHE_VERSION, cache_dir, cached_dataset, file_hash
+from output_encoding import netcdf_encoding
+
+# ===== INPUTS =====
+
+# Paths
+basedir = '/gpfs/data/greenocean/users/mep22dku/clims/'
+models_file = 'models.txt'  # Path to text file containing model names
+n_workers = default_workers()  # Processes for (model, file) units; 1 runs serially
+
+# Source grid coordinates (glamt/gphit)
+mesh_file = '/gpfs/data/greenocean/software/resources/regrid/mesh_mask3_6.nc'
+
+# Target grid, as CDO's r360x180: cell centres from 0.5E and 89.5S
+nlon = 360
+nlat = 180
+
+# ===== FUNCTIONS =====
+
+def target_grid(nlon=360, nlat=180):
+    """
+    Longitudes and latitudes of a global regular grid (CDO r<nlon>x<nlat>).
+
+    Returns
+    -------
+    tuple of np.ndarray
+        (lon, lat) cell centres
+    """
+    dlon = 360 / nlon
+    dlat = 180 / nlat
+    lon = dlon / 2 + dlon * np.arange(nlon)
+    lat = -90 + dlat / 2 + dlat * np.arange(nlat)
+    return lon, lat
+
+
+def bilinear_weights(src_lon, src_lat, dst_lon, dst_lat, tol=1e-6):
+    """
+    Bilinear remapping weights from a curvilinear grid to a regular grid.
+
+    Each target point is located in a quadrilateral of four neighbouring
+    source points, and its position (s, t) inside it is found by inverting
+    the bilinear map (Newton iterations in lon/lat), as CDO remapbil does.
+    The ORCA2 halo columns make the quadrilaterals wrap around in longitude.
+    Target points outside every quadrilateral (e.g. beyond the northernmost
+    row) get no weights.
+
+    Parameters
+    ----------
+    src_lon, src_lat : np.ndarray
+        2D (y, x) source coordinates in degrees
+    dst_lon, dst_lat : np.ndarray
+        1D, evenly spaced target coordinates in degrees
+    tol : float, optional
+        Tolerance on s and t for points on quadrilateral edges
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Weights of shape (dst_lat.size * dst_lon.size, src points), with
+        target points in (lat, lon) order and source points in (y, x) order
+    """
+    ny, nx = src_lat.shape
+    src_lon = np.mod(src_lon, 360)
+
+    # Corners of every quadrilateral, counter-clockwise from (j, i)
+    j, i = np.meshgrid(np.arange(ny - 1), np.arange(nx - 1), indexing='ij')
+    j, i = j.ravel(), i.ravel()
+    corner_j = np.stack([j, j, j + 1, j + 1], axis=1)
+    corner_i = np.stack([i, i + 1, i + 1, i], axis=1)
+    qlat = src_lat[corner_j, corner_i]
+    qlon = src_lon[corner_j, corner_i]
+    qlon = qlon[:, :1] + np.mod(qlon - qlon[:, :1] + 180, 360) - 180
+
+    # Skip degenerate quadrilaterals (missing coordinates, or around a pole)
+    good = np.isfinite(qlat).all(axis=1) & np.isfinite(qlon).all(axis=1)
+    good &= qlon.max(axis=1) - qlon.min(axis=1) < 180
+    quads = np.nonzero(good)[0]
+    qlat, qlon = qlat[quads], qlon[quads]
+
+    # Candidate target points: those inside each quadrilateral's bounding box
+    dlon = dst_lon[1] - dst_lon[0]
+    dlat = dst_lat[1] - dst_lat[0]
+    k_lo = np.ceil((qlon.min(axis=1) - dst_lon[0]) / dlon).astype(int)
+    k_hi = np.floor((qlon.max(axis=1) - dst_lon[0]) / dlon).astype(int)
+    l_lo = np.clip(np.ceil((qlat.min(axis=1) - dst_lat[0]) / dlat).astype(int), 0, None)
+    l_hi = np.clip(np.floor((qlat.max(axis=1) - dst_lat[0]) / dlat).astype(int), None, dst_lat.size - 1)
+    n_k = np.clip(k_hi - k_lo + 1, 0, None)
+    n_l = np.clip(l_hi - l_lo + 1, 0, None)
+    counts = n_k * n_l
+
+    q = np.repeat(np.arange(quads.size), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    k = k_lo[q] + offset % n_k[q]
+    l = l_lo[q] + offset // n_k[q]
+    px = dst_lon[0] + k * dlon
+    py = dst_lat[l]
+
+    # Invert P(s, t) = a + b s + c t + d s t for each candidate
+    a_x, a_y = qlon[q, 0], qlat[q, 0]
+    b_x, b_y = qlon[q, 1] - a_x, qlat[q, 1] - a_y
+    c_x, c_y = qlon[q, 3] - a_x, qlat[q, 3] - a_y
+    d_x = qlon[q, 0] - qlon[q, 1] + qlon[q, 2] - qlon[q, 3]
+    d_y = qlat[q, 0] - qlat[q, 1] + qlat[q, 2] - qlat[q, 3]
+    s = np.full(q.size, 0.5)
+    t = np.full(q.size, 0.5)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(20):
+            f_x = a_x + b_x * s + c_x * t + d_x * s * t - px
+            f_y = a_y + b_y * s + c_y * t + d_y * s * t - py
+            j_xs, j_xt = b_x + d_x * t, c_x + d_x * s
+            j_ys, j_yt = b_y + d_y * t, c_y + d_y * s
+            det = j_xs * j_yt - j_xt * j_ys
+            s = s - (j_yt * f_x - j_xt * f_y) / det
+            t = t - (j_xs * f_y - j_ys * f_x) / det
+
+    inside = (s >= -tol) & (s <= 1 + tol) & (t >= -tol) & (t <= 1 + tol)
+    s = np.clip(s[inside], 0, 1)
+    t = np.clip(t[inside], 0, 1)
+    target = (l * dst_lon.size + np.mod(k, dst_lon.size))[inside]
+    corners = (corner_j * nx + corner_i)[quads][q[inside]]
+
+    # A point on a shared edge (or in a halo column) is taken from its first quadrilateral
+    target, first = np.unique(target, return_index=True)
+    s, t, corners = s[first], t[first], corners[first]
+
+    w = np.stack([(1 - s) * (1 - t), s * (1 - t), s * t, (1 - s) * t], axis=1)
+    return scipy.sparse.csr_matrix(
+        (w.ravel(), (np.repeat(target, 4), corners.ravel())),
+        shape=(dst_lat.size * dst_lon.size, ny * nx),
+    )
+
+
+def load_weights(mesh_file, nlon=360, nlat=180):
+    """
+    Bilinear ORCA2 -> r<nlon>x<nlat> weights, built once and cached on disk.
+
+    The sparse matrix is stored in the mesh cache (see mesh_cache.py) under
+    the mesh file's hash, so every later file, process and run reuses it.
+
+    Parameters
+    ----------
+    mesh_file : str
+        NEMO mesh_mask file with glamt and gphit
+    nlon, nlat : int, optional
+        Size of the target grid
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Weights from bilinear_weights()
+    """
+    weights_file = (Path(cache_dir) / f'v{CACHE_VERSION}' / 'regrid'
+                    / f'{file_hash(mesh_file)}_bil_r{nlon}x{nlat}.npz')
+    if weights_file.exists():
+        return scipy.sparse.load_npz(weights_file)
+
+    mesh = cached_dataset(mesh_file, ['glamt', 'gphit'])
+    src_lon = np.asarray(mesh.glamt.squeeze().values, dtype=float)
+    src_lat = np.asarray(mesh.gphit.squeeze().values, dtype=float)
+    weights = bilinear_weights(src_lon, src_lat, *target_grid(nlon, nlat))
+
+    weights_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = weights_file.parent / f'.{uuid.uuid4().hex}.npz'
+    scipy.sparse.save_npz(tmp, weights)
+    os.replace(tmp, weights_file)
+    return weights
+
+
+def regrid_dataset(dataset, weights, nlon=360, nlat=180, spatial_dims=('y', 'x')):
+    """
+    Apply remapping weights to every (y, x) variable of a dataset.
+
+    All levels and time steps of a variable are remapped in one sparse
+    matrix product. Missing (NaN) source points are left out and the
+    weights of the remaining corners renormalised; target points with no
+    valid corner are NaN.
+
+    Parameters
+    ----------
+    dataset : xr.Dataset
+        Dataset on the ORCA2 grid
+    weights : scipy.sparse.csr_matrix
+        Weights from load_weights()
+    nlon, nlat : int, optional
+        Size of the target grid
+    spatial_dims : tuple of str, optional
+        Names of the horizontal dims
+
+    Returns
+    -------
+    xr.Dataset
+        Dataset on the regular grid, with dims (..., y, x) and 1D lat/lon
+        coordinates
+    """
+    lon, lat = target_grid(nlon, nlat)
+    output_ds = xr.Dataset(attrs=dataset.attrs)
+
+    for var in dataset.data_vars:
+        da = dataset[var]
+        if not set(spatial_dims) <= set(da.dims):
+            output_ds[var] = da
+            continue
+
+        da = da.transpose(..., *spatial_dims)
+        other = da.dims[:-2]
+        values = da.values.reshape(-1, weights.shape[1]).T
+        valid = ~np.isnan(values)
+        weighted_sum = weights @ np.where(valid, values, 0)
+        total_weight = weights @ valid.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            remapped = np.where(total_weight > 0, weighted_sum / total_weight, np.nan)
+
+        dtype = da.dtype if np.issubdtype(da.dtype, np.floating) else float
+        remapped = remapped.T.reshape(*[da.sizes[d] for d in other], nlat, nlon).astype(dtype)
+        coords = {c: v for c, v in da.coords.items() if not set(v.dims) & set(spatial_dims)}
+        output_ds[var] = xr.DataArray(remapped, dims=(*other, *spatial_dims), coords=coords, attrs=da.attrs)
+
+    output_ds = output_ds.assign_coords(
+        lat=(spatial_dims[0], lat, {'units': 'degrees_north', 'standard_name': 'latitude'}),
+        lon=(spatial_dims[1], lon, {'units': 'degrees_east', 'standard_name': 'longitude'}),
+    )
+    output_ds.attrs['regridding'] = f'bilinear ORCA2 -> r{nlon}x{nlat} (regrid_clim.py)'
+    return output_ds
+
+
+def regrid_unit(infile, outfile):
+    """Work unit for run_units: regrid one file with the shared weights"""
+    weights = shared_resource('regrid_weights', load_weights, mesh_file, nlon, nlat)
+    print(f"  Regridding {Path(infile).name}...", flush=True)
+    with instrument.unit(file=Path(infile).name), xr.open_dataset(infile) as dataset:
+        with instrument.stage('compute'):
+            regridded = regrid_dataset(dataset, weights, nlon, nlat)
+        with instrument.stage('write'):
+            regridded.to_netcdf(outfile, encoding=netcdf_encoding(regridded))
+    return True
+
+
+def find_clim_files(model, basedir):
+    """
+    Climatology files of a model that still need regridding.
+
+    Parameters
+    ----------
+    model : str
+        Model name
+    basedir : str
+        Directory containing one folder per model
+
+    Returns
+    -------
+    list of tuple
+        (input file, output file) pairs
+    """
+    model_dir = Path(basedir) / model
+    if not model_dir.is_dir():
+        print(f"  Directory not found: {model_dir}")
+        return []
+
+    # One listing of the directory gives both the inputs and the existing outputs
+    infiles = sorted(catalog.find_files(model_dir, clim=True, suffix=None))
+    existing = {f.name for f in infiles}
+
+    pairs = []
+    for infile in infiles:
+        # Skip files that are already regridded
+        if infile.name.endswith('_rg.nc'):
+            continue
+        outfile = infile.parent / f'{infile.stem}_rg.nc'
+        if outfile.name in existing:
+            print(f"  Skipping {infile.name} (already regridded)")
+            continue
+        pairs.append((str(infile), str(outfile)))
+    return pairs
+
+
+# ===== RUN =====
+
+def main():
+    """Regrid the climatology files of every model in models_file"""
+    models = read_models_from_file(models_file)
+
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    units = []
+    for model in models:
+        print(f"Processing {model}...")
+        units.extend(find_clim_files(model, basedir))
+
+    # Build (or load) the weights once before forking, so workers share them
+    weights = load_weights(mesh_file, nlon, nlat)
+    run_units(regrid_unit, units, n_workers, error_format='  ERROR regridding {0}: {e}',
+              resources={'regrid_weights': weights})
+
+    instrument.print_summary()
+    print("All runs completed!")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from compute_latitudinal_profiles import lat_binned_means
+
+edges = np.arange(-60., 61., 30.)
+
+
+@pytest.fixture
+def grid():
+    """Curvilinear latitudes, Atlantic cell weights (0 outside) and a field with land (NaN) cells"""
+    rng = np.random.default_rng(0)
+    lat = np.linspace(-75, 75, 10)[:, None] + rng.uniform(-3, 3, (10, 7))
+    weight = rng.uniform(1, 2, (10, 7))
+    weight[:, 5:] = 0                   # outside the Atlantic
+    data = rng.random((3, 10, 7))
+    data[:, 4, :3] = np.nan             # land
+    data[2][(lat >= 0) & (lat < 30)] = np.nan  # a whole band missing at one step
+    dataset = xr.Dataset({'DIA': (('time_counter', 'y', 'x'), data),
+                          'MIX': (('time_counter', 'y', 'x'), (2 * data).astype(np.float32))},
+                         coords={'time_counter': [0, 1, 2]})
+    return lat, weight, dataset
+
+
+def make_bins(lat, weight):
+    """Bins as load_lat_bins builds them: band and weight of every Atlantic cell inside the edges"""
+    band = np.digitize(lat, edges) - 1
+    cell_y, cell_x = np.nonzero((band >= 0) & (band < len(edges) - 1) & (weight > 0))
+    return xr.Dataset(
+        {'bin': ('cell', band[cell_y, cell_x]), 'weight': ('cell', weight[cell_y, cell_x])},
+        coords={'cell_y': ('cell', cell_y), 'cell_x': ('cell', cell_x), 'lat': (edges[:-1] + edges[1:]) / 2,
+                'lat_min': ('lat', edges[:-1]), 'lat_max': ('lat', edges[1:])},
+    )
+
+
+def test_lat_binned_means_match_xarray_weighted(grid):
+    lat, weight, dataset = grid
+    profiles = lat_binned_means(dataset, ['DIA', 'MIX'], make_bins(lat, weight))
+    lat = xr.DataArray(lat, dims=('y', 'x'))
+    weight = xr.DataArray(weight, dims=('y', 'x'))
+    for var in ('DIA', 'MIX'):
+        assert profiles[var].dims == ('time_counter', 'lat')
+        assert profiles[var].dtype == dataset[var].dtype
+        for i, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+            in_band = (lat >= lo) & (lat < hi)
+            expected = dataset[var].where(in_band).weighted(weight.where(in_band, 0)).mean(('y', 'x'))
+            rtol = 1e-6 if dataset[var].dtype == np.float32 else 1e-12
+            np.testing.assert_allclose(profiles[var].values[:, i], expected.values, rtol=rtol)
+    assert np.isnan(profiles.DIA.sel(lat=15).values[2])
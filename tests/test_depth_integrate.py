@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from depth_integrate import integrate_depth
+
+
+def original_integral(dataset, var, tmesh):
+    """The formulation integrate_depth used before depth_integral: e3t broadcast over time, then summed"""
+    e3t = tmesh['e3t_0'].rename({'t': 'time_counter', 'z': 'deptht'})
+    if e3t.sizes['time_counter'] == 1:
+        e3t = e3t.squeeze('time_counter', drop=True).expand_dims(time_counter=dataset.time_counter.values)
+    return (dataset[var] * e3t).sum(dim='deptht')
+
+
+@pytest.fixture
+def dataset():
+    """(time_counter, deptht, y, x) variables with land columns and NaNs below the sea floor"""
+    rng = np.random.default_rng(0)
+    shape = (3, 4, 5, 6)
+    dims = ('time_counter', 'deptht', 'y', 'x')
+    ds = xr.Dataset(coords={'time_counter': np.arange(shape[0]), 'deptht': [5., 15., 30., 60.]})
+    for var in ('DIA', 'MIX'):
+        values = rng.random(shape)
+        values[:, :, 0, :] = np.nan   # land columns integrate to 0
+        values[:, 2:, 3, :2] = np.nan  # below the sea floor
+        ds[var] = (dims, values)
+    ds['PPT'] = (('time_counter', 'deptht', 'y'), rng.random(shape[:3]))  # different dims, own batch
+    return ds
+
+
+def mesh(n_t, shape=(4, 5, 6)):
+    rng = np.random.default_rng(1)
+    e3t = (1 + rng.random((n_t,) + shape)) * np.array([10., 10., 20., 40.])[:, None, None]
+    return xr.Dataset({'e3t_0': (('t', 'z', 'y', 'x'), e3t)})
+
+
+@pytest.mark.parametrize('n_t', [1, 3])
+@pytest.mark.parametrize('time_block', [1, 2, None])
+def test_integrate_depth_matches_original(dataset, n_t, time_block):
+    tmesh = mesh(n_t)
+    result = integrate_depth(dataset, ['DIA', 'MIX'], tmesh, time_block=time_block)
+    for var in ('DIA', 'MIX'):
+        expected = original_integral(dataset, var, tmesh)
+        assert result[var].dims == expected.dims
+        np.testing.assert_allclose(result[var].values, expected.values, rtol=1e-12)
+    assert (result.DIA.values[:, 0, :] == 0).all()
+
+
+def test_variables_with_other_dims_are_integrated_separately(dataset):
+    tmesh = mesh(1)
+    tmesh['e3t_0'] = tmesh.e3t_0.isel(x=0)
+    result = integrate_depth(dataset, ['PPT'], tmesh)
+    np.testing.assert_allclose(result.PPT.values, original_integral(dataset, 'PPT', tmesh).values, rtol=1e-12)
+
+
+def test_lazy_integral_matches_eager(dataset):
+    pytest.importorskip('dask')
+    tmesh = mesh(1)
+    eager = integrate_depth(dataset, ['DIA', 'MIX'], tmesh)
+    lazy = integrate_depth(dataset.chunk({'time_counter': 1}), ['DIA', 'MIX'], tmesh).compute()
+    for var in ('DIA', 'MIX'):
+        np.testing.assert_allclose(lazy[var].values, eager[var].values, rtol=1e-12)
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from ensemble import common_years, open_ensemble, split_models
+
+models = ['A', 'B', 'C']
+
+
+@pytest.fixture
+def paths(tmp_path):
+    """One yearly file per model on the same grid and time axis, with land (NaN) cells"""
+    rng = np.random.default_rng(0)
+    files = []
+    for model in models:
+        dia = rng.random((12, 2, 3, 4))
+        dia[:, :, 0, :] = np.nan
+        ds = xr.Dataset(
+            {'DIA': (('time_counter', 'deptht', 'y', 'x'), dia),
+             'PPT': (('time_counter', 'y', 'x'), rng.random((12, 3, 4)).astype(np.float32)),
+             'area': (('y', 'x'), np.ones((3, 4)))},
+            coords={'time_counter': pd.date_range('2000-01-15', periods=12, freq='30D'), 'deptht': [5., 15.]},
+        )
+        files.append(str(tmp_path / f'{model}_2000.nc'))
+        ds.to_netcdf(files[-1])
+    return files
+
+
+def test_open_ensemble_matches_concat(paths):
+    expected = xr.concat([xr.open_dataset(p) for p in paths], dim=pd.Index(models, name='model'))
+    with open_ensemble(paths, models) as stacked:
+        assert list(stacked.model.values) == models
+        for var in ('DIA', 'PPT'):
+            assert stacked[var].dims[:2] == ('time_counter', 'model')
+            assert stacked[var].dtype == expected[var].dtype
+            np.testing.assert_array_equal(stacked[var].values, expected[var].transpose(*stacked[var].dims).values)
+
+
+def test_open_ensemble_keeps_only_the_variables_asked_for(paths):
+    with open_ensemble(paths, models, variables=['PPT', 'NOPE']) as stacked:
+        assert list(stacked.data_vars) == ['PPT']
+
+
+def test_split_models_gives_back_each_file(paths):
+    with open_ensemble(paths, models) as stacked:
+        for model, path in zip(models, paths):
+            with xr.open_dataset(path) as ds:
+                part = split_models(stacked)[model]
+                np.testing.assert_array_equal(part.DIA.values, ds.DIA.values)
+                assert 'model' not in part.dims
+
+
+def test_common_years_leaves_out_partial_years():
+    files = {'A': {2000: 'a0', 2001: 'a1', 2002: 'a2'}, 'B': {2001: 'b1', 2002: 'b2', 2003: 'b3'}}
+    assert common_years(files) == [2001, 2002]
+
+
+def test_static_variables_come_from_the_first_file(paths):
+    with open_ensemble(paths, models) as stacked, xr.open_dataset(paths[0]) as first:
+        assert stacked.area.dims == ('y', 'x')
+        np.testing.assert_array_equal(stacked.area.values, first.area.values)
@@ -0,0 +1,31 @@
+import pytest
+
+from executor import default_workers
+
+variables = ['EXTRACT_WORKERS', 'SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE']
+
+
+@pytest.fixture(autouse=True)
+def clean_environment(monkeypatch):
+    for var in variables:
+        monkeypatch.delenv(var, raising=False)
+
+
+def test_serial_without_an_allocation():
+    assert default_workers() == 1
+
+
+def test_extract_workers_then_slurm(monkeypatch):
+    monkeypatch.setenv('SLURM_CPUS_ON_NODE', '16')
+    assert default_workers() == 16
+    monkeypatch.setenv('SLURM_CPUS_PER_TASK', '8')
+    assert default_workers() == 8
+    monkeypatch.setenv('EXTRACT_WORKERS', '3')
+    assert default_workers() == 3
+
+
+def test_invalid_values_are_ignored(monkeypatch, capsys):
+    monkeypatch.setenv('EXTRACT_WORKERS', 'many')
+    monkeypatch.setenv('SLURM_CPUS_PER_TASK', '0')
+    assert default_workers() == 1
+    assert 'ignoring non-integer EXTRACT_WORKERS=many' in capsys.readouterr().out
@@ -0,0 +1,89 @@
+import cftime
+import numpy as np
+import pytest
+import xarray as xr
+
+import get_AMOC
+
+basins = {'glo': 'zomsfglo', 'inp': 'zomsfinp'}  # without the AMOC row, so it is read on top
+latitudes = [26.5, 45.0]
+y_indices = [94, 110]
+depths = np.array([0., 250., 750., 1250., 1750., 2500., 4000.])
+
+
+@pytest.fixture
+def rows():
+    """MOC rows as read_moc_profiles returns them for overturning_rows(basins, y_indices)"""
+    var_names, row_indices = get_AMOC.overturning_rows(basins, y_indices)
+    rng = np.random.default_rng(0)
+    times = [cftime.DatetimeNoLeap(year, month, 15) for year in range(2000, 2004) for month in range(1, 13)]
+    values = 20 * rng.standard_normal((len(var_names), len(row_indices), len(times), depths.size))
+    values[..., -1] = np.nan   # below the sea floor
+    values[1, 1, 5, :] = np.nan  # a missing profile
+    return xr.DataArray(values, dims=('variable', 'y', 'time_counter', 'depthw'),
+                        coords={'variable': var_names, 'y': row_indices, 'time_counter': times, 'depthw': depths})
+
+
+def test_overturning_rows_add_the_amoc_row():
+    assert get_AMOC.overturning_rows(basins, y_indices) == (['zomsfglo', 'zomsfinp', 'zomsfatl'], [94, 110])
+    assert get_AMOC.overturning_rows({'atl': 'zomsfatl'}, [94]) == (['zomsfatl'], [94])
+
+
+def test_amoc_from_rows_is_the_maximum_over_depth(rows):
+    amoc = get_AMOC.amoc_from_rows(rows)
+    expected = rows.sel(variable='zomsfatl', y=94).max('depthw')
+    np.testing.assert_array_equal(amoc.values, expected.values)
+    assert amoc.name == 'AMOC'
+    assert str(amoc.time_counter.dtype).startswith('datetime64')
+
+
+def test_metrics_from_rows_match_xarray(rows):
+    metrics = get_AMOC.metrics_from_rows(rows, basins, latitudes, y_indices, depth_band=(500, 2000), rolling_years=3)
+    assert list(metrics.basin.values) == list(basins)
+    assert list(metrics.y_index.values) == y_indices
+    for i, var in enumerate(basins.values()):
+        for j, y in enumerate(y_indices):
+            profile = get_AMOC.pandas_times(rows.sel(variable=var, y=y, drop=True))
+            expected = {
+                'moc_max': profile.max('depthw'),
+                'moc_depth_of_max': profile.idxmax('depthw'),
+                'moc_band_mean': profile.sel(depthw=slice(500, 2000)).mean('depthw'),
+            }
+            for name, values in expected.items():
+                np.testing.assert_array_equal(metrics[name].values[i, j], values.values, err_msg=name)
+                annual = values.groupby('time_counter.year').mean('time_counter')
+                np.testing.assert_allclose(metrics[f'{name}_annual'].values[i, j], annual.values, rtol=1e-12)
+                rolling = annual.rolling(year=3, center=True, min_periods=1).mean()
+                np.testing.assert_allclose(metrics[f'{name}_rolling'].values[i, j], rolling.values, rtol=1e-12)
+    assert np.isnan(metrics.moc_depth_of_max.values[1, 1, 5])
+
+
+def test_band_mean_uses_absolute_depths(rows):
+    metrics = get_AMOC.metrics_from_rows(rows, basins, latitudes, y_indices, depth_band=(500, 2000))
+    negative = rows.assign_coords(depthw=-depths)
+    flipped = get_AMOC.metrics_from_rows(negative, basins, latitudes, y_indices, depth_band=(500, 2000))
+    np.testing.assert_array_equal(flipped.moc_band_mean.values, metrics.moc_band_mean.values)
+
+
+def test_empty_band_warns(rows, capsys):
+    metrics = get_AMOC.metrics_from_rows(rows, basins, latitudes, y_indices, depth_band=(5000, 6000))
+    assert 'no depthw level lies in 5000-6000 m' in capsys.readouterr().out
+    assert metrics.moc_band_mean.isnull().all()
+
+
+def test_amoc_is_kept_when_the_metrics_rows_fail(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_AMOC.catalog.mesh_cache, 'cache_dir', tmp_path / 'cache')
+    rng = np.random.default_rng(1)
+    for year in (2000, 2001):
+        times = [cftime.DatetimeNoLeap(year, month, 15) for month in range(1, 13)]
+        moc = xr.DataArray(rng.standard_normal((12, depths.size, 100, 1)), dims=('time_counter', 'depthw', 'y', 'x'),
+                           coords={'time_counter': times, 'depthw': depths})
+        # Only the Atlantic basin and no nav_lat, so the metrics rows can't be read
+        xr.Dataset({'zomsfatl': moc}).to_netcdf(tmp_path / f'M_1m_{year}0101_{year}1231_MOC.nc')
+    
+    result = get_AMOC.compute_overturning('M', 2000, 2001, str(tmp_path), str(tmp_path / 'out'),
+                                          basins, latitudes)
+    assert result is not None and result[1] is None
+    saved = list((tmp_path / 'out' / 'M').glob('*.nc'))
+    assert len(saved) == 1 and 'AMOC' in saved[0].name
+    assert result[0].sizes['time_counter'] == 24
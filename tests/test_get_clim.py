@@ -0,0 +1,110 @@
+import importlib
+
+import cftime
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import memory_budget
+from get_clim import climatology_plan, streaming_climatology
+
+
+def write_yearly_files(directory, calendar='standard'):
+    """Three yearly files with land cells, gaps in some years only, differing NaN patterns and time bounds"""
+    rng = np.random.default_rng(0)
+    files = []
+    for year in (2000, 2001, 2002):
+        starts = xr.date_range(f'{year}-01-01', periods=13, freq='MS', calendar=calendar, use_cftime=calendar != 'standard')
+        bounds = np.stack([np.asarray(starts[:-1]), np.asarray(starts[1:])], axis=1)
+        time = np.asarray(starts[:-1]) + (np.asarray(starts[1:]) - np.asarray(starts[:-1])) / 2
+        shape = (12, 2, 4, 5)
+        dims = ('time_counter', 'deptht', 'y', 'x')
+        dia = 10 * rng.random(shape)
+        dia[:, :, 0, :] = np.nan          # land
+        mix = dia + rng.random(shape)      # same NaN pattern as DIA
+        coc = rng.random(shape)
+        coc[:, :, 0, :] = np.nan
+        if year == 2001:
+            dia[3, :, 2, 2] = np.nan       # a gap in one year only
+            mix[3, :, 2, 2] = np.nan
+            coc[5, 1, 1, :] = np.nan       # a gap DIA and MIX don't have
+        coc[7, 0, 3, 4] = np.nan           # missing in every year: NaN in the climatology
+        ds = xr.Dataset(
+            {'DIA': (dims, dia), 'MIX': (dims, mix), 'COC': (dims, coc),
+             'PPT': (('time_counter', 'y', 'x'), rng.random(shape[:1] + shape[2:]).astype(np.float32)),
+             'time_counter_bounds': (('time_counter', 'axis_nbounds'), bounds),
+             'area': (('y', 'x'), np.ones(shape[2:]))},
+            coords={'time_counter': time},
+        )
+        files.append(str(directory / f'{calendar}_{year}.nc'))
+        ds.to_netcdf(files[-1])
+    return files
+
+
+@pytest.fixture
+def yearly_files(tmp_path):
+    return write_yearly_files(tmp_path)
+
+
+def original_climatology(files):
+    """The open_mfdataset + groupby('time_counter.month') climatology, on the concatenated years"""
+    ds = xr.concat([xr.open_dataset(f) for f in files], dim='time_counter', data_vars='minimal')
+    grouped = ds.drop_vars('area').groupby('time_counter.month')
+    return grouped.mean('time_counter'), ds.drop_vars(['area', 'time_counter_bounds']).groupby('time_counter.month').std()
+
+
+@pytest.mark.parametrize('with_std', [False, True])
+def test_streaming_climatology_matches_groupby(yearly_files, with_std):
+    mean, std = original_climatology(yearly_files)
+    clim = streaming_climatology(yearly_files, with_std=with_std)
+    assert list(clim.time.values) == list(range(1, 13))
+    for var in ('DIA', 'MIX', 'COC', 'PPT'):
+        assert clim[var].dtype == mean[var].dtype
+        rtol = 1e-6 if clim[var].dtype == np.float32 else 1e-12
+        np.testing.assert_allclose(clim[var].values, mean[var].values, rtol=rtol, err_msg=var)
+        if with_std:
+            np.testing.assert_allclose(clim[f'{var}_std'].values, std[var].values, rtol=rtol, atol=1e-12, err_msg=var)
+        else:
+            assert f'{var}_std' not in clim
+    assert np.isnan(clim.COC.values[7, 0, 3, 4])
+    assert clim.area.dims == ('time', 'y', 'x')
+    assert 'time_counter_bounds_std' not in clim
+    assert_same_times(clim.time_counter_bounds, mean.time_counter_bounds)
+
+
+def assert_same_times(times, expected):
+    """Times equal to within a microsecond (both are averaged as floats)"""
+    assert times.dtype == expected.dtype
+    deltas = (times.values - expected.values).ravel()
+    assert max(abs(pd.Timedelta(d).total_seconds()) for d in deltas) < 1e-6
+
+
+def test_cftime_bounds_are_averaged(tmp_path):
+    files = write_yearly_files(tmp_path, calendar='noleap')
+    mean, _ = original_climatology(files)
+    clim = streaming_climatology(files)
+    assert isinstance(clim.time_counter_bounds.values[0, 0], cftime.DatetimeNoLeap)
+    assert_same_times(clim.time_counter_bounds, mean.time_counter_bounds)
+
+
+def test_variable_batches_match_one_pass(yearly_files):
+    whole = streaming_climatology(yearly_files, with_std=True)
+    for batch in (['COC'], ['DIA', 'PPT']):
+        part = streaming_climatology(yearly_files, with_std=True, variables=batch)
+        for var in batch:
+            np.testing.assert_array_equal(part[var].values, whole[var].values)
+            np.testing.assert_array_equal(part[f'{var}_std'].values, whole[f'{var}_std'].values)
+
+
+def test_budget_never_switches_to_streaming(yearly_files, monkeypatch):
+    monkeypatch.setattr(memory_budget, 'max_memory', '1K')
+    assert climatology_plan(yearly_files[0], len(yearly_files), False) == (False, [None])
+    streaming, batches = climatology_plan(yearly_files[0], len(yearly_files), True)
+    assert streaming and len(batches) > 1
+
+
+def test_no_budget_without_an_explicit_one(monkeypatch):
+    monkeypatch.setenv('SLURM_MEM_PER_NODE', '32000')
+    monkeypatch.delenv('EXTRACT_MAX_MEMORY', raising=False)
+    assert importlib.reload(memory_budget).budget() is None
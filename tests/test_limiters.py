@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import limiters
+
+
+def original_limiters(w, tmask):
+    """The xarray concat/fillna/argmin formulation extract-LoP used before limiter_kernel"""
+    tm_broad = xr.broadcast(tmask, w['nav_lat'])[0].expand_dims(time_counter=w.time_counter.values)
+    out = xr.Dataset()
+    for pft in limiters.pfts:
+        varlist = [f'lim3fe_{pft}', f'lim4po4_{pft}', f'lim6din_{pft}']
+        order = ['fe', 'p', 'n']
+        if pft == 'dia':
+            varlist.insert(2, f'lim5si_{pft}')
+            order.insert(2, 'si')
+        stacked = xr.concat([w[v] for v in varlist], dim='nutrient')
+        stacked_for_min = stacked.where(stacked != 0, np.nan).fillna(np.inf)
+        lv = stacked_for_min.min(dim='nutrient')
+        out[f'LV_{pft.upper()}'] = lv.where(np.isfinite(lv.values), np.nan)
+        min_idx = stacked_for_min.argmin(dim='nutrient').values.astype(float)
+        min_idx[tm_broad.transpose(*lv.dims).values == 0] = np.nan
+        ln = np.full_like(min_idx, np.nan)
+        for i, nutr in enumerate(order):
+            ln[min_idx == i] = limiters.limiter_codes[nutr]
+        out[f'LN_{pft.upper()}'] = lv.copy(data=ln)
+    return out
+
+
+@pytest.fixture
+def limphy():
+    """Synthetic limphy dataset with land, NaN and zero terms, and exact ties"""
+    rng = np.random.default_rng(0)
+    shape = (4, 3, 5, 6)
+    dims = ('time_counter', 'deptht', 'y', 'x')
+    tmask = np.ones(shape[1:])
+    tmask[:, 0, :] = 0   # land row
+    tmask[2, :, :2] = 0  # sea floor
+    w = xr.Dataset(coords={'time_counter': np.arange(shape[0])})
+    w['nav_lat'] = (('y', 'x'), np.repeat(np.linspace(-60, 60, shape[2])[:, None], shape[3], axis=1))
+    for pft in limiters.pfts:
+        for nutr in limiters.nutrient_order:
+            if nutr == 'si' and pft != 'dia':
+                continue
+            values = rng.random(shape).round(1)  # rounding gives plenty of ties
+            values[..., tmask == 0] = np.nan
+            values[0, 0, 1, 1] = 0  # zero terms never limit
+            values[1, 1, 2, 3] = np.nan
+            w[f'{limiters.nutrient_prefixes[nutr]}_{pft}'] = (dims, values)
+    # Every term tied, and every term zero or NaN in one cell
+    for pft in limiters.pfts:
+        for nutr in limiters.nutrient_order:
+            name = f'{limiters.nutrient_prefixes[nutr]}_{pft}'
+            if name in w:
+                w[name][2, 1, 3, 4] = 0.5
+                w[name][3, 2, 4, 5] = 0 if nutr == 'fe' else np.nan
+    return w, xr.DataArray(tmask, dims=('deptht', 'y', 'x'))
+
+
+@pytest.mark.parametrize('time_block', [1, 3, None])
+def test_compute_limiters_matches_original(limphy, time_block):
+    w, tmask = limphy
+    expected = original_limiters(w, tmask)
+    result = limiters.compute_limiters(w, tmask, time_block=time_block)
+    for var in expected.data_vars:
+        assert result[var].dims == expected[var].dims
+        np.testing.assert_array_equal(result[var].values, expected[var].values, err_msg=var)
+
+
+def test_ties_go_to_first_nutrient(limphy):
+    w, tmask = limphy
+    result = limiters.compute_limiters(w, tmask)
+    assert (result.LN_DIA[2, 1, 3, 4] == limiters.limiter_codes['fe']).item()
+    assert (result.LV_DIA[2, 1, 3, 4] == 0.5).item()
+    # No limiter at all: LV is NaN, LN still codes the first slot on ocean cells
+    assert np.isnan(result.LV_MIX[3, 2, 4, 5].item())
+    assert (result.LN_MIX[3, 2, 4, 5] == limiters.limiter_codes['fe']).item()
+    assert np.isnan(result.LN_MIX.values[..., tmask.values == 0]).all()
+
+
+def test_lazy_limiters_match_eager(limphy):
+    pytest.importorskip('dask')
+    w, tmask = limphy
+    eager = limiters.compute_limiters(w, tmask)
+    lazy = limiters.compute_limiters(w.chunk({'time_counter': 2}), tmask).compute()
+    for var in eager.data_vars:
+        np.testing.assert_array_equal(lazy[var].values, eager[var].values, err_msg=var)
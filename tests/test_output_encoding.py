@@ -0,0 +1,16 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from output_encoding import netcdf_encoding, profiles
+
+
+@pytest.mark.parametrize('profile', list(profiles))
+@pytest.mark.parametrize('name', ['NO3', None])
+def test_dataset_and_dataarray_outputs_write(tmp_path, profile, name):
+    da = xr.DataArray(np.random.default_rng(0).random((2, 3, 4, 5)), dims=('time_counter', 'deptht', 'y', 'x'), name=name)
+    for i, obj in enumerate([da, da.to_dataset(name='NO3')]):
+        path = tmp_path / f'{i}.nc'
+        obj.to_netcdf(path, encoding=netcdf_encoding(obj, profile))
+        with xr.open_dataset(path) as ds:
+            np.testing.assert_allclose(next(iter(ds.data_vars.values())).values, da.values, rtol=1e-6)
@@ -0,0 +1,38 @@
+import pipeline
+
+
+def make_targets(tmp_path):
+    """Two chained targets whose actions would fail if they ran"""
+    raw, clim, integral = tmp_path / 'raw.nc', tmp_path / 'clim.nc', tmp_path / 'clim_int.nc'
+    return [
+        pipeline.make_target('get_clim', 'M', [raw], [clim], {'yrst': 2000}, ('missing_script', 'run')),
+        pipeline.make_target('depth_integrate', 'M', [clim], [integral], {}, ('missing_script', 'run')),
+    ]
+
+
+def test_mark_built_adopts_existing_outputs(tmp_path):
+    targets = make_targets(tmp_path)
+    state_file = tmp_path / 'state.json'
+    for name in ['raw.nc', 'clim.nc', 'clim_int.nc']:
+        (tmp_path / name).write_text(name)
+
+    counts = pipeline.run_pipeline(targets, state_file, dry_run=True)
+    assert counts['built'] == 2
+
+    counts = pipeline.run_pipeline(targets, state_file, mark_built=True)
+    assert counts['marked'] == 2 and counts['built'] == 0
+    assert sorted(pipeline.load_state(state_file)) == sorted(t['name'] for t in targets)
+
+    counts = pipeline.run_pipeline(targets, state_file, dry_run=True)
+    assert counts['up_to_date'] == 2 and counts['built'] == 0
+
+
+def test_mark_built_leaves_missing_outputs_stale(tmp_path):
+    targets = make_targets(tmp_path)
+    state_file = tmp_path / 'state.json'
+    for name in ['raw.nc', 'clim.nc']:
+        (tmp_path / name).write_text(name)
+
+    counts = pipeline.run_pipeline(targets, state_file, mark_built=True)
+    assert counts['marked'] == 1 and counts['skipped'] == 1
+    assert list(pipeline.load_state(state_file)) == [targets[0]['name']]
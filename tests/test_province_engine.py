@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from province_engine import build_province_weights, grouped_province_means, grouped_province_profiles
+
+
+@pytest.fixture
+def field():
+    """(time_counter, y, x) field with land (NaN) cells and a province all NaN at one step"""
+    rng = np.random.default_rng(0)
+    data = rng.random((3, 6, 8))
+    data[:, 0, :] = np.nan      # land row
+    data[1, 2:4, 5:] = np.nan   # missing values inside provinces
+    data[2, 4:, :4] = np.nan    # all of province B at the last step
+    return xr.DataArray(data, dims=('time_counter', 'y', 'x'), coords={'time_counter': [0, 1, 2]})
+
+
+@pytest.fixture
+def masks():
+    """Overlapping area-weighted masks, as mask.csize * MA.<province>"""
+    area = xr.DataArray(np.linspace(1, 2, 48).reshape(6, 8), dims=('y', 'x'))
+    inside_a = xr.zeros_like(area)
+    inside_a[1:4, 2:] = 1
+    inside_b = xr.zeros_like(area)
+    inside_b[4:, :4] = 1
+    return {'GO': area, 'A': area * inside_a, 'B': area * inside_b}
+
+
+def test_unweighted_means_match_where_mean(field, masks):
+    weights = build_province_weights(masks=masks, weighted=False)
+    means = grouped_province_means(field, weights)
+    for name, prov_mask in masks.items():
+        expected = field.where(prov_mask > 0).mean(('y', 'x'))
+        np.testing.assert_allclose(means.sel(province=name).values, expected.values, rtol=1e-12)
+    assert np.isnan(means.sel(province='B').values[2])
+
+
+def test_weighted_means_match_xarray_weighted(field, masks):
+    weights = build_province_weights(masks=masks)
+    means = grouped_province_means(field, weights)
+    for name, prov_mask in masks.items():
+        expected = field.where(prov_mask > 0).weighted(prov_mask.fillna(0)).mean(('y', 'x'))
+        np.testing.assert_allclose(means.sel(province=name).values, expected.values, rtol=1e-12)
+
+
+def test_label_provinces_match_xarray_weighted(field, masks):
+    labels = xr.DataArray(np.zeros((6, 8)), dims=('y', 'x'))
+    labels[1:4, 2:] = 1
+    labels[4:, :4] = 2
+    labels[0, 0] = np.nan
+    area = masks['GO']
+    weights = build_province_weights(labels=labels, label_names={1: 'A', 2: 'B'}, area=area)
+    means = grouped_province_means(field, weights)
+    for label, name in ((1, 'A'), (2, 'B')):
+        expected = field.where(labels == label).weighted(area).mean(('y', 'x'))
+        np.testing.assert_allclose(means.sel(province=name).values, expected.values, rtol=1e-12)
+
+
+def test_other_dims_are_averaged_over(field, masks):
+    field_3d = xr.concat([field, 2 * field], dim='deptht').transpose('time_counter', 'deptht', 'y', 'x')
+    weights = build_province_weights(masks=masks, weighted=False)
+    means = grouped_province_means(field_3d, weights)
+    assert means.dims == ('province', 'time_counter')
+    for name, prov_mask in masks.items():
+        expected = field_3d.where(prov_mask > 0).mean(('deptht', 'y', 'x'))
+        np.testing.assert_allclose(means.sel(province=name).values, expected.values, rtol=1e-12)
+
+
+def test_lazy_means_match_eager(field, masks):
+    pytest.importorskip('dask')
+    weights = build_province_weights(masks=masks)
+    eager = grouped_province_means(field, weights)
+    lazy = grouped_province_means(field.chunk({'time_counter': 2}), weights).compute()
+    np.testing.assert_array_equal(lazy.values, eager.values)
+
+
+@pytest.fixture
+def column():
+    """(time_counter, deptht, y, x) field with land columns and NaNs below the sea floor, and its e3t"""
+    rng = np.random.default_rng(1)
+    data = rng.random((2, 4, 6, 8))
+    data[:, :, 0, :] = np.nan    # land
+    data[:, 2:, 4:, :3] = np.nan  # below the sea floor
+    data[1, 3, 1:4, 2:] = np.nan  # province A has no water at one level and step
+    depths = [5., 50., 150., 600.]
+    field = xr.DataArray(data, dims=('time_counter', 'deptht', 'y', 'x'),
+                         coords={'time_counter': [0, 1], 'deptht': depths})
+    e3t = xr.DataArray((1 + rng.random((4, 6, 8))) * np.array([10., 90., 110., 900.])[:, None, None],
+                       dims=('deptht', 'y', 'x'), coords={'deptht': depths})
+    return field, e3t
+
+
+def test_profiles_match_xarray_weighted(column, masks):
+    field, e3t = column
+    weights = build_province_weights(masks=masks)
+    profiles = grouped_province_profiles(field, weights, e3t)
+    assert profiles.dims == ('province', 'deptht', 'time_counter')
+    for name, prov_mask in masks.items():
+        expected = field.where(prov_mask > 0).weighted(prov_mask * e3t).mean(('y', 'x'))
+        np.testing.assert_allclose(profiles.sel(province=name).values, expected.transpose('deptht', ...).values,
+                                   rtol=1e-12)
+    assert np.isnan(profiles.sel(province='A').values[3, 1])
+
+
+def test_band_profiles_match_xarray_weighted(column, masks):
+    field, e3t = column
+    bands = [(0, 100), (100, 1000), (1000, 2000)]
+    weights = build_province_weights(masks=masks, weighted=False)
+    profiles = grouped_province_profiles(field, weights, e3t, bands=bands)
+    assert list(profiles.depth_band.values) == ['0-100', '100-1000', '1000-2000']
+    for name, prov_mask in masks.items():
+        for i, (top, bottom) in enumerate(bands):
+            in_band = (field.deptht >= top) & (field.deptht < bottom)
+            expected = field.where((prov_mask > 0) & in_band).weighted(e3t.where(in_band, 0)).mean(('deptht', 'y', 'x'))
+            np.testing.assert_allclose(profiles.sel(province=name).values[i], expected.values, rtol=1e-12)
+    assert np.isnan(profiles.values[:, 2]).all()  # no level in the deepest band
+
+
+def test_lazy_profiles_match_eager(column, masks):
+    pytest.importorskip('dask')
+    field, e3t = column
+    weights = build_province_weights(masks=masks)
+    eager = grouped_province_profiles(field, weights, e3t, bands=[(0, 100), (100, 1000)])
+    lazy = grouped_province_profiles(field.chunk({'time_counter': 1}), weights, e3t, bands=[(0, 100), (100, 1000)])
+    np.testing.assert_array_equal(lazy.compute().values, eager.values)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from regrid_clim import bilinear_weights, regrid_dataset, target_grid
+
+# Regular source grid (with a halo column past 360E) as 2D glamt/gphit, and an r36x18 target
+src_lon = np.arange(-2., 362., 3.)
+src_lat = np.arange(-88.5, 90., 3.)
+nlon, nlat = 36, 18
+
+
+@pytest.fixture
+def weights():
+    glamt, gphit = np.meshgrid(src_lon, src_lat)
+    return bilinear_weights(glamt, gphit, *target_grid(nlon, nlat))
+
+
+@pytest.fixture
+def dataset():
+    """(time_counter, deptht, y, x) field with land (NaN) cells, and a variable without (y, x)"""
+    rng = np.random.default_rng(0)
+    values = rng.random((2, 3, src_lat.size, src_lon.size))
+    values[:, :, 20:30, 40:60] = np.nan  # a continent
+    values[1, 2, :, :] = np.nan          # a level with no ocean at all
+    values[0, 0, 10, 10] = np.nan        # an isolated missing cell
+    return xr.Dataset({
+        'DIA': (('time_counter', 'deptht', 'y', 'x'), values),
+        'time_bnds': (('time_counter', 'nb'), np.zeros((2, 2))),
+    })
+
+
+def original_regrid(da):
+    """Bilinear interpolation with NaN corners left out and the rest renormalised, in xarray"""
+    lon, lat = target_grid(nlon, nlat)
+    source = da.rename({'y': 'lat', 'x': 'lon'}).assign_coords(lat=src_lat, lon=src_lon)
+    valid = source.notnull().astype(float)
+    weighted_sum = source.fillna(0).interp(lat=lat, lon=lon)
+    total_weight = valid.interp(lat=lat, lon=lon)
+    return (weighted_sum / total_weight).where(total_weight > 0)
+
+
+def test_regrid_matches_xarray_interp(weights, dataset):
+    result = regrid_dataset(dataset, weights, nlon, nlat)
+    expected = original_regrid(dataset.DIA)
+    assert result.DIA.dims == dataset.DIA.dims
+    np.testing.assert_allclose(result.DIA.values, expected.values, rtol=1e-10, atol=1e-12)
+    assert np.isnan(result.DIA.values[1, 2]).all()
+    assert result.time_bnds.identical(dataset.time_bnds)
+
+
+def test_regrid_reproduces_linear_fields(weights):
+    glamt, gphit = np.meshgrid(src_lon, src_lat)
+    linear = xr.Dataset({'f': (('y', 'x'), 2 * glamt - 3 * gphit + 1)})
+    result = regrid_dataset(linear, weights, nlon, nlat)
+    np.testing.assert_allclose(result.f.values, 2 * result.lon.values - 3 * result.lat.values[:, None] + 1, atol=1e-9)
+
+
+def test_every_target_point_has_weights_summing_to_one(weights):
+    assert weights.shape == (nlat * nlon, src_lat.size * src_lon.size)
+    np.testing.assert_allclose(np.asarray(weights.sum(axis=1)).ravel(), 1, atol=1e-12)
@@ -0,0 +1,61 @@
+import os
+import time
+
+import pytest
+
+import worker
+
+
+def age(path, seconds):
+    """Make a file look last touched seconds ago"""
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_serve_runs_jobs_with_a_heartbeat(tmp_path):
+    job_id = worker.submit({'script': 'cli', 'function': 'parse_value', 'args': ['[10, 100]']}, tmp_path)
+    paths = worker.spool_paths(tmp_path)
+    assert worker.serve(tmp_path, poll_interval=0.01, idle_timeout=0.2) == 1
+    record = worker.wait(job_id, tmp_path)
+    assert record['status'] == 'done' and record['result'] == [10, 100]
+    assert not list(paths['workers'].iterdir()) and not list(paths['running'].iterdir())
+
+
+def test_abandoned_jobs_fail_when_a_worker_starts(tmp_path):
+    paths = worker.spool_paths(tmp_path)
+    job_id = worker.submit({'script': 'cli', 'function': 'parse_value', 'args': ['1']}, tmp_path)
+    running = worker.next_job(paths)
+    age(running, 120)
+
+    assert worker.serve(tmp_path, poll_interval=0.01, idle_timeout=0.05, heartbeat_timeout=60) == 0
+    record = worker.wait(job_id, tmp_path)
+    assert record['status'] == 'failed' and 'stopped' in record['error']
+    assert not running.exists()
+
+
+def test_wait_stops_when_the_running_job_has_no_heartbeat(tmp_path):
+    paths = worker.spool_paths(tmp_path)
+    job_id = worker.submit({'script': 'cli', 'function': 'parse_value', 'args': ['1']}, tmp_path)
+    age(worker.next_job(paths), 120)
+    with pytest.raises(RuntimeError, match='stopped'):
+        worker.wait(job_id, tmp_path, poll_interval=0.01, heartbeat_timeout=60)
+
+
+def test_wait_times_out_without_a_live_worker(tmp_path, capsys):
+    job_id = worker.submit({'script': 'cli', 'function': 'parse_value', 'args': ['1']}, tmp_path)
+    with pytest.raises(TimeoutError):
+        worker.wait(job_id, tmp_path, poll_interval=0.01, no_worker_timeout=0.05)
+    assert 'No live worker' in capsys.readouterr().out
+
+
+def test_heartbeat_keeps_the_running_job_fresh(tmp_path):
+    paths = worker.spool_paths(tmp_path)
+    worker.submit({'script': 'cli', 'function': 'parse_value', 'args': ['1']}, tmp_path)
+    job_file = worker.next_job(paths)
+    age(job_file, 120)
+    with worker.heartbeat(paths, 0.01) as current:
+        current['job'] = job_file
+        time.sleep(0.1)
+        assert worker.live_workers(paths, 1)
+        assert time.time() - job_file.stat().st_mtime < 1
+    assert not worker.live_workers(paths, 1)
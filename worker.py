@@ -0,0 +1,436 @@
+import contextlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+import instrument
+from cli import load_script
+from executor import default_workers, run_units, shared_resource
+from mesh_cache import cached_dataset
+
+# ===== INPUTS =====
+
+# Spool directory shared by the worker and the submitters (EXTRACT_SPOOL overrides).
+# On /gpfs it lets jobs be submitted from the login node to a worker on a compute node.
+spool_dir = os.environ.get('EXTRACT_SPOOL', str(Path.home() / '.cache' / 'EXTRACT' / 'spool'))
+poll_interval = 1.0  # seconds between looks at the queue
+idle_timeout = 3600  # exit after this many seconds without a job (None: never)
+heartbeat_timeout = 60  # a worker (and the job it runs) is gone after this many seconds without a heartbeat
+no_worker_timeout = 600  # submit: give up after this many seconds with no live worker (None: never)
+n_workers = default_workers()  # Processes for jobs given as a list of units
+
+# Scripts imported and geometry loaded when the worker starts (see warm_up)
+preload = [
+    'extract-LoP',
+    'create_LNL_files',
+    'depth_integrate',
+    'compute_province_means',
+    'compute_latitudinal_profiles',
+    'regrid_clim',
+    'get_clim',
+    'get_AMOC',
+]
+
+# Geometry inputs are loaded once for the worker's lifetime, so jobs can't change them
+fixed_inputs = ['mesh_file', 'mask_file', 'ma_file', 'cdomask_file', 'atl_file',
+                'province_labels_file', 'province_labels_var', 'area_weighted', 'nlon', 'nlat',
+                'native_atl_file', 'lat_var', 'lat_edges']
+
+# ===== FUNCTIONS =====
+
+def spool_paths(spool_dir):
+    """Queue directories: incoming (submitted), running, done (results and logs), workers (heartbeats)"""
+    paths = {name: Path(spool_dir) / name for name in ('incoming', 'running', 'done', 'workers')}
+    for path in paths.values():
+        path.mkdir(parents=True, exist_ok=True)
+    return paths
+
+
+def warm_up(scripts):
+    """
+    Import scripts and load the geometry their work units use.
+
+    Resources are loaded into the same per-process store the units read
+    (executor.shared_resource), under the same names, so jobs find them
+    resident. Units run on a process pool inherit them when the pool forks.
+
+    Parameters
+    ----------
+    scripts : list of str
+        Script names, e.g. ['extract-LoP', 'compute_province_means']
+
+    Returns
+    -------
+    dict
+        Script name -> module (scripts that failed to load are left out)
+    """
+    loaders = {
+        'extract-LoP': lambda m: shared_resource('mesh_tmask', cached_dataset, m.mesh_file, ['tmask']),
+        'create_LNL_files': lambda m: shared_resource('mesh_e3t_tmask', cached_dataset, m.mesh_file, ['e3t_0', 'tmask']),
+        'depth_integrate': lambda m: shared_resource('nicedims_e3t', cached_dataset, m.mask_file, ['e3t_0']),
+        'compute_province_means': lambda m: shared_resource('province_mask_weights', m.load_province_weights),
+        'compute_latitudinal_profiles': lambda m: shared_resource('ATL_csize', m.load_atl_csize),
+        'regrid_clim': lambda m: shared_resource('regrid_weights', m.load_weights, m.mesh_file, m.nlon, m.nlat),
+    }
+    modules = {}
+    for name in scripts:
+        t0 = time.perf_counter()
+        try:
+            modules[name] = load_script(name)
+            if name in loaders:
+                loaders[name](modules[name])
+            print(f"  Loaded {name} ({time.perf_counter() - t0:.1f} s)", flush=True)
+        except Exception as e:
+            print(f"  Warning: could not warm up {name}: {e}", flush=True)
+    return modules
+
+
+def resolve_argument(value):
+    """Job argument: {"resource": name} becomes the resident resource, anything else is passed as is"""
+    if isinstance(value, dict) and set(value) == {'resource'}:
+        return shared_resource(value['resource'])
+    return value
+
+
+def describe_result(result):
+    """JSON-safe summary of a job's return value (datasets are described, not copied)"""
+    if result is None or isinstance(result, (bool, int, float, str)):
+        return result
+    if isinstance(result, (np.integer, np.floating, np.bool_)):
+        return result.item()
+    if isinstance(result, (list, tuple)):
+        return [describe_result(r) for r in result]
+    if isinstance(result, dict):
+        return {str(k): describe_result(v) for k, v in result.items()}
+    if isinstance(result, (xr.Dataset, xr.DataArray)):
+        variables = list(result.data_vars) if isinstance(result, xr.Dataset) else [result.name]
+        return {'type': type(result).__name__, 'sizes': dict(result.sizes), 'variables': variables}
+    return repr(result)
+
+
+@contextlib.contextmanager
+def job_inputs(module, inputs):
+    """Set a script's INPUTS for one job and restore them afterwards"""
+    refused = [key for key in inputs if key in fixed_inputs]
+    if refused:
+        raise ValueError(f"inputs {refused} are fixed while the worker runs (restart it to change them)")
+    saved = {key: getattr(module, key) for key in inputs if hasattr(module, key)}
+    try:
+        # Inside the try: a bad key raises after the keys before it are set
+        load_script(module.__name__, inputs)
+        yield
+    finally:
+        for key, value in saved.items():
+            setattr(module, key, value)
+
+
+def run_job(job):
+    """
+    Run one job against the resident state.
+
+    A job names a script function and its arguments:
+
+        {"script": "create_LNL_files", "function": "process_unit",
+         "units": [["TOM12_TJ_LA50", 2023]]}
+
+        {"script": "compute_province_means", "function": "compute_averages",
+         "args": ["TOM12_TJ_LA50", "ptrc", "NO3", 0, {"resource": "province_mask_weights"},
+                  "/gpfs/data/greenocean/software/runs/"],
+         "inputs": {"clims_dir": "/gpfs/home/abc/clims/"}}
+
+    "units" runs the function once per unit with executor.run_units (on
+    n_workers processes, forked from the warm worker); otherwise it is
+    called once with "args" and "kwargs". "inputs" overrides the script's
+    INPUTS for this job only.
+
+    Returns
+    -------
+    object
+        JSON-safe description of the function's result(s)
+    """
+    module = load_script(job['script'])
+    func = getattr(module, job['function'])
+    with job_inputs(module, job.get('inputs', {})):
+        if 'units' in job:
+            results = run_units(func, job['units'], job.get('n_workers', n_workers),
+                                error_format='  ERROR in {0}: {e}')
+            return describe_result(results)
+        args = [resolve_argument(a) for a in job.get('args', [])]
+        kwargs = {k: resolve_argument(v) for k, v in job.get('kwargs', {}).items()}
+        return describe_result(func(*args, **kwargs))
+
+
+def next_job(paths):
+    """Claim the oldest submitted job (an atomic rename, so several workers can share a spool)"""
+    for job_file in sorted(paths['incoming'].glob('*.json')):
+        claimed = paths['running'] / job_file.name
+        try:
+            # The mtime of a running job is its heartbeat (see heartbeat), not its submission time
+            os.utime(job_file)
+            job_file.rename(claimed)
+        except FileNotFoundError:
+            continue  # taken by another worker
+        return claimed
+    return None
+
+
+@contextlib.contextmanager
+def heartbeat(paths, interval):
+    """
+    Touch this worker's file in workers/, and the job it is running, every
+    interval seconds from a background thread (so also during long jobs).
+
+    Yields a dict whose 'job' entry is the running job file, or None.
+    """
+    beat = paths['workers'] / f'{socket.gethostname()}-{os.getpid()}'
+    current = {'job': None}
+    stop = threading.Event()
+
+    def touch():
+        while True:
+            beat.touch()
+            job_file = current['job']
+            if job_file is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(job_file)
+            if stop.wait(interval):
+                return
+
+    thread = threading.Thread(target=touch, daemon=True)
+    thread.start()
+    try:
+        yield current
+    finally:
+        stop.set()
+        thread.join()
+        beat.unlink(missing_ok=True)
+
+
+def live_workers(paths, timeout):
+    """Names of the workers whose heartbeat is less than timeout seconds old"""
+    now = time.time()
+    names = []
+    for beat in paths['workers'].iterdir():
+        with contextlib.suppress(FileNotFoundError):
+            if now - beat.stat().st_mtime < timeout:
+                names.append(beat.name)
+    return names
+
+
+def fail_abandoned_jobs(paths, timeout):
+    """
+    Record the jobs left in running/ by a worker that stopped (no heartbeat
+    for timeout seconds) as failed, so their submitters stop waiting.
+
+    They are not requeued: a job that took its worker down (e.g. out of
+    memory) would take the next one down too.
+
+    Returns
+    -------
+    list of str
+        Ids of the failed jobs
+    """
+    failed = []
+    for job_file in sorted(paths['running'].glob('*.json')):
+        try:
+            silent = time.time() - job_file.stat().st_mtime
+            if silent < timeout:
+                continue
+            job = json.loads(job_file.read_text())
+        except FileNotFoundError:
+            continue
+        except ValueError:
+            job = None
+        record = {'id': job_file.stem, 'job': job, 'status': 'failed',
+                  'error': f"the worker running it stopped (no heartbeat for {silent:.0f} s); resubmit the job"}
+        _write_json(paths['done'] / f'{job_file.stem}.json', record)
+        job_file.unlink(missing_ok=True)
+        print(f"  Job {job_file.stem} was abandoned by a stopped worker, recorded as failed", flush=True)
+        failed.append(job_file.stem)
+    return failed
+
+
+def serve(spool_dir, poll_interval=1.0, idle_timeout=None, heartbeat_timeout=60):
+    """
+    Run submitted jobs one after another until idle for idle_timeout seconds.
+
+    Each job's output goes to done/<id>.log as it is printed (see wait),
+    and its status and result to done/<id>.json when it finishes. While it
+    runs, the worker keeps a heartbeat (see heartbeat); jobs left running
+    by a stopped worker are failed when the next one starts.
+
+    Returns
+    -------
+    int
+        Number of jobs run
+    """
+    paths = spool_paths(spool_dir)
+    fail_abandoned_jobs(paths, heartbeat_timeout)
+    with heartbeat(paths, heartbeat_timeout / 4) as current:
+        return _serve_jobs(paths, current, poll_interval, idle_timeout)
+
+
+def _serve_jobs(paths, current, poll_interval, idle_timeout):
+    """Job loop of serve(); current['job'] is the running job file for the heartbeat"""
+    n_jobs = 0
+    idle_since = time.time()
+    print(f"Waiting for jobs in {paths['incoming']}", flush=True)
+
+    while idle_timeout is None or time.time() - idle_since < idle_timeout:
+        claimed = next_job(paths)
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+
+        current['job'] = claimed
+        job_id = claimed.stem
+        log_file = paths['done'] / f'{job_id}.log'
+        record = {'id': job_id, 'started': time.time()}
+        print(f"Job {job_id}...", flush=True)
+        with open(log_file, 'w', buffering=1) as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            try:
+                job = json.loads(claimed.read_text())
+                record['job'] = job
+                record['result'] = run_job(job)
+                record['status'] = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                record['status'] = 'failed'
+                record['error'] = str(e)
+        record['elapsed_s'] = time.time() - record['started']
+        _write_json(paths['done'] / f'{job_id}.json', record)
+        current['job'] = None
+        claimed.unlink()
+        print(f"  {record['status']} in {record['elapsed_s']:.1f} s", flush=True)
+
+        n_jobs += 1
+        idle_since = time.time()
+
+    print(f"No jobs for {idle_timeout} s, exiting")
+    return n_jobs
+
+
+def _write_json(path, data):
+    """Write JSON atomically (readers never see a partial file)"""
+    tmp = Path(f'{path}.{uuid.uuid4().hex}.tmp')
+    tmp.write_text(json.dumps(data, indent=1))
+    os.replace(tmp, path)
+
+
+def submit(job, spool_dir):
+    """
+    Queue a job for a running worker.
+
+    Returns
+    -------
+    str
+        Job id (results appear as done/<id>.json)
+    """
+    paths = spool_paths(spool_dir)
+    job_id = f'{time.time_ns()}-{uuid.uuid4().hex[:8]}'
+    tmp = paths['incoming'] / f'.{job_id}.tmp'
+    tmp.write_text(json.dumps(job))
+    os.replace(tmp, paths['incoming'] / f'{job_id}.json')
+    return job_id
+
+
+def wait(job_id, spool_dir, poll_interval=0.5, heartbeat_timeout=60, no_worker_timeout=None):
+    """
+    Stream a job's output to stdout until it finishes.
+
+    Parameters
+    ----------
+    job_id : str
+        Id returned by submit()
+    spool_dir : str
+        Spool directory of the worker
+    poll_interval : float, optional
+        Seconds between looks at the job
+    heartbeat_timeout : float, optional
+        Seconds without a heartbeat after which the worker running the job
+        is taken to have stopped
+    no_worker_timeout : float, optional
+        Give up after this many seconds with the job queued and no live
+        worker (None: wait for one to start)
+
+    Returns
+    -------
+    dict
+        The job's record (status, result, elapsed_s, ...)
+
+    Raises
+    ------
+    RuntimeError
+        If the worker running the job stopped
+    TimeoutError
+        If no worker was alive for no_worker_timeout seconds
+    """
+    paths = spool_paths(spool_dir)
+    log_file = paths['done'] / f'{job_id}.log'
+    result_file = paths['done'] / f'{job_id}.json'
+    running_file = paths['running'] / f'{job_id}.json'
+    position = 0
+    no_worker_since = None
+    while True:
+        finished = result_file.exists()
+        if log_file.exists():
+            with open(log_file, 'r') as f:
+                f.seek(position)
+                text = f.read()
+                position = f.tell()
+            if text:
+                print(text, end='', flush=True)
+        if finished:
+            return json.loads(result_file.read_text())
+
+        try:
+            silent = time.time() - running_file.stat().st_mtime
+        except FileNotFoundError:
+            silent = None  # still queued
+        if silent is not None and silent > heartbeat_timeout and not result_file.exists():
+            raise RuntimeError(f"the worker running job {job_id} stopped (no heartbeat for {silent:.0f} s)")
+        if silent is not None or live_workers(paths, heartbeat_timeout):
+            no_worker_since = None
+        elif no_worker_since is None:
+            no_worker_since = time.time()
+            print(f"  No live worker serves {spool_dir}; job {job_id} stays queued until one starts", flush=True)
+        elif no_worker_timeout is not None and time.time() - no_worker_since > no_worker_timeout:
+            raise TimeoutError(f"no worker started within {no_worker_timeout} s; job {job_id} is still queued")
+        time.sleep(poll_interval)
+
+
+# ===== RUN =====
+
+def main():
+    """Load the geometry once, then serve jobs from the spool directory"""
+    print(f"Warming up {len(preload)} script(s)...", flush=True)
+    warm_up(preload)
+    serve(spool_dir, poll_interval, idle_timeout, heartbeat_timeout)
+    instrument.print_summary()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['submit']:
+        # python worker.py submit job.json [...]: queue jobs and stream their output
+        for job_path in sys.argv[2:]:
+            job_id = submit(json.loads(Path(job_path).read_text()), spool_dir)
+            print(f"Submitted {job_path} as {job_id}", flush=True)
+            try:
+                record = wait(job_id, spool_dir, heartbeat_timeout=heartbeat_timeout,
+                              no_worker_timeout=no_worker_timeout)
+            except (RuntimeError, TimeoutError) as e:
+                print(f"ERROR: {e}")
+                sys.exit(1)
+            elapsed = f" in {record['elapsed_s']:.1f} s" if 'elapsed_s' in record else ''
+            print(f"{record['status']}{elapsed}: {record.get('result', record.get('error'))}")
+    else:
+        main()
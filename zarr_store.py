@@ -0,0 +1,173 @@
+import fcntl
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+import instrument
+from cli import read_models_from_file
+from executor import default_workers, run_units
+from output_encoding import output_dtype
+
+# ===== INPUTS =====
+
+# Converter for existing yearly NetCDF outputs (run this file)
+base_dir = '/gpfs/data/greenocean/software/runs/'
+models_file = 'models.txt'  # Path to text file containing model names
+n_workers = default_workers()  # Processes for (model, kind, year) units; 1 runs serially
+kinds = ['LoP_T', 'LNL_T']
+year_start = 1940
+year_end = 2023
+
+# ===== FUNCTIONS =====
+
+def store_path(base_dir, model, kind):
+    """Per-model store for one yearly output kind, e.g. .../TOM12_TJ_LA50/ORCA2_1m_LNL_T.zarr"""
+    return Path(base_dir) / model / f'ORCA2_1m_{kind}.zarr'
+
+
+def yearly_file(base_dir, model, kind, year):
+    """Yearly NetCDF output, e.g. .../ORCA2_1m_19400101_19401231_LNL_T.nc"""
+    return Path(base_dir) / model / f'ORCA2_1m_{year}0101_{year}1231_{kind}.nc'
+
+
+@contextmanager
+def store_lock(path):
+    """Exclusive lock on a store (a POSIX lock on a sidecar file), held across processes"""
+    lock_file = Path(f'{path}.lock')
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def init_store(path, template, years, time_dim='time_counter'):
+    """
+    Create an empty store covering every year, with consolidated metadata.
+
+    The time axis is allocated for all years up front, using the template's
+    time steps shifted to each year, and every variable is chunked as one
+    time step x the full (depth, y, x) slab. Years are then written into
+    their own regions (see write_year), so the metadata never changes again
+    and a whole run opens with a single metadata read.
+
+    Parameters
+    ----------
+    path : str or Path
+        Store to create
+    template : xr.Dataset
+        One year of output
+    years : list of int
+        All years the store will hold, in order
+    time_dim : str, optional
+        Name of the time dimension
+    """
+    import dask.array as da
+
+    steps = template.sizes[time_dim]
+    year0 = int(template[time_dim].dt.year.values[0])
+    times = [t.replace(year=t.year - year0 + year) for year in years for t in template[time_dim].to_index()]
+
+    # Per-year attributes (e.g. 'year') don't describe the whole store
+    empty = xr.Dataset(attrs={k: v for k, v in template.attrs.items() if k != 'year'})
+    for var in template.data_vars:
+        tv = template[var]
+        if time_dim not in tv.dims:
+            empty[var] = tv
+            continue
+        shape = tuple(steps * len(years) if d == time_dim else tv.sizes[d] for d in tv.dims)
+        chunks = tuple(1 if d == time_dim else -1 for d in tv.dims)
+        empty[var] = xr.DataArray(da.full(shape, np.nan, dtype=output_dtype(tv.dtype), chunks=chunks),
+                                  dims=tv.dims, attrs=tv.attrs)
+
+    coords = {c: v for c, v in template.coords.items() if time_dim not in v.dims}
+    empty = empty.assign_coords(coords).assign_coords({time_dim: times})
+    empty.attrs['years'] = f'{years[0]}-{years[-1]}'
+    empty.to_zarr(path, mode='w', compute=False, consolidated=True)
+
+
+def write_year(ds, path, year, years, time_dim='time_counter'):
+    """
+    Write one year of output into its region of a per-model store.
+
+    The store is created by the first writer (under a lock), after which
+    years write disjoint, chunk-aligned regions, so parallel units can
+    write at the same time without corrupting each other.
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        One year of output
+    path : str or Path
+        Store path (see store_path)
+    year : int
+        Year of ds
+    years : list of int
+        All years the store holds
+    time_dim : str, optional
+        Name of the time dimension
+    """
+    path = Path(path)
+    with store_lock(path):
+        if not (path / '.zmetadata').exists() and not (path / 'zarr.json').exists():
+            init_store(path, ds, years, time_dim)
+
+    steps = ds.sizes[time_dim]
+    start = years.index(year) * steps
+    region = ds[[v for v in ds.data_vars if time_dim in ds[v].dims]]
+    region = region.drop_vars([c for c in region.coords])
+    region.attrs = {}
+    for var in region.data_vars:
+        region[var].encoding = {}
+    with instrument.stage('write'):
+        region.to_zarr(path, region={time_dim: slice(start, start + steps)}, consolidated=False)
+
+
+def open_store(base_dir, model, kind):
+    """Open a per-model store (one consolidated metadata read)"""
+    return xr.open_zarr(store_path(base_dir, model, kind), consolidated=True)
+
+
+def convert_unit(model, kind, year, years):
+    """Work unit for run_units: copy one existing yearly NetCDF file into its model's store"""
+    source = yearly_file(base_dir, model, kind, year)
+    if not source.exists():
+        return False
+    with instrument.unit(model=model, kind=kind, year=year), xr.open_dataset(source) as ds:
+        with instrument.stage('load'):
+            ds = ds.load()
+        write_year(ds, store_path(base_dir, model, kind), year, years)
+    return True
+
+
+# ===== RUN =====
+
+def main():
+    """Convert the existing yearly NetCDF outputs of every model in models_file to stores"""
+    models = read_models_from_file(models_file)
+
+    if not models:
+        print("No models to process. Exiting.")
+        exit(1)
+
+    years = list(range(year_start, year_end + 1))
+    units = [(model, kind, year, years) for model in models for kind in kinds for year in years]
+    print(f"Converting {', '.join(kinds)} for {len(models)} model(s) with {n_workers} worker(s)")
+    results = run_units(convert_unit, units, n_workers, error_format='  ERROR converting {0} {1} {2}: {e}')
+
+    for model in models:
+        for kind in kinds:
+            n_done = sum(1 for (m, k, _, _), r in zip(units, results) if m == model and k == kind and r)
+            if n_done:
+                print(f"  {model} {kind}: {n_done} years -> {store_path(base_dir, model, kind)}")
+
+    instrument.print_summary()
+    print("All conversions complete!")
+
+
+if __name__ == '__main__':
+    main()